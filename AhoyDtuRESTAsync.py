@@ -7,51 +7,113 @@
 #    http://<ahoydtu>/api/index            - reachability and 'cur_pwr' of the above inverters
 #    http://<ahoydtu>/api/live             - measurement point names and units of ch0 (AC) and ch1..n (PV)
 #    http://<ahoydtu>/api/inverter/id/<nr> - measurement point values (AC and PV(s)), active power limit 'power_limit_read'
+#    http://<ahoydtu>/api/ctrl             - POST of JSON commands {"id":<nr>, "cmd":..., "val":...}
 #
 # Note: AhoyDTU firmware versions up to 0.7.26 had http://<ahoydtu>/api/record/live
 # which had measurement point names, values, units. This was deprecated in later
 # versions of the Ahoy REST API, see https://github.com/lumapu/ahoy/issues/1185
 #
-# Now measurement names and units are read once at creation of AhoyDtuREST().
+# Now measurement names and units are read once, before the first inverter data query,
+# and cached per DTU host for all of its inverters. The cached names are dropped and
+# read again when an inverter reply no longer fits them, or the inverter firmware
+# versions in /api/inverter/list change, e.g. after a firmware update.
 # Live values are read from /api/inverter/id/<nr> and parsed.
-# There is a field 'ts_last_success' which contains the Unix timestamp. Todo: use it?
+# The field 'ts_last_success' contains the Unix timestamp of the inverter data,
+# it tells the age of a reading (InverterReading.timestamp).
+#
+# Asynchronous requests go through the caller's AsyncHttpPool, which the caller also
+# closes. The control loop passes in its shared pool so that connections to the DTU
+# are kept alive between polls.
+#
+# AhoyDtuRESTAsync.discover() creates one instance per inverter listed by the DTU,
+# with their number of DC inputs, all on the caller's pool; readInverters() reads
+# several inverters concurrently.
+#
+# The measurement names are compiled once into a name->index table per channel.
+# parseReading() turns a reply into a compact InverterReading, a flat array of the
+# values of all channels, for repeated lookups e.g. when decoding long replay logs.
 #
-
-import requests
 
 import asyncio
-import aiohttp
 
 import threading
-import time, datetime
-import json
+import datetime
+import math
+from array import array
+
+from AsyncHttpPool import AsyncHttpPool
+
+
+# Measurement names and units per DTU hostname: {'versions': inverter firmware versions or None,
+# 'ch0_fld_names', 'ch0_fld_units', 'fld_names', 'fld_units': as in /api/live,
+# 'ch0_fld_index', 'fld_index': name -> position in the channel values}
+_field_schemas = {}
+
+
+class InverterReading:
+	"""
+	Measurement values of all channels of one inverter data reply, as one array of floats.
+	Values that are not numbers are NaN, get() returns None for them.
+	"""
+	__slots__ = ('inverter', 'timestamp', 'power_limit_percent', 'values', 'offsets', 'field_index')
+
+	def __init__(self, inverter, timestamp, power_limit_percent, channels, field_index):
+		self.inverter = inverter
+		self.timestamp = timestamp
+		self.power_limit_percent = power_limit_percent
+		self.values = array('d')
+		self.offsets = []
+		for ch in channels:
+			self.offsets.append(len(self.values))
+			self.values.extend([v if isinstance(v, (int, float)) else math.nan for v in ch])
+		self.field_index = field_index[:len(channels)]
+
+
+	def get(self, measurement_name, channel=0):
+
+		if channel >= len(self.field_index):
+			return None
+		i = self.field_index[channel].get(measurement_name)
+		if i is None:
+			return None
+		v = self.values[self.offsets[channel] + i]
+		return None if math.isnan(v) else v
+
+
+	def getActiveLimitWatt(self):
+		"""
+		Active power limit in Watt, or None if the reply had no limit or inverter max power.
+		"""
+		max_P = self.get('MaxPower', 0)
+		if self.power_limit_percent is None or not max_P:
+			return None
+		return self.power_limit_percent * max_P / 100.0
+
 
 class AhoyDtuRESTAsync(threading.Thread):
 
-	def __init__(self, host, inverter=0):
+	def __init__(self, host, pool, inverter=0):
 
 		threading.Thread.__init__(self)
 		self.hostname = str(host)
 		self.inverter = int(inverter)
+		self.pool = pool
 		self.runnable = self.queryLoop
 		self.daemon = True
 
-		self.max_chan = 1 + 8  # todo: from http://<ahoydtu>/api/inverter/list JSON get max(inverter[]['channels']) + 1
+		self.name = None
+		self.channels = None   # number of DC inputs, from /api/inverter/list or the first data reply
 		self.AC_CHAN = 0
+		self.DC_INPUT_1 = 1
 
 		self.readings = {}
 		self.last_update = datetime.datetime.utcnow()
 
-		url = 'http://%s/api/live' % (self.hostname)
-		j = self._getJSON(url)
-
-		self.field_names = [[]] * self.max_chan
-		self.field_units = [[]] * self.max_chan
-		self.field_names[0] = j['ch0_fld_names']
-		self.field_units[0] = j['ch0_fld_units']
-		for n in range(1, self.max_chan):
-			self.field_names[n] = j['fld_names']
-			self.field_units[n] = j['fld_units']
+		self.field_names = None
+		self.field_units = None
+		self.field_index = None
+		self.schema = None
+		self.inverter_versions = None
 
 
 	def run(self):
@@ -66,7 +128,7 @@ class AhoyDtuRESTAsync(threading.Thread):
 		while True:
 			invdata = await self.readInverterData()
 			plimit = self.getActiveLimit(invdata)
-			print('== Inverter %d - power limit %d Watt ==' % (self.inverter, plimit))
+			print('== Inverter %d - power limit %.0f %% ==' % (self.inverter, plimit))
 			print('Updated     %s' % (str(self.last_update)))
 			print('YieldTotal  %s' % (self.getChannelMeasurement(invdata, 'YieldTotal', self.AC_CHAN)))
 			print('YieldDay    %s' % (self.getChannelMeasurement(invdata, 'YieldDay', self.AC_CHAN)))
@@ -75,69 +137,127 @@ class AhoyDtuRESTAsync(threading.Thread):
 			await asyncio.sleep(5)
 
 
-	def _getJSON(self, url):
+	async def _getJSON_async(self, url):
 
-		try:
-			r = requests.get(url, timeout=5)
-		except requests.ConnectionError as e:
-			print(e)
-			return None
-		except requests.exceptions.ReadTimeout as e:
-			print(e)
-			return None
+		return await self.pool.getJSON(url, timeout_s=2)
 
-		if (r.status_code != 200):
-			print ('HTTP Error %d while querying %s' % (r.status_code, url))
-			return None
 
-		try:
-			j = r.json()
-		except json.decoder.JSONDecodeError as e:
-			print ('JSON response decode error: %s' % (str(e)))
-			return None
+	@classmethod
+	async def discover(cls, host, pool):
+		"""
+		Create one AhoyDtuRESTAsync for each enabled inverter listed in http://<ahoydtu>/api/inverter/list,
+		with the measurement point names already loaded. Returns an empty list if the DTU is not reachable.
+		The instances use the caller's AsyncHttpPool, which the caller closes.
+		"""
+		probe = cls(host, pool)
+		inverters = await probe.loadInverterList()
+		if not inverters or not await probe.loadFieldNames():
+			return []
 
-		if not j:
-			print("Unexpected reply on %s: %s - %s" % (url, str(r), str(j)))
+		dtus = []
+		for inv in inverters:
+			if not inv.get('enabled', True):
+				continue
+			dtu = cls(host, pool, inverter=inv['id'])
+			dtu.name = inv.get('name')
+			dtu.channels = int(inv.get('channels', 1))
+			dtu._applyFieldSchema(_field_schemas[dtu.hostname])
+			dtus.append(dtu)
+
+		return dtus
+
+
+	async def loadInverterList(self):
+		"""
+		Fetch the list of inverters from http://<ahoydtu>/api/inverter/list. Drops the cached
+		measurement point names of the DTU if the inverter firmware versions have changed.
+		"""
+		url = 'http://%s/api/inverter/list' % (self.hostname)
+		j = await self._getJSON_async(url)
+		if not j or 'inverter' not in j:
 			return None
 
-		return j
+		versions = [inv.get('version') for inv in j['inverter']]
+		schema = _field_schemas.get(self.hostname)
+		if schema is not None and schema['versions'] not in (None, versions):
+			print('Inverter firmware on %s changed, reloading measurement names' % (self.hostname))
+			del _field_schemas[self.hostname]
+		elif schema is not None:
+			schema['versions'] = versions
+		self.inverter_versions = versions
 
+		for inv in j['inverter']:
+			if int(inv['id']) == self.inverter:
+				self.name = inv.get('name')
+				self.channels = int(inv.get('channels', 1))
 
-	async def _getJSON_async(self, url):
+		return j['inverter']
 
-		try:
-			nokeepalive = aiohttp.TCPConnector(force_close=True)
-			async with aiohttp.ClientSession(connector=nokeepalive, timeout=aiohttp.ClientTimeout(total=2)) as client:
-				async with client.get(url) as resp:
-					if resp.status != 200:
-						print ('HTTP Error %d while querying %s' % (resp.status, url))
-						return None
-					j = await resp.json()
-
-					if not j:
-						print("Unexpected reply on %s: %s - %s" % (url, str(r), str(j)))
-						return None
-
-					return j
-		except aiohttp.ServerDisconnectedError:
-			print('Unexpected _getJSON(%s) outcome - server disconnected' % (url))
-			return None
-		except Exception as e:
-			print('Unexpected _getJSON(%s) outcome - exception: %s' % (url, str(e)))
-			return None
 
-		print('Unexpected _getJSON(%s) outcome, maybe could not connect' % (url))
+	async def loadFieldNames(self):
+		"""
+		Fetch measurement point names and units from http://<ahoydtu>/api/live, unless cached for this DTU.
+		"""
+		schema = _field_schemas.get(self.hostname)
+		if schema is None:
+			url = 'http://%s/api/live' % (self.hostname)
+			j = await self._getJSON_async(url)
+			if not j:
+				return False
+			schema = {'versions': self.inverter_versions}
+			for key in ('ch0_fld_names', 'ch0_fld_units', 'fld_names', 'fld_units'):
+				schema[key] = j[key]
+			schema['ch0_fld_index'] = {name: i for i, name in enumerate(j['ch0_fld_names'])}
+			schema['fld_index'] = {name: i for i, name in enumerate(j['fld_names'])}
+			_field_schemas[self.hostname] = schema
+
+		self._applyFieldSchema(schema)
+		return True
 
-		return None
+
+	def _applyFieldSchema(self, schema):
+
+		nchan = 1 + (self.channels if self.channels is not None else 1)
+		self.field_names = [schema['ch0_fld_names']] + [schema['fld_names']] * (nchan - 1)
+		self.field_units = [schema['ch0_fld_units']] + [schema['fld_units']] * (nchan - 1)
+		self.field_index = [schema['ch0_fld_index']] + [schema['fld_index']] * (nchan - 1)
+		self.schema = schema
+
+
+	def _fitsFieldSchema(self, j):
+		"""
+		Check an inverter reply against the measurement point names, adapting them to its
+		number of channels. Returns False if the names do not fit (e.g. new firmware).
+		"""
+		if 'ch' not in j or len(j['ch']) < 1:
+			return True
+		if len(j['ch'][0]) != len(self.schema['ch0_fld_names']):
+			return False
+		if any(len(ch) != len(self.schema['fld_names']) for ch in j['ch'][1:]):
+			return False
+		if self.channels is None or len(j['ch']) != len(self.field_names):
+			self.channels = len(j['ch']) - 1
+			self._applyFieldSchema(self.schema)
+		return True
 
 
 	async def readInverterData(self):
 
+		if self.field_names is None and not await self.loadFieldNames():
+			return None
+
 		url = 'http://%s/api/inverter/id/%d' % (self.hostname, self.inverter)
 		j = await self._getJSON_async(url)
 		if not j:
 			return None
 
+		if not self._fitsFieldSchema(j):
+			print('Inverter %d data does not fit the measurement names of %s, reloading them' % (self.inverter, self.hostname))
+			if _field_schemas.get(self.hostname) is self.schema:
+				del _field_schemas[self.hostname]
+			if not await self.loadFieldNames() or not self._fitsFieldSchema(j):
+				return None
+
 		self.last_update = self.getDataTimestamp(j)
 
 		return j
@@ -151,9 +271,20 @@ class AhoyDtuRESTAsync(threading.Thread):
 		return dtime
 
 
+	def parseReading(self, invdata):
+		"""
+		Compact InverterReading of an inverter data reply, or None if there is no reply.
+		"""
+		if not invdata or self.field_index is None:
+			return None
+		limit = invdata.get('power_limit_read')
+		return InverterReading(self.inverter, invdata.get('ts_last_success'),
+			float(limit) if limit is not None else None, invdata.get('ch', []), self.field_index)
+
+
 	def getChannelMeasurements(self, invdata, channel=0, verbose=False):
 
-		if channel < 0 or channel > len(invdata['ch']):
+		if channel < 0 or channel >= len(invdata['ch']):
 			return None
 
 		if verbose:
@@ -167,24 +298,86 @@ class AhoyDtuRESTAsync(threading.Thread):
 
 	def getChannelMeasurement(self, invdata, measurement_name, channel=0, verbose=False):
 
-		try:
-			i = self.field_names[channel].index(measurement_name)
-			return invdata['ch'][channel][i]
-		except:
+		if not invdata or self.field_index is None or channel >= len(self.field_index):
 			return None
+		i = self.field_index[channel].get(measurement_name)
+		channels = invdata.get('ch', [])
+		if i is None or channel >= len(channels) or i >= len(channels[channel]):
+			return None
+		return channels[channel][i]
 
 
 	def getActiveLimit(self, invdata):
-
+		"""
+		Active power limit as reported by the DTU, in percent of the inverter max power.
+		"""
 		if 'power_limit_read' in invdata:
 			return float(invdata['power_limit_read'])
 		return 0
 
 
+	def getActiveLimitWatt(self, invdata):
+		"""
+		Active power limit in Watt, or None if the DTU did not report the limit or the inverter max power.
+		"""
+		if not invdata or 'power_limit_read' not in invdata:
+			return None
+		max_P = self.getChannelMeasurement(invdata, 'MaxPower', self.AC_CHAN)
+		if not max_P:
+			return None
+		return float(invdata['power_limit_read']) * float(max_P) / 100.0
+
+
+	async def sendCommand(self, cmd, val=None, timeout_s=5, retries=2, retry_delay_s=0.5):
+		"""
+		POST a control command for this inverter to http://<ahoydtu>/api/ctrl.
+		Returns the decoded DTU reply, e.g. {'success': True}, or None if all attempts failed.
+		"""
+		url = 'http://%s/api/ctrl' % (self.hostname)
+		payload = {'id': self.inverter, 'cmd': cmd}
+		if val is not None:
+			payload['val'] = val
+
+		for attempt in range(1 + retries):
+			if attempt > 0:
+				await asyncio.sleep(retry_delay_s)
+			j = await self.pool.postJSON(url, payload, timeout_s=timeout_s, retries=0)
+			if j and j.get('success', True):
+				return j
+			print('DTU command %s failed (attempt %d of %d), reply: %s' % (str(payload), attempt + 1, 1 + retries, str(j)))
+
+		return None
+
+
+	async def setPowerLimit(self, P_Watt, persistent=False, timeout_s=5, retries=2):
+		"""
+		Set the absolute AC power limit of the inverter, non-persistent by default.
+		"""
+		cmd = 'limit_persistent_absolute' if persistent else 'limit_nonpersistent_absolute'
+		return await self.sendCommand(cmd, int(P_Watt), timeout_s=timeout_s, retries=retries)
+
+
+	async def setPowerState(self, powerEnabled=True, timeout_s=5, retries=2):
+		"""
+		Turn the inverter power production on or off.
+		"""
+		return await self.sendCommand('power', 1 if powerEnabled else 0, timeout_s=timeout_s, retries=retries)
+
+
+async def readInverters(dtus):
+	"""
+	Read the data of several inverters concurrently. Returns their replies in the same order, None where failed.
+	"""
+	return await asyncio.gather(*[dtu.readInverterData() for dtu in dtus])
+
+
 if __name__ == '__main__':
 
 	async def main():
-		dtu = AhoyDtuRESTAsync('192.168.0.52', inverter=1)
-		await dtu.queryLoop()
+		async with AsyncHttpPool(timeout_s=2) as pool:
+			dtus = await AhoyDtuRESTAsync.discover('192.168.0.52', pool)
+			for dtu in dtus:
+				print('Inverter %d: %s with %d DC inputs' % (dtu.inverter, dtu.name, dtu.channels))
+			await asyncio.gather(*[dtu.queryLoop() for dtu in dtus])
 
 	asyncio.run(main())
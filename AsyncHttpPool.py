@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+#
+# Shared, long-lived HTTP client for the local devices (AhoyDTU, Tibber Bridge,
+# MyStrom switch) polled by the control loop.
+#
+# One aiohttp session and TCP connector are kept for the lifetime of the loop
+# instead of one per request. Connections are kept alive between polls, the
+# number of parallel connections per device is limited (the ESP8266/ESP32 web
+# servers cope with only a few sockets), and a request that fails because the
+# device silently dropped a kept-alive socket is retried on a fresh connection.
+#
+# If a TrafficRecorder is attached, every response body is recorded.
+#
+
+import asyncio
+import aiohttp
+import json
+
+class AsyncHttpPool:
+
+	def __init__(self, limit_per_host=2, keepalive_timeout_s=30, timeout_s=5, retries=1, recorder=None):
+		self.limit_per_host = int(limit_per_host)
+		self.keepalive_timeout_s = float(keepalive_timeout_s)
+		self.timeout_s = float(timeout_s)
+		self.retries = int(retries)
+		self.recorder = recorder
+		self.session = None
+
+
+	async def __aenter__(self):
+		return self
+
+
+	async def __aexit__(self, *exc_info):
+		await self.close()
+
+
+	def _getSession(self):
+		"""
+		Return the shared session, (re)creating it lazily inside the running event loop.
+		"""
+		if self.session is None or self.session.closed:
+			connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host,
+				keepalive_timeout=self.keepalive_timeout_s, enable_cleanup_closed=True)
+			self.session = aiohttp.ClientSession(connector=connector,
+				timeout=aiohttp.ClientTimeout(total=self.timeout_s))
+		return self.session
+
+
+	async def close(self):
+		if self.session is not None and not self.session.closed:
+			await self.session.close()
+		self.session = None
+
+
+	async def request(self, method, url, auth=None, timeout_s=None, payload=None, retries=None, headers=None):
+		"""
+		Issue a request and return (status, body bytes), or None on failure.
+
+		Connection-level errors on a reused socket (device closed it meanwhile)
+		are retried up to 'retries' times, each retry gets a new connection.
+		"""
+		if retries is None:
+			retries = self.retries
+		kwargs = {'auth': auth, 'json': payload, 'headers': headers}
+		if timeout_s:
+			kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout_s)
+
+		attempt = 0
+		while True:
+			try:
+				client = self._getSession()
+				async with client.request(method, url, **kwargs) as resp:
+					body = await resp.read()
+					if self.recorder is not None:
+						self.recorder.record('%s %s' % (method, url), body, resp.status)
+					return (resp.status, body)
+			except (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError) as e:
+				if attempt >= retries:
+					print('Unexpected %s(%s) outcome - connection lost: %s' % (method, url, str(e)))
+					return None
+			except asyncio.TimeoutError:
+				if attempt >= retries:
+					print('Unexpected %s(%s) outcome - timeout' % (method, url))
+					return None
+			except Exception as e:
+				print('Unexpected %s(%s) outcome - exception: %s' % (method, url, str(e)))
+				return None
+			attempt += 1
+
+
+	async def getBytes(self, url, auth=None, timeout_s=None):
+
+		r = await self.request('GET', url, auth=auth, timeout_s=timeout_s)
+		if not r:
+			return None
+
+		status, body = r
+		if status != 200:
+			print('HTTP Error %d while querying %s' % (status, url))
+			return None
+
+		return body
+
+
+	async def getJSON(self, url, auth=None, timeout_s=None):
+
+		body = await self.getBytes(url, auth=auth, timeout_s=timeout_s)
+		if body is None:
+			return None
+
+		try:
+			j = json.loads(body)
+		except ValueError as e:
+			print('JSON response decode error on %s: %s' % (url, str(e)))
+			return None
+
+		if not j:
+			print('Unexpected reply on %s: %s' % (url, str(body)))
+			return None
+
+		return j
+
+
+	async def postJSON(self, url, payload, timeout_s=None, retries=None, headers=None):
+		"""
+		POST a JSON payload, return the decoded JSON reply or None.
+		"""
+		r = await self.request('POST', url, payload=payload, timeout_s=timeout_s, retries=retries, headers=headers)
+		if not r:
+			return None
+
+		status, body = r
+		if status != 200:
+			print('HTTP Error %d while posting to %s' % (status, url))
+			return None
+
+		try:
+			j = json.loads(body)
+		except ValueError as e:
+			print('JSON response decode error on %s: %s' % (url, str(e)))
+			return None
+
+		return j
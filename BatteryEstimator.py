@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+#
+# Battery state estimate of a 16S LFP battery from BMS and DTU readings.
+#
+# BMS readings arrive every few seconds (MQTT) to minutes (InfluxDB), or not at
+# all for a while; the DTU reports the inverter output on every poll; the loop
+# ticks with every grid meter frame. BatteryStateEstimator.update() runs on each
+# tick and fuses what is there:
+#
+#   current  - battery current of the latest BMS reading, corrected by the change of
+#              the inverter DC draw since then; the charger current is assumed unchanged
+#   voltage  - BMS voltage, load-compensated with the internal resistance model
+#              V = OCV + I*R for the current change since the BMS reading
+#   OCV      - open circuit voltage V - I*R, i.e. the voltage without the load drop
+#   SoC      - coulomb counting of V*I, pulled towards the BMS SoC on each new BMS
+#              reading, and towards the SoC of the OCV while at rest in the steep
+#              parts of the LFP curve (below 20 %, above 90 %)
+#
+# The internal resistance R is refined from voltage and current steps between two
+# BMS readings. The estimate is 'ok' from the first BMS reading on for max_coast_s
+# after the latest one; coulomb counting alone drifts.
+#
+
+# open circuit voltage vs state of charge of 16 LFP cells in series, cf. powerControlLoopAsync.py
+LFP_16S_OCV = [(0, 44.0), (5, 48.0), (10, 50.0), (20, 51.2), (40, 52.0), (60, 52.3), (80, 53.1), (95, 53.6), (100, 55.2)]
+
+
+def socFromOcv(ocv_V):
+	"""
+	State of charge [%] for an open circuit voltage, by linear interpolation of LFP_16S_OCV.
+	"""
+	if ocv_V <= LFP_16S_OCV[0][1]:
+		return LFP_16S_OCV[0][0]
+	for (soc0, V0), (soc1, V1) in zip(LFP_16S_OCV, LFP_16S_OCV[1:]):
+		if ocv_V <= V1:
+			return soc0 + (soc1 - soc0) * (ocv_V - V0) / (V1 - V0)
+	return LFP_16S_OCV[-1][0]
+
+
+class BatteryStateEstimator:
+
+	def __init__(self, capacity_Wh=5120.0, R_ohm=0.03, inverter_efficiency=0.95, max_coast_s=900,
+			soc_gain=0.3, ocv_gain_per_s=0.001, rest_current_A=2.0):
+
+		self.capacity_Wh = float(capacity_Wh)
+		self.R_ohm = float(R_ohm)
+		self.inverter_efficiency = inverter_efficiency
+		self.max_coast_s = max_coast_s
+		self.soc_gain = soc_gain
+		self.ocv_gain_per_s = ocv_gain_per_s
+		self.rest_current_A = rest_current_A
+
+		self.T = None
+		self.soc = None
+		self.voltage_V = None
+		self.current_A = 0.0
+		self.ocv_V = None
+		self.ok = False
+
+		# latest BMS reading used, and the inverter DC draw at that time
+		self.bms_T = None
+		self.bms_V = None
+		self.bms_I = None
+		self.bms_Pdc = None
+
+
+	def _onBmsReading(self, T, V, P, soc, P_dc):
+
+		I = P / V
+		if self.bms_T is not None and T - self.bms_T <= 120 and abs(I - self.bms_I) > 2.0:
+			R = (V - self.bms_V) / (I - self.bms_I)
+			if 0.002 < R < 0.3:
+				self.R_ohm = 0.9 * self.R_ohm + 0.1 * R
+
+		if self.soc is None:
+			self.soc = soc
+		else:
+			self.soc += self.soc_gain * (soc - self.soc)
+
+		self.bms_T, self.bms_V, self.bms_I, self.bms_Pdc = T, V, I, P_dc
+
+
+	def update(self, T, s):
+		"""
+		Advance the estimate to time T with the sample s (keys as of PowerControlLogic.decide(),
+		'bms_T' the acquisition time of the BMS values). Returns True if the estimate is ok.
+		"""
+		P_dc = None
+		if s.get('dtu_ok', True):
+			P_dc = s.get('dtu_battery_Pac', s['dtu_Pac']) / self.inverter_efficiency
+
+		bms_T = s.get('bms_T')
+		if bms_T is not None and s['bmsVolt'] > 0 and (self.bms_T is None or bms_T > self.bms_T):
+			self._onBmsReading(bms_T, s['bmsVolt'], s['bmsPower'], s['bmsSOC'], P_dc)
+
+		if self.soc is None:
+			self.T = T
+			return False
+
+		I = self.bms_I
+		if P_dc is not None and self.bms_Pdc is not None:
+			I -= (P_dc - self.bms_Pdc) / self.bms_V
+		V = self.bms_V + (I - self.bms_I) * self.R_ohm
+
+		dt = T - self.T if self.T is not None and T > self.T else 0.0
+		self.soc += 100.0 * V * I * dt / 3600.0 / self.capacity_Wh
+		self.ocv_V = V - I * self.R_ohm
+		if abs(I) < self.rest_current_A:
+			soc_ocv = socFromOcv(self.ocv_V)
+			if soc_ocv < 20.0 or soc_ocv > 90.0:
+				self.soc += min(1.0, self.ocv_gain_per_s * dt) * (soc_ocv - self.soc)
+		self.soc = min(100.0, max(0.0, self.soc))
+
+		self.T, self.voltage_V, self.current_A = T, V, I
+		self.ok = (T - self.bms_T <= self.max_coast_s)
+		return self.ok
+
+
+	def values(self):
+		"""
+		Estimate as sample keys: battery_V, battery_W, battery_SOC, battery_ocv_V, battery_ok.
+		"""
+		if self.soc is None:
+			return {'battery_ok': False}
+		return {'battery_V': self.voltage_V, 'battery_W': self.voltage_V * self.current_A, 'battery_SOC': self.soc,
+			'battery_ocv_V': self.ocv_V, 'battery_ok': self.ok}
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+#
+# Latest BMS readings straight from MQTT, with InfluxDB as the fallback.
+#
+# The BMS gateway publishes the JK-BMS and Steca values on MQTT, from where they
+# are also written into InfluxDB. BmsDataSource subscribes to the same topics
+# (LocalInfluxdbQueryAsync.BMS_TOPICS) and keeps the latest value and its arrival
+# time in memory. getBatteryReadings() answers from memory while the values are
+# fresher than max_age_s, and otherwise queries InfluxDB, e.g. after an MQTT
+# outage or right after startup. Each value is then taken from the fresher source.
+# If InfluxDB fails as well, the MQTT values are returned as they are, however old;
+# the control logic judges their age.
+#
+
+import asyncio
+
+import aiohttp
+from aioinflux import InfluxDBError
+
+from ControlScheduler import MonotonicClock
+from LocalInfluxdbQueryAsync import BMS_TOPICS, BmsReadings
+
+
+class BmsDataSource:
+
+	def __init__(self, mqtt, influx, max_age_s=60, clock=None):
+		self.influx = influx
+		self.max_age_s = max_age_s
+		self.clock = clock if clock is not None else MonotonicClock()
+		self.latest = BmsReadings()
+		self.names = {topic: name for name, topic in BMS_TOPICS.items()}
+		self.stats = {'messages': 0, 'mqtt': 0, 'influx': 0, 'influx_failed': 0}
+
+		for topic in self.names:
+			mqtt.subscribe(topic, self._onMessage)
+
+
+	async def close(self):
+		await self.influx.close()
+
+
+	def _onMessage(self, topic, payload):
+
+		try:
+			value = float(payload)
+		except ValueError:
+			print('Unexpected BMS value on %s: %s' % (topic, str(payload)))
+			return
+		name = self.names[topic]
+		setattr(self.latest, name, value)
+		self.latest.timestamps[name] = self.clock.wallclock().timestamp()
+		self.stats['messages'] += 1
+
+
+	def _isFresh(self, readings, now):
+
+		for name in ('voltage', 'power', 'soc'):
+			age = readings.age(name, now)
+			if age is None or age > self.max_age_s:
+				return False
+		return True
+
+
+	async def getBatteryReadings(self):
+		"""
+		Latest BMS values and their times as a BmsReadings, see LocalInfluxdbQueryAsync.getBatteryReadings().
+		"""
+		now = self.clock.wallclock().timestamp()
+		readings = BmsReadings()
+		for name in BMS_TOPICS:
+			setattr(readings, name, getattr(self.latest, name))
+		readings.timestamps = dict(self.latest.timestamps)
+
+		if self._isFresh(readings, now):
+			self.stats['mqtt'] += 1
+			return readings
+
+		self.stats['influx'] += 1
+		try:
+			stored = await self.influx.getBatteryReadings()
+		except (aiohttp.ClientError, asyncio.TimeoutError, InfluxDBError) as e:
+			self.stats['influx_failed'] += 1
+			print('BMS readings from InfluxDB failed: %s' % (repr(e)))
+			return readings
+		for name, T in stored.timestamps.items():
+			if T > readings.timestamps.get(name, -1):
+				setattr(readings, name, getattr(stored, name))
+				readings.timestamps[name] = T
+
+		return readings
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+#
+# Small asyncio scheduling helpers for the power control loop.
+#
+# MonotonicClock   - time source based on time.monotonic(), immune to wall clock steps,
+#                    plus the local wall clock time for time-of-day decisions
+# DeadlineTicker   - drift-free periodic ticks: deadlines are multiples of the interval
+#                    from the start time, a late tick does not shift later ticks
+# Mailbox          - single-slot hand-over between tasks where only the newest value counts
+# TokenBucket      - rate limit with bursts, e.g. for radio commands to a device
+# runTasks()       - run cooperating tasks until one fails, then cancel and await all of them
+# waitEvent()      - wait for an asyncio.Event with timeout, without the asyncio.wait_for()
+#                    pitfall of converting a task cancellation into a timeout
+#
+
+import asyncio
+import datetime
+import time
+
+
+class MonotonicClock:
+
+	def now(self):
+		return time.monotonic()
+
+	def wallclock(self):
+		return datetime.datetime.now()
+
+	async def sleep(self, dt):
+		await asyncio.sleep(max(0.0, dt))
+
+	async def sleep_until(self, deadline):
+		await asyncio.sleep(max(0.0, deadline - self.now()))
+
+
+class DeadlineTicker:
+
+	def __init__(self, interval_s, clock=None):
+		self.interval_s = float(interval_s)
+		self.clock = clock if clock is not None else MonotonicClock()
+		self.start = None
+		self.ticks = 0
+		self.missed = 0
+
+
+	async def wait(self):
+		"""
+		Sleep until the next tick deadline and return it. The first call returns immediately.
+		Ticks whose deadline already passed (e.g. a slow device query) are skipped rather
+		than fired back-to-back.
+		"""
+		now = self.clock.now()
+		if self.start is None:
+			self.start = now
+			return now
+
+		self.ticks += 1
+		deadline = self.start + self.ticks * self.interval_s
+		if deadline < now:
+			late = int((now - deadline) / self.interval_s) + 1
+			self.missed += late
+			self.ticks += late
+			deadline = self.start + self.ticks * self.interval_s
+
+		await self.clock.sleep_until(deadline)
+		return deadline
+
+
+class Mailbox:
+
+	def __init__(self):
+		self.value = None
+		self.event = asyncio.Event()
+
+
+	def put(self, value):
+		"""
+		Deposit a value, replacing any value not yet picked up.
+		"""
+		self.value = value
+		self.event.set()
+
+
+	def peek(self):
+		return self.value if self.event.is_set() else None
+
+
+	async def get(self):
+		await self.event.wait()
+		self.event.clear()
+		value, self.value = self.value, None
+		return value
+
+
+class TokenBucket:
+
+	EPSILON = 1e-9   # rounding slack, so that sleeping for delay() always yields a token
+
+	def __init__(self, rate_per_s, burst=1, clock=None):
+		self.rate_per_s = float(rate_per_s)
+		self.burst = float(burst)
+		self.clock = clock if clock is not None else MonotonicClock()
+		self.tokens = self.burst
+		self.updated = None
+
+
+	def _refill(self):
+		now = self.clock.now()
+		if self.updated is not None:
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate_per_s)
+		self.updated = now
+
+
+	def delay(self):
+		"""
+		Seconds until a token is available, 0 if one is available now.
+		"""
+		self._refill()
+		if self.tokens >= 1.0 - self.EPSILON:
+			return 0.0
+		return (1.0 - self.tokens) / self.rate_per_s
+
+
+	def take(self):
+		"""
+		Take a token if one is available now. Returns True if one was taken.
+		"""
+		self._refill()
+		if self.tokens >= 1.0 - self.EPSILON:
+			self.tokens = max(0.0, self.tokens - 1.0)
+			return True
+		return False
+
+
+	async def acquire(self):
+		"""
+		Wait until a token is available and take it.
+		"""
+		while not self.take():
+			await self.clock.sleep(self.delay())
+
+
+	async def wait(self):
+		"""
+		Wait until a token is available, without taking it.
+		"""
+		while self.delay() > 0:
+			await self.clock.sleep(self.delay())
+
+
+async def runTasks(*coros):
+	"""
+	Run coroutines as tasks until the first one fails or the caller is cancelled.
+	All tasks are then cancelled and awaited, so that no task outlives the call.
+	"""
+	tasks = [asyncio.create_task(c) for c in coros]
+	try:
+		done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+		for t in done:
+			t.result()
+	finally:
+		for t in tasks:
+			t.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def waitEvent(event, timeout_s=None):
+	"""
+	Wait until the event is set. Returns True if it was set, False on timeout.
+	"""
+	waiter = asyncio.ensure_future(event.wait())
+	try:
+		done, pending = await asyncio.wait([waiter], timeout=timeout_s)
+		return waiter in done
+	finally:
+		if not waiter.done():
+			waiter.cancel()
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+#
+# State of one control cycle, and a history of recent cycles.
+#
+# ControlSnapshot  - readings of grid meter, DTU, BMS and Steca that one decision is
+#                    based on, with fixed fields (__slots__). Reads like a dict, too,
+#                    so PowerControlLogic.decide() takes snapshots as well as dicts.
+# SnapshotHistory  - columnar ring buffer of the snapshots of the last history_s seconds,
+#                    in one preallocated NumPy array. Every row is stored twice, at i and
+#                    i + capacity, so that any window of the history is one contiguous
+#                    view of the array, without copying (window(), column()).
+#
+# Boolean fields are stored as 0.0/1.0, missing values as NaN.
+#
+
+import numpy as np
+
+
+SNAPSHOT_FIELDS = ('T', 'hour', 'meter_T', 'meter_P', 'meter_E', 'meter_slope',
+	'dtu_T', 'dtu_ok', 'dtu_Vdc', 'dtu_Pac', 'dtu_battery_Pac', 'dtu_busy',
+	'bms_T', 'bms_ok', 'bmsVolt', 'bmsPower', 'bmsSOC', 'stecaCharge',
+	'battery_V', 'battery_W', 'battery_SOC', 'battery_ocv_V', 'battery_ok')
+
+
+class ControlSnapshot:
+
+	__slots__ = SNAPSHOT_FIELDS
+
+	def __init__(self, **values):
+		for name, value in values.items():
+			setattr(self, name, value)
+
+
+	def __getitem__(self, name):
+		try:
+			return getattr(self, name)
+		except AttributeError:
+			raise KeyError(name)
+
+
+	def __setitem__(self, name, value):
+		setattr(self, name, value)
+
+
+	def __contains__(self, name):
+		return hasattr(self, name)
+
+
+	def get(self, name, default=None):
+		return getattr(self, name, default)
+
+
+	def asdict(self):
+		return {name: getattr(self, name) for name in SNAPSHOT_FIELDS if hasattr(self, name)}
+
+
+class SnapshotHistory:
+
+	def __init__(self, history_s=3600, interval_s=1.0):
+		self.capacity = max(1, int(history_s / interval_s))
+		self.columns = {name: n for n, name in enumerate(SNAPSHOT_FIELDS)}
+		self.data = np.full((2 * self.capacity, len(SNAPSHOT_FIELDS)), np.nan)
+		self.row = np.full(len(SNAPSHOT_FIELDS), np.nan)
+		self.count = 0   # snapshots appended so far
+
+
+	def __len__(self):
+		return min(self.count, self.capacity)
+
+
+	def append(self, snapshot):
+		"""
+		Add a snapshot, overwriting the oldest one once the history is full.
+		"""
+		for n, name in enumerate(SNAPSHOT_FIELDS):
+			value = snapshot.get(name)
+			self.row[n] = np.nan if value is None else float(value)
+		i = self.count % self.capacity
+		self.data[i] = self.row
+		self.data[i + self.capacity] = self.row
+		self.count += 1
+
+
+	def window(self, window_s=None, now=None):
+		"""
+		View of the rows of the last window_s seconds (all rows if None), oldest first.
+		Columns are in the order of SNAPSHOT_FIELDS. The view changes with later appends.
+		"""
+		n = len(self)
+		end = self.count % self.capacity + (self.capacity if self.count >= self.capacity else 0)
+		rows = self.data[end - n:end]
+		if window_s is None or n == 0:
+			return rows
+		if now is None:
+			now = rows[-1, self.columns['T']]
+		first = np.searchsorted(rows[:, self.columns['T']], now - window_s, side='left')
+		return rows[first:]
+
+
+	def column(self, name, window_s=None, now=None):
+		"""
+		View of one field over the last window_s seconds, oldest first.
+		"""
+		return self.window(window_s, now)[:, self.columns[name]]
+
+
+	def windowStats(self, name, window_s, now=None):
+		"""
+		Statistics of one field over the last window_s seconds, like LocalTibberQueryAsync.powerWindowStats():
+		dict with 'n', 'mean', 'min', 'max' and least-squares 'slope' [1/s]. Returns None if there are no values.
+		"""
+		rows = self.window(window_s, now)
+		T, x = rows[:, self.columns['T']], rows[:, self.columns[name]]
+		valid = ~np.isnan(x)
+		if not valid.any():
+			return None
+		T, x = T[valid], x[valid]
+
+		slope = 0.0
+		dT = T - T.mean()
+		var_T = np.dot(dT, dT)
+		if var_T > 0:
+			slope = float(np.dot(dT, x - x.mean()) / var_T)
+
+		return {'n': int(x.size), 'mean': float(x.mean()), 'min': float(x.min()), 'max': float(x.max()), 'slope': slope}
@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+#
+# Command queue in front of one inverter of an AhoyDTU.
+#
+# Every power limit or power state change goes over the DTU radio to the Hoymiles
+# inverter, takes seconds to apply, and ESP8266 based DTUs in particular choke on
+# bursts of commands. The queue therefore
+#
+#   - coalesces: while a command waits for its turn, a newer request replaces it,
+#     only the latest power limit and latest power state are ever sent
+#   - rate limits: commands are sent at most at commands_per_min, with short bursts
+#     of up to 'burst' commands (token bucket, one bucket per inverter)
+#   - skips writes of a limit that the inverter already has, according to the
+#     'power_limit_read' the DTU reports back (noteReadback()), or that was just sent,
+#     and repeats of a recently sent power state
+#   - confirms: after a limit was sent, DTU readings taken once the settling time
+#     has passed must report the new limit within confirm_timeout_s; otherwise the
+#     limit is sent once more
+#
+# Power state changes take precedence over a pending power limit. After each sent
+# command the queue waits settling_time_s for the inverter to apply it, unless a
+# lower limit is requested meanwhile (quick back-off, still rate limited). While
+# the queue is busy (isBusy()), the control logic decides only on such back-offs.
+#
+# The queue runs as a task, run(), of the control loop.
+#
+
+import asyncio
+
+from ControlScheduler import MonotonicClock, TokenBucket, waitEvent
+
+
+class DtuCommandQueue:
+
+	def __init__(self, dtu, clock=None, commands_per_min=6, burst=4, settling_time_s=5,
+			tolerance_W=5, confirm_timeout_s=30, on_sent=None):
+
+		self.dtu = dtu
+		self.clock = clock if clock is not None else MonotonicClock()
+		self.bucket = TokenBucket(commands_per_min / 60.0, burst, self.clock)
+		self.settling_time_s = settling_time_s
+		self.tolerance_W = tolerance_W
+		self.confirm_timeout_s = confirm_timeout_s
+		self.on_sent = on_sent  # optional callback(kind, value) after a command went out
+
+		self.pending_limit_W = None
+		self.pending_state = None
+		self.wakeup = asyncio.Event()
+
+		self.active_limit_W = None   # as last read back from the DTU
+		self.sent_limit_W = None     # last limit sent and not yet confirmed, or None
+		self.sent_T = None
+		self.resend_W = None         # limit sent once more after it was not confirmed
+		self.sent_state = None       # last power state sent, and when
+		self.sent_state_T = None
+		self.busy_until_T = 0.0
+
+		self.stats = {'requested': 0, 'coalesced': 0, 'skipped': 0, 'sent': 0, 'failed': 0, 'confirmed': 0, 'unconfirmed': 0}
+
+
+	def setPowerLimit(self, P_W):
+		"""
+		Request a new absolute power limit. Replaces a limit that is still waiting to be sent.
+		"""
+		self.stats['requested'] += 1
+		if self.pending_limit_W is not None:
+			self.stats['coalesced'] += 1
+		self.pending_limit_W = P_W
+		self.wakeup.set()
+
+
+	def setPowerState(self, powerEnabled=True):
+		"""
+		Request inverter power production on or off.
+		"""
+		self.stats['requested'] += 1
+		if self.pending_state is not None:
+			self.stats['coalesced'] += 1
+		self.pending_state = bool(powerEnabled)
+		self.wakeup.set()
+
+
+	def isBusy(self):
+		"""
+		True if a new command could not be sent right away: an earlier one is still waiting,
+		the inverter is settling, or the rate limit is reached. The control logic holds back
+		power limit decisions meanwhile, so that they are not based on outdated readings by
+		the time they are sent.
+		"""
+		if self.pending_state is not None or self.pending_limit_W is not None:
+			return True
+		return self.clock.now() < self.busy_until_T or self.bucket.delay() > 0
+
+
+	def expectedLimit(self):
+		"""
+		Limit the inverter has or will have once the last sent command is applied, None if unknown.
+		"""
+		if self.sent_limit_W is not None:
+			return self.sent_limit_W
+		return self.active_limit_W
+
+
+	def noteReadback(self, limit_W, T=None):
+		"""
+		Take note of the active power limit [W] reported by the DTU, see AhoyDtuRESTAsync.getActiveLimitWatt().
+		"""
+		if limit_W is None:
+			return
+		if T is None:
+			T = self.clock.now()
+		self.active_limit_W = limit_W
+
+		if self.sent_limit_W is None or T < self.sent_T + self.settling_time_s:
+			# nothing to confirm, or the DTU reading may predate the command
+			return
+
+		if abs(limit_W - self.sent_limit_W) < self.tolerance_W:
+			self.stats['confirmed'] += 1
+			self.sent_limit_W = None
+		elif T - self.sent_T > self.confirm_timeout_s:
+			self.stats['unconfirmed'] += 1
+			print('DTU reports a power limit of %d Watt instead of %d Watt' % (limit_W, self.sent_limit_W))
+			if self.pending_limit_W is None and self.sent_limit_W != self.resend_W:
+				self.pending_limit_W = self.resend_W = self.sent_limit_W
+				self.wakeup.set()
+			self.sent_limit_W = None
+
+
+	def _dropRedundantState(self):
+		"""
+		Drop the pending power state if the same was sent recently. Returns True if dropped.
+		The DTU does not report the power state, the inverter output is the readback.
+		"""
+		if self.pending_state is None or self.pending_state != self.sent_state:
+			return False
+		if self.clock.now() - self.sent_state_T > self.confirm_timeout_s:
+			return False
+		self.pending_state = None
+		self.stats['skipped'] += 1
+		return True
+
+
+	def _dropRedundantLimit(self):
+		"""
+		Drop the pending limit if the inverter already has it or is about to. Returns True if dropped.
+		"""
+		expected = self.expectedLimit()
+		if self.pending_limit_W is None or expected is None:
+			return False
+		if abs(self.pending_limit_W - expected) >= self.tolerance_W:
+			return False
+		self.pending_limit_W = None
+		self.stats['skipped'] += 1
+		return True
+
+
+	def _backingOff(self):
+		"""
+		True if the pending limit is lower than the limit the inverter has or is about to have.
+		"""
+		expected = self.expectedLimit()
+		if self.pending_limit_W is None or expected is None:
+			return False
+		return self.pending_limit_W <= expected - self.tolerance_W
+
+
+	async def _settle(self):
+		"""
+		Wait out the settling time of the command just sent, cut short by a request to back off.
+		"""
+		self.busy_until_T = self.clock.now() + self.settling_time_s
+		while self.clock.now() < self.busy_until_T:
+			self.wakeup.clear()
+			if self._backingOff():
+				return
+			await waitEvent(self.wakeup, self.busy_until_T - self.clock.now())
+
+
+	async def _send(self, kind, value):
+
+		if kind == 'power_state':
+			reply = await self.dtu.setPowerState(value)
+		else:
+			reply = await self.dtu.setPowerLimit(value)
+		print("  DTU reply ", str(reply))
+
+		if not reply:
+			self.stats['failed'] += 1
+			return
+		self.stats['sent'] += 1
+
+		if kind == 'power_state':
+			self.sent_state, self.sent_state_T = value, self.clock.now()
+		else:
+			if value != self.resend_W:
+				self.resend_W = None
+			self.sent_limit_W = value
+			self.sent_T = self.clock.now()
+		if self.on_sent is not None:
+			self.on_sent(kind, value)
+
+
+	async def run(self):
+		"""
+		Send the pending commands, one per token, each followed by the settling time.
+		"""
+		while True:
+			self._dropRedundantState()
+			self._dropRedundantLimit()
+			if self.pending_state is None and self.pending_limit_W is None:
+				self.wakeup.clear()
+				await self.wakeup.wait()
+				continue
+
+			# newer requests coalesce while waiting for a token, which is taken
+			# only once it is clear that a command is still wanted
+			await self.bucket.wait()
+
+			if not self._dropRedundantState() and self.pending_state is not None:
+				kind, value, self.pending_state = 'power_state', self.pending_state, None
+			elif not self._dropRedundantLimit() and self.pending_limit_W is not None:
+				kind, value, self.pending_limit_W = 'power_limit', self.pending_limit_W, None
+			else:
+				continue
+
+			self.bucket.take()
+			await self._send(kind, value)
+			await self._settle()
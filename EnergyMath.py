@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+#
+# Energy and cost arithmetic on NumPy arrays, for the report scripts.
+#
+# Times are Unix times [s]. Bins are given by their edges, e.g. localBinEdges() of
+# the local hours or quarter hours of a range of days: on the days of a DST change
+# those have 23 or 25 hours, since the edges are spaced in absolute time from local
+# midnight to local midnight. A range of several years is one array of edges.
+#
+# binValues()          - sums of values per bin
+# binEnergy()          - energy [Wh] per bin of power samples [W] that each average the
+#                        sample_s seconds from their time on, split into import and export
+#                        sample by sample. Missing samples (no sample, NaN) count as 0 Wh.
+# perDay()             - sums of bins per local day
+# priceWeighted()      - cost of the energy of each bin at hourly or quarter-hourly prices
+# autarky()            - share of the consumption that was self-generated [%]
+#
+
+import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+timezone = 'Europe/Berlin'
+
+
+def localMidnight(date, tz=timezone):
+	"""
+	Unix time of the local midnight at the start of a date.
+	"""
+	return datetime.datetime.combine(date, datetime.time(0), tzinfo=ZoneInfo(tz)).timestamp()
+
+
+def localBinEdges(first, last, bin_s=3600, tz=timezone):
+	"""
+	Edges of the bins of bin_s seconds of the local days first..last, and the index of the
+	day of each bin. The number of bins per day follows the length of the day.
+	"""
+	ndays = (last - first).days + 1
+	midnights = np.array([localMidnight(first + datetime.timedelta(days=n), tz) for n in range(ndays + 1)])
+	bins_per_day = np.round(np.diff(midnights) / bin_s).astype(int)
+	day_index = np.repeat(np.arange(ndays), bins_per_day)
+	first_bin = np.cumsum(bins_per_day) - bins_per_day
+	edges = np.empty(day_index.size + 1)
+	edges[:-1] = midnights[day_index] + bin_s * (np.arange(day_index.size) - first_bin[day_index])
+	edges[-1] = midnights[-1]
+	return edges, day_index
+
+
+def binValues(t, values, edges):
+	"""
+	Sums of the values at times t per bin. Values outside the edges and NaN are ignored.
+	"""
+	t, values = np.asarray(t, dtype=float), np.asarray(values, dtype=float)
+	nbins = len(edges) - 1
+	idx = np.searchsorted(edges, t, side='right') - 1
+	valid = (idx >= 0) & (idx < nbins) & ~np.isnan(values)
+	return np.bincount(idx[valid], weights=values[valid], minlength=nbins)
+
+
+def binEnergy(t, P_W, edges, sample_s):
+	"""
+	Energy per bin [Wh] of power samples P_W at times t: (total, import, export) arrays,
+	export positive. Samples outside the edges are ignored.
+	"""
+	E_Wh = np.asarray(P_W, dtype=float) * (sample_s / 3600.0)
+	total = binValues(t, E_Wh, edges)
+	imported = binValues(t, np.clip(E_Wh, 0.0, None), edges)
+	return total, imported, imported - total
+
+
+def perDay(values, day_index, ndays=None):
+	"""
+	Sums of the bin values per day, by the day index of localBinEdges().
+	"""
+	if ndays is None:
+		ndays = day_index[-1] + 1 if len(day_index) else 0
+	return np.bincount(day_index, weights=np.asarray(values, dtype=float), minlength=ndays)
+
+
+def priceWeighted(E_kWh, prices):
+	"""
+	Cost of the energy of each bin at the prices [EUR/kWh]. Hourly energy at quarter-hourly
+	prices uses the mean price of each hour, quarter-hourly energy at hourly prices the price
+	of its hour. Returns None if the lengths do not match.
+	"""
+	E_kWh, prices = np.asarray(E_kWh, dtype=float), np.asarray(prices, dtype=float)
+	if prices.size == 0 or E_kWh.size == 0:
+		return None
+	if prices.size > E_kWh.size and prices.size % E_kWh.size == 0:
+		prices = prices.reshape(E_kWh.size, -1).mean(axis=1)
+	elif E_kWh.size > prices.size and E_kWh.size % prices.size == 0:
+		prices = np.repeat(prices, E_kWh.size // prices.size)
+	if prices.size != E_kWh.size:
+		print("Error: energy of %d intervals at %d prices" % (E_kWh.size, prices.size))
+		return None
+	return E_kWh * prices
+
+
+def autarky(selfconsumed_kWh, imported_kWh):
+	"""
+	Self-generated share of the consumption [%], NaN where nothing was consumed.
+	"""
+	selfconsumed_kWh, imported_kWh = np.asarray(selfconsumed_kWh, dtype=float), np.asarray(imported_kWh, dtype=float)
+	consumed = selfconsumed_kWh + imported_kWh
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return np.where(consumed > 0, 100.0 * selfconsumed_kWh / consumed, np.nan)
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+#
+# Several Hoymiles inverters, on one or more AhoyDTUs, controlled as one.
+#
+# Each inverter has its own AhoyDtuRESTAsync and DtuCommandQueue, so also its
+# own command rate limit. Data of all inverters is read concurrently. A total
+# power limit is split across the inverters by PowerControlLogic.allocatePower(),
+# in order of priority: solar powered inverters before battery powered ones, and
+# otherwise in the order they were added. Power on/off commands, which protect
+# the battery, go to the battery powered inverters only (to all inverters if
+# none is battery powered).
+#
+# InverterGroup offers setPowerLimit(), setPowerState(), isBusy() and run() like
+# a single DtuCommandQueue.
+#
+# Readings are judged per inverter. A solar powered inverter that has no reading
+# newer than max_age_s, typically because it went offline at dusk, counts as
+# offline with 0 W and does not hold back the control of the other inverters.
+#
+
+from AhoyDtuRESTAsync import readInverters
+from ControlScheduler import runTasks
+from PowerControlLogic import allocatePower
+
+
+class InverterUnit:
+
+	def __init__(self, name, dtu, queue, max_power_W, min_power_W=5, battery=True, priority=None):
+		self.name = name
+		self.dtu = dtu
+		self.queue = queue
+		self.max_power_W = max_power_W
+		self.min_power_W = min_power_W
+		self.battery = battery
+		self.priority = priority if priority is not None else (1 if battery else 0)
+		self.enabled = True
+		self.offline = False
+
+		# latest readings, None if unknown, and when the DTU took them (monotonic time)
+		self.T = None
+		self.Pac = None
+		self.Vdc = None
+		self.limit_W = None
+
+
+class InverterGroup:
+
+	def __init__(self, granularity_W=5, max_age_s=60):
+		self.units = []
+		self.granularity_W = granularity_W
+		self.max_age_s = max_age_s
+		self.total_W = None     # latest total power limit
+
+
+	def add(self, unit):
+		self.units.append(unit)
+		self.units.sort(key=lambda u: u.priority)
+
+
+	def batteryUnits(self):
+		return [u for u in self.units if u.battery] or self.units
+
+
+	async def readInverterData(self, T, unixtime=None):
+		"""
+		Read the data of all inverters concurrently, at monotonic time T and Unix time 'unixtime'.
+		The acquisition time of each reading is T less the age of its DTU timestamp, or T if the
+		DTU timestamp lies in the future. Returns the number of inverters that replied.
+		Solar powered inverters without a recent reading are marked offline, with 0 W.
+		"""
+		replies = await readInverters([u.dtu for u in self.units])
+
+		nreplies = 0
+		for u, invdata in zip(self.units, replies):
+			u.Vdc, u.Pac = None, None
+			if not invdata:
+				print('No data from inverter %s' % (u.name))
+				continue
+			reading = u.dtu.parseReading(invdata)
+			Vdc = reading.get('U_DC', u.dtu.DC_INPUT_1)
+			Pac = reading.get('P_AC', u.dtu.AC_CHAN)
+			if Vdc is None or Pac is None:
+				continue
+			u.Vdc, u.Pac = Vdc, Pac
+			u.T = T
+			if unixtime is not None and reading.timestamp is not None and unixtime >= reading.timestamp:
+				# however old, e.g. the last data of an inverter that went offline
+				u.T = T - (unixtime - reading.timestamp)
+			u.limit_W = reading.getActiveLimitWatt()
+			u.queue.noteReadback(u.limit_W, u.T)
+			nreplies += 1
+
+		battery = self.batteryUnits()
+		for u in self.units:
+			u.offline = u not in battery and (u.Pac is None or T - u.T > self.max_age_s)
+			if u.offline:
+				u.Vdc, u.Pac = None, 0.0
+
+		return nreplies
+
+
+	def acquisitionTime(self):
+		"""
+		Acquisition time of the oldest reading of the inverters that are not offline, None if
+		one of them did not reply.
+		"""
+		online = [u for u in self.units if not u.offline]
+		if not online or any(u.Pac is None for u in online):
+			return None
+		return min(u.T for u in online)
+
+
+	def totals(self):
+		"""
+		Returns (AC output of all inverters, AC output of the battery powered ones, lowest DC voltage
+		of the battery powered ones). Inverters without a reading count with 0.
+		"""
+		Pac = sum(u.Pac for u in self.units if u.Pac is not None)
+		battery = self.batteryUnits()
+		battery_Pac = sum(u.Pac for u in battery if u.Pac is not None)
+		voltages = [u.Vdc for u in battery if u.Vdc is not None]
+		return (Pac, battery_Pac, min(voltages) if voltages else 0.0)
+
+
+	def setPowerLimit(self, P_W):
+		"""
+		Request a new total power limit, split across the inverters.
+		"""
+		self.total_W = P_W
+		units = [{'max_W': u.max_power_W, 'min_W': u.min_power_W, 'enabled': u.enabled, 'solar': not u.battery,
+			'Pac': u.Pac, 'limit_W': u.max_power_W if u.offline else u.limit_W} for u in self.units]
+		for u, limit_W in zip(self.units, allocatePower(P_W, units, self.granularity_W)):
+			if limit_W is not None:
+				u.queue.setPowerLimit(limit_W)
+
+
+	def setPowerState(self, powerEnabled=True):
+		"""
+		Request power production on or off for the battery powered inverters.
+		"""
+		for u in self.batteryUnits():
+			u.enabled = bool(powerEnabled)
+			u.queue.setPowerState(powerEnabled)
+
+
+	def isBusy(self):
+		return any(u.queue.isBusy() for u in self.units)
+
+
+	def stats(self):
+		"""
+		DTU command statistics, summed over all inverters.
+		"""
+		total = {}
+		for u in self.units:
+			for key, n in u.queue.stats.items():
+				total[key] = total.get(key, 0) + n
+		return total
+
+
+	async def run(self):
+		"""
+		Run the command queues of all inverters.
+		"""
+		await runTasks(*[u.queue.run() for u in self.units])
@@ -1,27 +1,113 @@
 #!/usr/bin/python3
+#
+# Queries of the latest JK-BMS and Steca readings that are stored in a local InfluxDB.
+#
+# getBatteryReadings() fetches all of them in one request, a single InfluxQL statement
+# with GROUP BY topic, and returns a BmsReadings with the time of each value.
+# Each query is given up after timeout_s (asyncio.TimeoutError).
+#
 
 import asyncio
+import json
+import time
 from aioinflux import InfluxDBClient
-from aioinflux import iterpoints
+
+
+# BmsReadings attribute -> InfluxDB 'topic' tag
+BMS_TOPICS = {'voltage': 'solar/data/Battery_Voltage', 'power': 'solar/data/Battery_Power',
+	'soc': 'solar/data/Percent_Remain', 'steca_load': 'solar/data/Steca_Load_W'}
+
+
+class BmsReadings:
+	"""
+	Latest values of the BMS_TOPICS, -1 where there was none in the query time range,
+	and the Unix time [s] of each value in 'timestamps', by attribute name.
+	"""
+	__slots__ = ('voltage', 'power', 'soc', 'steca_load', 'timestamps')
+
+	def __init__(self):
+		for name in BMS_TOPICS:
+			setattr(self, name, -1)
+		self.timestamps = {}
+
+
+	def age(self, name, now=None):
+		"""
+		Age [s] of a value, None if there is no value.
+		"""
+		if name not in self.timestamps:
+			return None
+		if now is None:
+			now = time.time()
+		return now - self.timestamps[name]
+
 
 class LocalInfluxdbQueryAsync:
 
-	def __init__(self, dbhost='localhost', dbport=8086, dbname='controllers'):
+	def __init__(self, dbhost='localhost', dbport=8086, dbname='controllers', recorder=None, timeout_s=5):
 		self.dbclient = InfluxDBClient(host=dbhost, port=dbport, username='', password='', db=dbname, mode='async')
+		self.recorder = recorder
+		self.timeout_s = timeout_s
 
 
-	def _getResultFloat(self, resultset):
-		pts = list(iterpoints(resultset, lambda *x, meta: dict(zip(meta['columns'], x))))
+	async def close(self):
+		await self.dbclient.close()
+
+
+	def _iterLast(self, resultset):
+		"""
+		Yield (topic tag or None, time, value) of the last row of each series of the first statement.
+		"""
 		try:
-			if len(pts) > 0:
-				r = pts[-1]
-			return float(r['last'])
-		except:
-			return -1
+			series = resultset['results'][0].get('series', [])
+		except (KeyError, IndexError, TypeError):
+			return
+		for s in series:
+			columns, rows = s.get('columns', []), s.get('values')
+			if not rows or 'last' not in columns:
+				continue
+			row = rows[-1]
+			T = row[columns.index('time')] if 'time' in columns else None
+			yield (s.get('tags', {}).get('topic'), T, row[columns.index('last')])
+
+
+	def _getResultFloat(self, resultset):
+		last = -1
+		for topic, T, value in self._iterLast(resultset):
+			if value is not None:
+				last = float(value)
+		return last
+
+
+	async def query(self, qry):
+		V = await asyncio.wait_for(self.dbclient.query(qry, epoch='ns'), self.timeout_s)
+		if self.recorder is not None:
+			self.recorder.record('INFLUX %s' % (qry), json.dumps(V))
+		return V
+
 
 	async def queryFloat(self, qry):
-		V = await self.dbclient.query(qry)
-		return self._getResultFloat(V)
+		return self._getResultFloat(await self.query(qry))
+
+
+	async def getBatteryReadings(self, max_age_s=300):
+		"""
+		Latest values of all BMS_TOPICS of the last max_age_s seconds, in one query. Returns a BmsReadings.
+		"""
+		topics = {topic: name for name, topic in BMS_TOPICS.items()}
+		where = ' OR '.join("topic::tag = '%s'" % (topic) for topic in topics)
+		qry = "SELECT last(value) FROM autogen.solar WHERE (%s) and time >= now() - %ds GROUP BY topic fill(null)" % (where, max_age_s)
+
+		readings = BmsReadings()
+		for topic, T, value in self._iterLast(await self.query(qry)):
+			if topic not in topics or value is None:
+				continue
+			name = topics[topic]
+			setattr(readings, name, float(value))
+			if isinstance(T, (int, float)):
+				readings.timestamps[name] = T / 1e9
+
+		return readings
 
 
 	async def getBatteryVoltage(self):
@@ -48,11 +134,15 @@ if __name__ == '__main__':
 
 	async def main():
 		db = LocalInfluxdbQueryAsync()
-		out = await asyncio.gather(*[db.getBatteryVoltage(), db.getBatteryPower(), db.getBatteryPercentage(), db.getStecaLoad()])
-		print('Battery Voltage: %.2f V' % (out[0]))
-		print('Battery Power:   %+.2f W, %s' % (out[1], 'charging' if out[1]>0 else 'discharging'))
-		print('Battery Charged: %.1f %%' % (out[2]))
-		print('Steca AC load:   %.1f VA' % (out[3]))
+		bms = await db.getBatteryReadings()
+		print('Battery Voltage: %.2f V' % (bms.voltage))
+		print('Battery Power:   %+.2f W, %s' % (bms.power, 'charging' if bms.power>0 else 'discharging'))
+		print('Battery Charged: %.1f %%' % (bms.soc))
+		print('Steca AC load:   %.1f VA' % (bms.steca_load))
+		for name in BMS_TOPICS:
+			if bms.age(name) is not None:
+				print('%-15s  %.0f s old' % (name, bms.age(name)))
+		await db.close()
 
 	asyncio.run(main())
 
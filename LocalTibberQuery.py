@@ -6,9 +6,11 @@
 # Does not use the remote API of Tibber, i.e., works even when the house
 # internet connection drops out (provided that wifi stays on).
 #
-# Code assumes SML is from a Landis+Gyr E220 meter.
-# For other meters, have to adjust two "offset = ..." below,
-# by trial and error, or by some reverse engineering with https://github.com/volkszaehler/libsml
+# SML frames are decoded by SmlParser.SmlMeterReadout, readings are looked up by
+# their OBIS code. The layout of the first decoded frame is cached, later frames are
+# read directly at the known offsets. Frames that can not be decoded or fail the CRC
+# check give no readings (None). Fixed byte offsets are used as a fallback only when
+# a known meter type is configured, e.g. meter_type='LandisGyrE220'.
 #
 # Tibber readout assumes the web interface has been enabled on the Tibber Bridge.
 # Steps to enable it are explained on other web sites,
@@ -38,14 +40,15 @@
 
 
 import requests
-import struct
 
-class LocalTibberQuery:
+from SmlParser import SmlMeterReadout
 
-	def __init__(self, hostname, bridge_passwd):
+class LocalTibberQuery(SmlMeterReadout):
+
+	def __init__(self, hostname, bridge_passwd, meter_type=None):
 		self.hostname = hostname
 		self.auth = requests.auth.HTTPBasicAuth('admin', bridge_passwd)
-		self.smlframe = None
+		SmlMeterReadout.__init__(self, meter_type)
 
 	def getMeterSMLFrame(self):
 		url = 'http://%s/data.json?node_id=1' % (self.hostname)
@@ -66,43 +69,3 @@ class LocalTibberQuery:
 		self.smlframe = r.content
 
 		return r.content
-
-
-	def extractPowerReading(self, smlframe=None):
-		"""
-		Extract net active power reading from SML frame.
-		The reading is a 32-bit Signed Int.
-
-		One could in principle properly decode the entire SML frame using
-		some library/package. However, it seems energy meters (or at least
-		the Landis+Gyr E220) use a fixed SML frame format, no varying fields.
-
-		Hence it suffices to "decode" just the 32-bit (4 byte) portion
-		of the SML binary data that contains the power reading. The location
-		likely depends on the meter model.
-		"""
-
-		offset = 12*16 + 4 + 8  # works for one type of Landis Gyr E220
-
-		if not smlframe:
-			smlframe = self.smlframe
-
-		if smlframe and len(smlframe) >= (offset + 4):
-			P_Watts = struct.unpack(">l", smlframe[offset:(offset+4)])[0]
-			return P_Watts
-		else:
-			return 0
-
-
-	def extractEnergyReading(self, smlframe=None):
-
-		offset = 10*16 + 8 + 8  # works for one type of Landis Gyr E220
-
-		if not smlframe:
-			smlframe = self.smlframe
-
-		if smlframe and len(smlframe) >= (offset + 8):
-			E_Wh = float( struct.unpack(">Q", smlframe[offset:(offset+8)])[0] ) / 10
-			return E_Wh
-		else:
-			return 0
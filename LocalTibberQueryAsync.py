@@ -6,9 +6,11 @@
 # Does not use the remote API of Tibber, i.e., works even when the house
 # internet connection drops out (provided that wifi stays on).
 #
-# Code assumes SML is from a Landis+Gyr E220 meter.
-# For other meters, have to adjust two "offset = ..." below,
-# by trial and error, or by some reverse engineering with https://github.com/volkszaehler/libsml
+# SML frames are decoded by SmlParser.SmlMeterReadout, readings are looked up by
+# their OBIS code. The layout of the first decoded frame is cached, later frames are
+# read directly at the known offsets. Frames that can not be decoded or fail the CRC
+# check give no readings (None). Fixed byte offsets are used as a fallback only when
+# a known meter type is configured, e.g. meter_type='LandisGyrE220'.
 #
 # Tibber readout assumes the web interface has been enabled on the Tibber Bridge.
 # Steps to enable it are explained on other web sites.
@@ -36,76 +38,109 @@
 # as read directly from the grid energy meter. The Bridge does not decode
 # the content of the SML frame.
 #
+# The Pulse delivers a new SML frame about once per second. streamFrames() is a
+# producer task that keeps fetching frames and stores the decoded readings with
+# their monotonic timestamps in a small ring buffer. Consumers use getLatest(),
+# waitForFrame() and getWindowStats() (mean/min/max/slope over the last seconds).
+# Requests go through the caller's AsyncHttpPool, which the caller also closes.
+#
 
 
 import aiohttp
-import struct
+import asyncio
+import collections
+
+from SmlParser import SmlMeterReadout
+
+from ControlScheduler import MonotonicClock, DeadlineTicker, waitEvent
+
+def powerWindowStats(history, window_s, now):
+	"""
+	Statistics of the (T, P, E) readings of the last window_s seconds: dict with
+	'n', 'mean', 'min', 'max' [W] and least-squares 'slope' [W/s].
+	Returns None if the window holds no readings.
+	"""
+	pts = [(T, P) for (T, P, E) in reversed(history) if now - T <= window_s]
+	n = len(pts)
+	if n == 0:
+		return None
 
-class LocalTibberQueryAsync:
+	Ps = [P for (T, P) in pts]
+	mean_T = sum(T for (T, P) in pts) / n
+	mean_P = sum(Ps) / n
+	var_T = sum((T - mean_T)**2 for (T, P) in pts)
+	slope = 0.0
+	if var_T > 0:
+		slope = sum((T - mean_T)*(P - mean_P) for (T, P) in pts) / var_T
 
-	def __init__(self, hostname, bridge_passwd):
-		self.hostname = hostname
-		self.auth = aiohttp.BasicAuth('admin', bridge_passwd)
-		self.smlframe = None
+	return {'n': n, 'mean': mean_P, 'min': min(Ps), 'max': max(Ps), 'slope': slope}
 
-	async def getMeterSMLFrame(self):
-		url = 'http://%s/data.json?node_id=1' % (self.hostname)
 
-		try:
-			nokeepalive = aiohttp.TCPConnector(force_close=True)
-			async with aiohttp.ClientSession(connector=nokeepalive, timeout=aiohttp.ClientTimeout(total=5)) as client:
-				async with client.get(url, auth=self.auth) as resp:
-					if resp.status != 200:
-						print ('HTTP Error %d while querying %s' % (resp.status, url))
-						return None
-					self.smlframe = await resp.read()
-					return self.smlframe
-		except aiohttp.ServerDisconnectedError:
-			print('Unexpected getMeterSMLFrame(%s) outcome - server disconnected' % (url))
-			return None
-		except Exception as e:
-			print('Unexpected getMeterSMLFrame(%s) outcome - exception: %s' % (url, str(e)))
-			return None
-
-		print ('LocalTibberQueryAsync: Unexpected HTTP connect error')
+class LocalTibberQueryAsync(SmlMeterReadout):
 
-		return None
+	def __init__(self, hostname, bridge_passwd, pool, history_len=120, clock=None, meter_type=None):
+		self.hostname = hostname
+		self.auth = aiohttp.BasicAuth('admin', bridge_passwd)
+		self.pool = pool
+		self.clock = clock if clock is not None else MonotonicClock()
+		SmlMeterReadout.__init__(self, meter_type)
 
-	def extractPowerReading(self, smlframe=None):
-		"""
-		Extract net active power reading from SML frame.
-		The reading is a 32-bit Signed Int.
+		self.history = collections.deque(maxlen=history_len)  # entries (T, P_Watts, E_Wh)
+		self.new_frame = asyncio.Event()
 
-		One could in principle properly decode the entire SML frame using
-		some library/package. However, it seems energy meters (or at least
-		the Landis+Gyr E220) use a fixed SML frame format, no varying fields.
 
-		Hence it suffices to "decode" just the 32-bit (4 byte) portion
-		of the SML binary data that contains the power reading. The location
-		likely depends on the meter model.
+	async def streamFrames(self, interval_s=1.0):
 		"""
+		Producer loop: fetch and decode one SML frame per interval, forever.
+		"""
+		ticker = DeadlineTicker(interval_s, self.clock)
+		while True:
+			await ticker.wait()
+			smlframe = await self.getMeterSMLFrame()
+			if not smlframe:
+				continue
+			P_Watts, E_Wh = self.extractPowerReading(smlframe), self.extractEnergyReading(smlframe)
+			if P_Watts is None or E_Wh is None:
+				# undecodable or corrupted frame, skip it
+				continue
+			self.history.append((self.clock.now(), P_Watts, E_Wh))
+			self.new_frame.set()
+
+
+	async def waitForFrame(self, timeout_s=None):
+		"""
+		Wait until streamFrames() delivered a new frame, return getLatest(), or None on timeout.
+		"""
+		if not await waitEvent(self.new_frame, timeout_s):
+			return None
+		self.new_frame.clear()
+		return self.getLatest()
 
-		offset = 12*16 + 4 + 8  # works for one type of Landis Gyr E220
 
-		if not smlframe:
-			smlframe = self.smlframe
+	def getLatest(self):
+		"""
+		Return the newest (T, P_Watts, E_Wh) reading, or None if nothing was received yet.
+		"""
+		if not self.history:
+			return None
+		return self.history[-1]
 
-		if smlframe and len(smlframe) >= (offset + 4):
-			P_Watts = struct.unpack(">l", smlframe[offset:(offset+4)])[0]
-			return P_Watts
-		else:
-			return 0
 
+	def getWindowStats(self, window_s=10.0, now=None):
+		"""
+		Statistics of the power readings of the last window_s seconds, see powerWindowStats().
+		"""
+		if now is None:
+			now = self.clock.now()
+		return powerWindowStats(self.history, window_s, now)
 
-	def extractEnergyReading(self, smlframe=None):
 
-		offset = 10*16 + 8 + 8  # works for one type of Landis Gyr E220
+	async def getMeterSMLFrame(self):
+		url = 'http://%s/data.json?node_id=1' % (self.hostname)
 
-		if not smlframe:
-			smlframe = self.smlframe
+		smlframe = await self.pool.getBytes(url, auth=self.auth, timeout_s=5)
+		if smlframe is None:
+			return None
 
-		if smlframe and len(smlframe) >= (offset + 8):
-			E_Wh = float( struct.unpack(">Q", smlframe[offset:(offset+8)])[0] ) / 10
-			return E_Wh
-		else:
-			return 0
+		self.smlframe = smlframe
+		return self.smlframe
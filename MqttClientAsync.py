@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+#
+# Minimal asyncio MQTT 3.1.1 client for publishing control commands and
+# telemetry to a broker (e.g. Mosquitto), without spawning mosquitto_pub,
+# and for subscribing to topics such as the BMS readings.
+#
+# One persistent broker connection is kept open. Messages are published
+# through a bounded outbound queue; when the queue is full the oldest message
+# is dropped. QoS 0 and QoS 1 are supported, QoS 1 messages stay in flight
+# until acknowledged and are re-sent after a reconnect. Lost connections are
+# re-established with exponential backoff.
+#
+# Subscriptions are (re-)sent on every connection. Incoming messages are handed
+# to the callback(topic, payload) of each matching subscription, topic filters
+# may contain the wildcards '+' and '#'. QoS 1 messages are acknowledged.
+#
+# Usage:
+#   mqtt = MqttClientAsync('192.168.0.74')
+#   await mqtt.start()
+#   mqtt.publish('solar/control/inverter_enable', 'false', qos=1)
+#   mqtt.subscribe('solar/data/+', lambda topic, payload: print(topic, payload))
+#   ...
+#   await mqtt.stop()
+#
+
+import asyncio
+import struct
+import os
+
+from ControlScheduler import waitEvent
+
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+SUBSCRIBE = 0x80
+SUBACK = 0x90
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+def _encodeLength(n):
+	"""
+	Encode the MQTT 'remaining length' variable-length integer.
+	"""
+	out = bytearray()
+	while True:
+		b = n % 128
+		n = n // 128
+		if n > 0:
+			b |= 0x80
+		out.append(b)
+		if n == 0:
+			return bytes(out)
+
+
+def _encodeString(s):
+	if isinstance(s, str):
+		s = s.encode('utf-8')
+	return struct.pack('>H', len(s)) + s
+
+
+def _packet(ptype, body=b''):
+	return bytes([ptype]) + _encodeLength(len(body)) + body
+
+
+async def _readPacket(reader):
+	"""
+	Read one MQTT control packet, return (header byte, body bytes).
+	"""
+	hdr = (await reader.readexactly(1))[0]
+	length, shift = 0, 0
+	while True:
+		b = (await reader.readexactly(1))[0]
+		length |= (b & 0x7F) << shift
+		shift += 7
+		if not (b & 0x80):
+			break
+	body = await reader.readexactly(length) if length > 0 else b''
+	return hdr, body
+
+
+def topicMatches(topic_filter, topic):
+	"""
+	True if the topic matches the subscription filter, which may contain '+' and '#' wildcards.
+	"""
+	filter_levels = topic_filter.split('/')
+	levels = topic.split('/')
+	for n, f in enumerate(filter_levels):
+		if f == '#':
+			return True
+		if n >= len(levels) or (f != '+' and f != levels[n]):
+			return False
+	return len(levels) == len(filter_levels)
+
+
+class MqttMessage:
+
+	__slots__ = ('topic', 'payload', 'qos', 'retain', 'packet_id')
+
+	def __init__(self, topic, payload, qos=0, retain=False):
+		self.topic = topic
+		self.payload = payload if isinstance(payload, bytes) else str(payload).encode('utf-8')
+		self.qos = 1 if qos else 0
+		self.retain = bool(retain)
+		self.packet_id = 0
+
+	def encode(self, dup=False):
+		flags = (self.qos << 1) | (0x08 if dup else 0) | (0x01 if self.retain else 0)
+		body = _encodeString(self.topic)
+		if self.qos > 0:
+			body += struct.pack('>H', self.packet_id)
+		return _packet(PUBLISH | flags, body + self.payload)
+
+
+class MqttClientAsync:
+
+	def __init__(self, host, port=1883, client_id=None, keepalive_s=30, queue_size=100, backoff_min_s=1.0, backoff_max_s=60.0, ack_timeout_s=5.0):
+		self.host = host
+		self.port = int(port)
+		self.client_id = client_id if client_id else 'zeroexport-%s' % (os.urandom(4).hex())
+		self.keepalive_s = int(keepalive_s)
+		self.backoff_min_s = float(backoff_min_s)
+		self.backoff_max_s = float(backoff_max_s)
+		self.ack_timeout_s = float(ack_timeout_s)
+
+		self.queue = asyncio.Queue(maxsize=queue_size)
+		self.inflight = None
+		self.acked = asyncio.Event()
+		self.next_packet_id = 1
+		self.connected = asyncio.Event()
+		self.writer = None
+		self.task = None
+		self.num_dropped = 0
+		self.subscriptions = {}   # topic filter -> (qos, [callbacks])
+		self.num_received = 0
+
+
+	def publish(self, topic, payload, qos=0, retain=False):
+		"""
+		Queue a message for publishing. Never blocks; if the outbound queue
+		is full the oldest queued message is discarded to make room.
+		"""
+		msg = MqttMessage(topic, payload, qos, retain)
+		if self.queue.full():
+			self.queue.get_nowait()
+			self.num_dropped += 1
+		self.queue.put_nowait(msg)
+
+
+	def subscribe(self, topic_filter, callback, qos=0):
+		"""
+		Call callback(topic, payload bytes) for each incoming message on topics matching the filter.
+		"""
+		qos_old, callbacks = self.subscriptions.get(topic_filter, (0, []))
+		callbacks.append(callback)
+		self.subscriptions[topic_filter] = (max(qos_old, 1 if qos else 0), callbacks)
+		if self.connected.is_set() and self.writer is not None:
+			self._sendSubscribe(self.writer, [topic_filter])
+
+
+	def _sendSubscribe(self, writer, topic_filters):
+
+		body = struct.pack('>H', self.next_packet_id)
+		self.next_packet_id = (self.next_packet_id % 65535) + 1
+		for topic_filter in topic_filters:
+			body += _encodeString(topic_filter) + bytes([self.subscriptions[topic_filter][0]])
+		writer.write(_packet(SUBSCRIBE | 0x02, body))
+
+
+	async def start(self):
+		if self.task is None:
+			self.task = asyncio.create_task(self._run())
+
+
+	async def stop(self, drain_timeout_s=2.0):
+		"""
+		Try to flush the outbound queue, then disconnect from the broker.
+		"""
+		if self.task is None:
+			return
+
+		if self.connected.is_set():
+			try:
+				await asyncio.wait_for(self._drained(), drain_timeout_s)
+			except asyncio.TimeoutError:
+				pass
+
+		self.task.cancel()
+		try:
+			await self.task
+		except asyncio.CancelledError:
+			pass
+		self.task = None
+
+
+	async def _drained(self):
+		while not self.queue.empty() or self.inflight is not None:
+			await asyncio.sleep(0.05)
+
+
+	async def _run(self):
+		"""
+		Connection supervisor: (re)connect with exponential backoff.
+		"""
+		backoff = self.backoff_min_s
+		while True:
+			try:
+				await self._session()
+				backoff = self.backoff_min_s
+			except asyncio.CancelledError:
+				raise
+			except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError) as e:
+				print('MQTT connection to %s:%d lost: %s' % (self.host, self.port, str(e)))
+			except Exception as e:
+				print('MQTT unexpected error: %s' % (str(e)))
+			await asyncio.sleep(backoff)
+			backoff = min(2*backoff, self.backoff_max_s)
+
+
+	async def _session(self):
+		"""
+		One broker connection; returns or raises when the connection ends.
+		"""
+		reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.ack_timeout_s)
+		self.writer = writer
+		try:
+			body = _encodeString('MQTT') + bytes([4, 0x02]) + struct.pack('>H', self.keepalive_s) + _encodeString(self.client_id)
+			writer.write(_packet(CONNECT, body))
+			await writer.drain()
+
+			hdr, body = await asyncio.wait_for(_readPacket(reader), self.ack_timeout_s)
+			if (hdr & 0xF0) != CONNACK or len(body) < 2 or body[1] != 0:
+				raise ConnectionError('broker refused connection, CONNACK %s' % (body.hex()))
+
+			if self.subscriptions:
+				self._sendSubscribe(writer, list(self.subscriptions))
+				await writer.drain()
+
+			self.connected.set()
+			tasks = [asyncio.create_task(self._sender(writer)),
+				asyncio.create_task(self._receiver(reader)),
+				asyncio.create_task(self._pinger(writer))]
+			try:
+				done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+				for t in done:
+					t.result()
+			finally:
+				for t in tasks:
+					t.cancel()
+				await asyncio.gather(*tasks, return_exceptions=True)
+		finally:
+			self.connected.clear()
+			self.writer = None
+			if not writer.is_closing():
+				try:
+					writer.write(_packet(DISCONNECT))
+				except Exception:
+					pass
+				writer.close()
+
+
+	async def _sender(self, writer):
+
+		# Re-send an unacknowledged QoS 1 message left over from the previous connection
+		if self.inflight is not None:
+			await self._sendAndConfirm(writer, self.inflight, dup=True)
+
+		while True:
+			msg = await self.queue.get()
+			if msg.qos > 0:
+				msg.packet_id = self.next_packet_id
+				self.next_packet_id = (self.next_packet_id % 65535) + 1
+				self.inflight = msg
+				await self._sendAndConfirm(writer, msg)
+			else:
+				writer.write(msg.encode())
+				await writer.drain()
+
+
+	async def _sendAndConfirm(self, writer, msg, dup=False):
+
+		self.acked.clear()
+		writer.write(msg.encode(dup))
+		await writer.drain()
+		if not await waitEvent(self.acked, self.ack_timeout_s):
+			raise asyncio.TimeoutError('no PUBACK for packet %d' % (msg.packet_id))
+		self.inflight = None
+
+
+	async def _receiver(self, reader):
+
+		while True:
+			hdr, body = await _readPacket(reader)
+			ptype = hdr & 0xF0
+			if ptype == PUBACK and self.inflight is not None:
+				if struct.unpack('>H', body[:2])[0] == self.inflight.packet_id:
+					self.acked.set()
+			elif ptype == PUBLISH:
+				self._onPublish(hdr, body)
+			elif ptype == SUBACK and b'\x80' in body[2:]:
+				print('MQTT broker %s:%d refused a subscription' % (self.host, self.port))
+
+
+	def _onPublish(self, hdr, body):
+		"""
+		Acknowledge an incoming message if QoS 1, and hand it to the matching subscriptions.
+		"""
+		qos = (hdr >> 1) & 0x03
+		tlen = struct.unpack('>H', body[:2])[0]
+		topic = body[2:2+tlen].decode('utf-8')
+		pos = 2 + tlen
+		if qos > 0:
+			if self.writer is not None:
+				self.writer.write(_packet(PUBACK, body[pos:pos+2]))
+			pos += 2
+
+		self.num_received += 1
+		payload = body[pos:]
+		for topic_filter, (sub_qos, callbacks) in self.subscriptions.items():
+			if topicMatches(topic_filter, topic):
+				for callback in callbacks:
+					callback(topic, payload)
+
+
+	async def _pinger(self, writer):
+
+		while True:
+			await asyncio.sleep(max(1, self.keepalive_s / 2))
+			writer.write(_packet(PINGREQ))
+			await writer.drain()
+
+
+if __name__ == '__main__':
+
+	import sys
+
+	async def main():
+		mqtt = MqttClientAsync(sys.argv[1] if len(sys.argv) > 1 else 'localhost')
+		await mqtt.start()
+		mqtt.publish('test/mqttclientasync', 'hello', qos=1)
+		await mqtt.stop()
+
+	asyncio.run(main())
@@ -0,0 +1,509 @@
+#!/usr/bin/python3
+#
+# Decision logic of the zero export control loop, without any device I/O.
+#
+# PowerControlLogic.decide() receives one sample of the latest device readings
+# and returns the commands to send. Commands are tuples (kind, value):
+#
+#   ('power_state', True|False)  - turn Hoymiles power production on or off
+#   ('power_limit', Watt)        - new non-persistent Hoymiles AC power limit
+#   ('steca_enable', True|False) - enable or disable the Steca Solarix AC inverter
+#
+# A sample is a dict with the keys
+#
+#   T            - monotonic time of the sample [s]
+#   hour         - local hour of day, for day/night power limits
+#   dtu_T        - monotonic time at which the DTU took the last successful reading [s]
+#   dtu_ok       - optional, False if the last DTU poll did not get readings of all inverters
+#   dtu_Vdc      - Hoymiles DC input voltage [V], 0 if unknown
+#   dtu_Pac      - Hoymiles AC output power [W], 0 if unknown; the sum of all inverters
+#   dtu_battery_Pac - optional, AC output of the battery powered inverters [W] if
+#                  there are also solar powered ones, for the undervoltage shutdown
+#   meter_T      - monotonic time of the last successful grid meter reading [s]
+#   meter_P      - grid power [W], P>0 import, P<0 export
+#   meter_E      - grid energy counter [Wh]
+#   bmsVolt      - BMS battery voltage [V]
+#   bmsPower     - BMS battery power [W], P<0 discharging
+#   bmsSOC       - BMS state of charge [%]
+#   bms_T        - optional, monotonic time at which the BMS values were taken [s]
+#   bms_ok       - optional, False if the BMS values are missing (then -1)
+#   battery_V, battery_W, battery_SOC, battery_ok - optional, the battery state estimate
+#                  of BatteryEstimator; used instead of the BMS values while battery_ok
+#   stecaCharge  - True if the Steca Solarix charges the battery from AC In
+#   meter_slope  - optional, trend of the grid power over the last seconds [W/s]
+#   dtu_busy     - optional, True while the DTU command queue could not send a new command right away;
+#                  only a lower limit to back off is decided meanwhile
+#
+# When DTU commands are queued rather than sent right away, the actuator reports
+# the actual send time with noteCommandSent(), settling is counted from then on.
+#
+# The control law that turns grid and inverter power into a new power limit is
+# a pluggable engine (CONTROL_ENGINES): 'proportional' (the original rule, default),
+# 'pi' (PI with anti-windup, experimental) or 'predictive' (dead time model with
+# meter trend).
+# PowerControlLogic itself handles battery protection, settling, quantization,
+# limits and hysteresis for all of them.
+#
+# With several inverters, the logic decides on their total power limit, and
+# allocatePower() splits it across the inverters by priority.
+#
+# Only valid and recent data is acted on: DTU readings older than max_dtu_age_s and
+# BMS values older than max_bms_age_s are not used.
+#
+import math
+
+
+def isBatteryLow(SoC_pct, voltage_V, battery_W, verbose=True):
+	"""
+	Check combination of battery voltage, BMS-reported SoC%, and power draw,
+	to return a best guess whether the 16S LFP battery is close to empty (80% DoD).
+	The SoC chaged% reading is not always reliable.
+	"""
+	drained = False
+
+	# BMS-reported load: P<0 means discharging, P>0 means charging.
+	# Flip the sign
+	if battery_W >= 0:
+		load_W = 0
+	else:
+		load_W = -battery_W
+
+	# Medium to no load, and voltage indicates below 20% SoC
+	if voltage_V <= 51.2 and load_W <= 400.0:
+		drained = True
+
+	# Voltage looks critical regardless of load
+	if voltage_V <= 49.5:
+		drained = True
+
+	# Load is high and hence internal voltage drop is high,
+	# fall back to trusting SoC% rather than voltage?
+	if (load_W > 400.0 and SoC_pct < 20.0) and voltage_V <= 50.0:
+		drained = True
+
+	if verbose:
+		print ("DBG: isBatteryLow(%.2f%%, %.2fV, load=%.2fW) verdict: %s" % (SoC_pct, voltage_V, load_W, drained))
+
+	return drained
+
+
+class PowerControlLogic:
+
+	def __init__(self, day_max_power_W=310, night_max_power_W=310, min_power_W=5, power_granularity_W=5,
+			settling_time_s=5, max_meter_age_s=3, lfp_recovery_voltage=51.5, lfp_min_SOC_percent=20.0, day_hours=(8, 18), engine=None,
+			max_dtu_age_s=60, max_bms_age_s=120):
+
+		self.day_max_power_W = day_max_power_W
+		self.night_max_power_W = night_max_power_W
+		self.min_power_W = min_power_W
+		self.power_granularity_W = power_granularity_W
+		self.settling_time_s = settling_time_s
+		self.max_meter_age_s = max_meter_age_s
+		self.max_dtu_age_s = max_dtu_age_s
+		self.max_bms_age_s = max_bms_age_s
+		self.lfp_recovery_voltage = lfp_recovery_voltage
+		self.lfp_min_SOC_percent = lfp_min_SOC_percent
+		self.day_hours = day_hours
+		self.engine = engine if engine is not None else ProportionalEngine()
+
+		self.hitUndervoltage = False
+		self.drained = None
+		self.prev_adjust_T = None
+		self.prev_limit_W = None
+		self.settling_from_W = 0
+		self.backed_off = False
+		self.verdict = {}
+
+
+	def getMaxPower(self, hour):
+
+		if hour >= self.day_hours[0] and hour <= self.day_hours[1]:
+			return self.day_max_power_W
+		return self.night_max_power_W
+
+
+	def batteryState(self, s):
+		"""
+		Battery (SoC %, voltage V, power W) from the battery state estimate or else from recent
+		BMS values, or None if neither is valid.
+		"""
+		if s.get('battery_ok'):
+			return (s['battery_SOC'], s['battery_V'], s['battery_W'])
+		if s.get('bms_ok', True) and s['bmsVolt'] > 0 and s['T'] - s.get('bms_T', s['T']) <= self.max_bms_age_s:
+			return (s['bmsSOC'], s['bmsVolt'], s['bmsPower'])
+		return None
+
+
+	def decide(self, s):
+		"""
+		Judge one sample and return the list of commands to carry out.
+		Details of the judgement are left in self.verdict for logging and telemetry.
+		"""
+		T = s['T']
+		dtu_Vdc, dtu_Pac = s['dtu_Vdc'], s['dtu_Pac']
+		battery_Pac = s.get('dtu_battery_Pac', dtu_Pac)
+		bmsVolt, bmsPower, bmsSOC = s['bmsVolt'], s['bmsPower'], s['bmsSOC']
+		dynamic_max_power_W = self.getMaxPower(s['hour'])
+
+		self.verdict = {'grid_power_W': s['meter_P'], 'inverter_power_W': dtu_Pac, 'steca_ac_charging': s['stecaCharge']}
+
+		# Stop microinverter if Steca Solarix hybrid inverter AC-IN was
+		# switched on (outside of this script) to charge battery esp.
+		# at night during a minimal electricity cost hour (Tibber); no point
+		# in microinverter feeding house via Solarix-internal battery charger...
+		if s['stecaCharge']:
+			print("Command power    : OFF due to Steca Solarix hybrid inverter charging battery from AC In")
+			return [('power_state', False)]
+
+		cmds = []
+		dtu_valid = s.get('dtu_ok', True) and T - s['dtu_T'] <= self.max_dtu_age_s
+		battery = self.batteryState(s)
+		if battery is not None:
+			bmsSOC, bmsVolt, bmsPower = battery
+			self.verdict['battery_SOC'] = round(bmsSOC, 1)
+
+		# Check battery undervoltage & low charge remaining, and recovery from it
+		# First judge based on Hoymiles -reported DC input voltage
+		drained = False
+		if dtu_valid and dtu_Vdc > 0:
+			drained = isBatteryLow(bmsSOC, dtu_Vdc, bmsPower, verbose=False)
+			if self.hitUndervoltage and not drained and dtu_Vdc >= self.lfp_recovery_voltage:
+				self.hitUndervoltage = False
+			elif drained:
+				self.hitUndervoltage = True
+
+		# Secondly judge from the battery state estimate or BMS -reported battery voltage
+		if battery is not None:
+			drained = isBatteryLow(bmsSOC, bmsVolt, bmsPower, verbose=False)
+			if self.hitUndervoltage and not drained and bmsVolt >= self.lfp_recovery_voltage:
+				self.hitUndervoltage = False
+			elif drained:
+				self.hitUndervoltage = True
+		else:
+			print('No recent battery readings, judging the battery by the DTU only')
+
+		self.verdict['battery_drained'] = drained
+		self.verdict['undervoltage'] = self.hitUndervoltage
+
+		# Aux: safe-off a separate Steca Solarix PLI hybrid inverter, once per drained period
+		if drained != self.drained:
+			print("DBG: isBatteryLow(%.2f%%, %.2fV, %.2fW) verdict: %s" % (bmsSOC, bmsVolt if battery is not None else dtu_Vdc, bmsPower, drained))
+			if drained:
+				print("Command Steca AC : safety OFF due low battery SOC %%")
+				cmds.append(('steca_enable', False))
+			self.drained = drained
+
+		if not dtu_valid:
+			print('No recent inverter data, skipping adjustments')
+			return cmds
+
+		# During undervoltage, shut down the u-inverter power production,
+		# turn back on only after undervoltage condition has cleared
+		if self.hitUndervoltage and battery_Pac > 0:
+			print("Command power    : OFF due low battery, wait till %.2f V and %.0f %% charge" % (self.lfp_recovery_voltage, self.lfp_min_SOC_percent))
+			cmds.append(('power_state', False))
+			return cmds
+		elif (not self.hitUndervoltage) and battery_Pac <= 0:
+			print("Command power    : ON due to recovery from earlier DC undervoltage or AC-Charge Priority")
+			cmds.append(('power_state', True))
+			return cmds
+
+		# When the grid reading is fresh, adjust inverter output power to get near zero energy export.
+		if T - s['meter_T'] > self.max_meter_age_s:
+			print('Not enough recent data in this interval, skipping adjustments')
+			return cmds
+
+		gran = self.power_granularity_W
+		busy = s.get('dtu_busy')
+		inverter_P = self.estimateInverterPower(s)
+		if inverter_P is None or busy:
+			# Slowly assist, quickly back off: while settling or while the DTU command queue is busy,
+			# a lower limit is sent if the grid power calls for one even at the highest output the
+			# inverter may have now, i.e. still the output from before the change. Export the change
+			# already removes is not counted twice. Once per change, the settled readings decide the rest.
+			if self.prev_limit_W is None:
+				print('Waiting for the DTU command queue')
+				return cmds
+			highest_P = max(self.prev_limit_W, s['dtu_Pac'], self.settling_from_W)
+			new_P = self.quantize(highest_P + s['meter_P'] + gran, dynamic_max_power_W)
+			if new_P < self.prev_limit_W - 2*gran and not self.backed_off and not self.hitUndervoltage:
+				print("Command power    : %d Watt, backing off while settling" % (new_P))
+				self.command(cmds, T, new_P)
+				self.settling_from_W = highest_P
+				self.backed_off = True
+				self.engine.backedOff(self, T, new_P)
+			elif inverter_P is None:
+				print('Waiting for inverter to settle at %d Watt' % (self.prev_limit_W))
+			else:
+				print('Waiting for the DTU command queue')
+			return cmds
+		self.backed_off = False
+
+		new_P = self.quantize(self.engine.computeLimit(self, s, inverter_P, dynamic_max_power_W), dynamic_max_power_W)
+		self.verdict['engine_target_W'] = new_P
+		pdiff = new_P - self.engine.referencePower(self, inverter_P)
+
+		if abs(pdiff) > 2*gran and self.engine.shouldCommand(self, T):
+			if self.hitUndervoltage:
+				print("Command power    : stay OFF due to DC undervoltage")
+			else:
+				print("Command power    : %d Watt" % (new_P))
+				self.command(cmds, T, new_P)
+				self.settling_from_W = inverter_P
+
+		return cmds
+
+
+	def quantize(self, P_W, max_P):
+		"""
+		Power limit rounded down to the granularity, within the min and max power.
+		"""
+		gran = self.power_granularity_W
+		return max(min((P_W // gran) * gran, max_P), self.min_power_W)
+
+
+	def command(self, cmds, T, P_W):
+
+		cmds.append(('power_limit', P_W))
+		self.verdict['commanded_limit_W'] = P_W
+		self.prev_adjust_T = T
+		self.prev_limit_W = P_W
+		self.engine.commanded(self, T, P_W)
+
+
+	def noteCommandSent(self, T, P_W):
+		"""
+		A power limit decided earlier was sent to the DTU only at time T.
+		"""
+		self.prev_adjust_T = T
+		self.prev_limit_W = P_W
+		self.engine.commanded(self, T, P_W)
+
+
+	def estimateInverterPower(self, s):
+		"""
+		Best estimate of the current inverter output, or None while a limit change is settling
+		and the engine relies on settled readings.
+
+		Inverter output changes only through our commands, so an older DTU reading stays valid as
+		long as it was taken after the last limit change had settled. Until the DTU reports again,
+		assume the inverter runs at the commanded limit.
+		"""
+		inverter_P = s['dtu_Pac']
+		if self.prev_adjust_T is not None:
+			settled_T = self.prev_adjust_T + self.settling_time_s
+			if s['meter_T'] < settled_T and self.engine.wait_for_settling:
+				return None
+			if s['dtu_T'] < settled_T:
+				inverter_P = self.prev_limit_W
+		return inverter_P
+
+
+class ProportionalEngine:
+	"""
+	The original control law: new limit = inverter power + grid power, quantized,
+	plus one granularity step of extra feed. Acts only on settled readings.
+	"""
+
+	name = 'proportional'
+	wait_for_settling = True
+
+	def computeLimit(self, logic, s, inverter_P, max_P):
+		return inverter_P + s['meter_P'] + logic.power_granularity_W
+
+	def referencePower(self, logic, inverter_P):
+		return inverter_P
+
+	def shouldCommand(self, logic, T):
+		return True
+
+	def commanded(self, logic, T, P_W):
+		pass
+
+	def backedOff(self, logic, T, P_W):
+		"""
+		The limit was lowered to P_W while the previous change was still settling.
+		"""
+		pass
+
+
+class PIEngine(ProportionalEngine):
+	"""
+	PI control of the grid power towards -target_export_W (a small export).
+
+	The integral term, started at the current inverter output, carries the
+	estimated house load, the proportional term reacts to the current error.
+	The integral is advanced at most max_dt_s per decision, and not within the
+	deadband of one granularity step. Anti-windup: the integral is kept within
+	the inverter power range, and while the output is saturated it is
+	recomputed from the saturated output (back-calculation). Acts only on
+	settled readings, so that the dead time of the DTU does not enter the loop
+	as overshoot.
+
+	Experimental: in benchmarkControlLogic.py it exports more than the
+	proportional engine and hunts between limits while the inverter output
+	falls short of the limit, since the integral then winds up.
+	"""
+
+	name = 'pi'
+
+	def __init__(self, Kp=0.1, Ki=0.5, target_export_W=None, max_dt_s=1.0):
+		self.Kp = float(Kp)
+		self.Ki = float(Ki)
+		self.target_export_W = target_export_W
+		self.max_dt_s = float(max_dt_s)
+		self.integral = None
+		self.prev_T = None
+
+	def computeLimit(self, logic, s, inverter_P, max_P):
+		target = self.target_export_W if self.target_export_W is not None else logic.power_granularity_W
+		e = s['meter_P'] + target    # >0: importing or exporting less than the target, raise output
+
+		T = s['meter_T']
+		if self.integral is None or self.prev_T is None:
+			self.integral = inverter_P
+			dt = 0.0
+		else:
+			dt = min(max(0.0, T - self.prev_T), self.max_dt_s)
+		self.prev_T = T
+
+		if abs(e) > logic.power_granularity_W:
+			self.integral += self.Ki * e * dt
+		u = self.integral + self.Kp * e
+
+		lo, hi = logic.min_power_W, max_P
+		if u > hi or u < lo:
+			u = min(max(u, lo), hi)
+			self.integral = u - self.Kp * e
+		self.integral = min(max(self.integral, lo), hi)
+		return u
+
+	def backedOff(self, logic, T, P_W):
+		# the house load is now below the lowered output
+		if self.integral is not None:
+			self.integral = min(self.integral, P_W)
+
+
+class PredictiveEngine(ProportionalEngine):
+	"""
+	Model-predictive variant that does not wait for a DTU reading after a limit change.
+
+	A commanded limit is assumed to take effect dead_time_s after the command,
+	and the inverter output then follows it with a first-order lag of lag_s.
+	The inverter output at the time of the meter reading comes from this model,
+	or from the DTU reading if the inverter evidently can not deliver the limit
+	(e.g. low battery). House load is grid power plus inverter output; it is
+	extrapolated over the dead time with the grid power trend ('meter_slope'),
+	and the new limit covers it plus a small export. To save DTU commands a
+	limit is sent only if it differs from the last one by more than the
+	hysteresis, and not more often than every min_command_interval_s (by default
+	the settling time, during which the actuator would hold it back anyway).
+	"""
+
+	name = 'predictive'
+	wait_for_settling = False
+
+	def __init__(self, dead_time_s=None, lag_s=1.5, min_command_interval_s=None, max_trend_W=30.0, target_export_W=None):
+		self.dead_time_s = dead_time_s
+		self.lag_s = float(lag_s)
+		self.min_command_interval_s = min_command_interval_s
+		self.max_trend_W = float(max_trend_W)
+		self.target_export_W = target_export_W
+		self.limits = []       # (time the limit takes effect, limit W), newest last
+		self.prev_command_T = None
+
+	def _deadTime(self, logic):
+		return self.dead_time_s if self.dead_time_s is not None else logic.settling_time_s
+
+	def modelOutput(self, logic, s, T):
+		"""
+		Expected inverter output at time T.
+		"""
+		before_W, W, T_eff = s['dtu_Pac'], None, None
+		for (T_lim, W_lim) in self.limits:
+			if T_lim <= T:
+				if W is not None:
+					before_W = W
+				W, T_eff = W_lim, T_lim
+		if W is None:
+			return s['dtu_Pac']
+
+		if s['dtu_T'] >= T_eff + 3*self.lag_s and s['dtu_Pac'] < W - 2*logic.power_granularity_W:
+			return s['dtu_Pac']   # not delivering the limit
+		return before_W + (W - before_W) * (1.0 - math.exp(-(T - T_eff) / self.lag_s))
+
+	def computeLimit(self, logic, s, inverter_P, max_P):
+		target = self.target_export_W if self.target_export_W is not None else logic.power_granularity_W
+		load = s['meter_P'] + self.modelOutput(logic, s, s['meter_T'])
+		# the trend is noisy, only its excess over the hysteresis is taken as a real ramp
+		trend = s.get('meter_slope', 0.0) * self._deadTime(logic)
+		trend = math.copysign(max(0.0, abs(trend) - 2*logic.power_granularity_W), trend)
+		trend = min(max(trend, -self.max_trend_W), self.max_trend_W)
+		return load + trend + target
+
+	def referencePower(self, logic, inverter_P):
+		if self.limits:
+			return self.limits[-1][1]
+		return inverter_P
+
+	def shouldCommand(self, logic, T):
+		interval = self.min_command_interval_s if self.min_command_interval_s is not None else logic.settling_time_s
+		return self.prev_command_T is None or T - self.prev_command_T >= interval
+
+	def commanded(self, logic, T, P_W):
+		if self.limits and self.limits[-1][1] == P_W and self.limits[-1][0] > T:
+			# same limit noted again when it was actually sent
+			self.limits.pop()
+		self.prev_command_T = T
+		self.limits.append((T + self._deadTime(logic), P_W))
+		self.limits = self.limits[-4:]
+
+
+def allocatePower(total_W, units, granularity_W=5):
+	"""
+	Split a total power limit across several inverters, in order of priority.
+
+	units is a list of dicts, highest priority first, with
+	  'max_W'   - power limit of the inverter [W]
+	  'min_W'   - smallest limit to command [W], optional
+	  'enabled' - False while the inverter is switched off, it then gets no share; optional
+	  'solar'   - True if the inverter is fed directly by solar panels; optional
+	  'Pac'     - last AC output [W] or None
+	  'limit_W' - last reported active limit [W] or None
+
+	Each inverter takes as much of the remaining power as it can. A solar inverter that
+	delivers clearly less than its active limit is short of sun: it counts with what it
+	delivers and is left at its max limit to follow the sun, the rest goes to the next
+	inverters. The last enabled inverter takes the remainder, up to its max.
+	Returns the list of limits [W], None for inverters that are switched off.
+	"""
+	limits = [None] * len(units)
+	active = [n for n, u in enumerate(units) if u.get('enabled', True)]
+	remaining = max(0.0, float(total_W))
+
+	for k, n in enumerate(active):
+		u = units[n]
+		Pac, limit_W = u.get('Pac'), u.get('limit_W')
+		if u.get('solar') and k < len(active) - 1 and Pac is not None and limit_W is not None:
+			if limit_W - Pac > 2*granularity_W and remaining > Pac:
+				limits[n] = u['max_W']
+				remaining -= Pac
+				continue
+		share = min(remaining, u['max_W'])
+		limits[n] = max(share, u.get('min_W', 0.0))
+		remaining -= share
+
+	return limits
+
+
+CONTROL_ENGINES = {'proportional': ProportionalEngine, 'pi': PIEngine, 'predictive': PredictiveEngine}
+
+
+def makeControlEngine(name='proportional', **params):
+	"""
+	Create a control engine by name, see CONTROL_ENGINES. The default 'proportional' is the
+	one to use in production, 'pi' is experimental.
+	"""
+	if name not in CONTROL_ENGINES:
+		raise ValueError('Unknown control engine %s, choose from %s' % (name, ', '.join(CONTROL_ENGINES)))
+	return CONTROL_ENGINES[name](**params)
@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+#
+# Local stand-in servers for the devices of the control loop, answering from a
+# SimulatedPlant:
+#
+#   AhoyDTU        /api/live, /api/inverter/list, /api/inverter/id/<nr>, POST /api/ctrl
+#   Tibber Bridge  /data.json?node_id=1   (raw SML frame)
+#   MyStrom        /report, /relay?state=0|1
+#   InfluxDB       /query   (SELECT last(value) ... WHERE topic::tag = '<topic>' [OR ...] [GROUP BY topic], also several statements separated by ';')
+#   MQTT broker    CONNECT, PUBLISH QoS 0/1, SUBSCRIBE, PINGREQ; 'solar/control/inverter_enable' switches the Steca,
+#                  the BMS readings are published every bms_publish_interval_s like the InfluxDB topics
+#
+# The battery inverter of the plant has id inverter_id, the optional solar
+# inverter the next id.
+#
+# Each device listens on its own port of 127.0.0.1, the addresses to put into
+# the control loop configuration are in SimulatedDevices.hosts after start().
+# Device time is taken from the event loop clock, so the servers also work on
+# the virtual time of SimulationHarness.
+#
+
+import asyncio
+import collections
+import re
+import socket
+import struct
+
+from aiohttp import web
+
+from SimulatedPlant import AHOY_CH0_FIELDS, AHOY_CH0_UNITS, AHOY_CH_FIELDS, AHOY_CH_UNITS
+from MqttClientAsync import topicMatches
+
+_TOPIC_RE = re.compile(r"topic::tag\s*=\s*'([^']+)'")
+
+
+def _encodeMqttLength(n):
+	out = bytearray()
+	while True:
+		b, n = n % 128, n // 128
+		out.append(b | 0x80 if n > 0 else b)
+		if n == 0:
+			return bytes(out)
+
+
+def _listenSocket():
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.bind(('127.0.0.1', 0))
+	sock.listen(16)
+	sock.setblocking(False)
+	return sock
+
+
+class SimulatedDevices:
+
+	def __init__(self, plant, inverter_id=1, bms_publish_interval_s=5.0):
+		self.plant = plant
+		self.inverter_id = int(inverter_id)
+		self.units = {self.inverter_id + n: n for n in range(len(plant.inverters))}   # inverter id -> plant unit
+		self.hosts = {}
+		self.runners = []
+		self.mqtt_server = None
+		self.mqtt_subscriptions = {}   # client writer -> topic filters
+		self.bms_publish_interval_s = bms_publish_interval_s
+		self.bms_publisher = None
+		self.mqtt_messages = collections.deque(maxlen=10000)  # latest (T, topic, payload) received by the broker
+		self.num_mqtt_messages = 0
+		self.num_requests = 0
+		self.t0 = None
+
+
+	def now(self):
+		"""
+		Plant time: seconds since start().
+		"""
+		return asyncio.get_running_loop().time() - self.t0
+
+
+	async def start(self):
+		self.t0 = asyncio.get_running_loop().time()
+
+		apps = {
+			'dtu': [web.get('/api/live', self.ahoyLive), web.get('/api/inverter/list', self.ahoyInverterList),
+				web.get('/api/inverter/id/{nr}', self.ahoyInverter), web.post('/api/ctrl', self.ahoyCtrl)],
+			'bridge': [web.get('/data.json', self.bridgeData)],
+			'mystrom': [web.get('/report', self.mystromReport), web.get('/relay', self.mystromRelay)],
+			'influx': [web.get('/query', self.influxQuery), web.post('/query', self.influxQuery), web.get('/ping', self.influxPing)],
+		}
+		for name, routes in apps.items():
+			app = web.Application()
+			app.add_routes(routes)
+			runner = web.AppRunner(app, access_log=None)
+			await runner.setup()
+			sock = _listenSocket()
+			await web.SockSite(runner, sock).start()
+			self.runners.append(runner)
+			self.hosts[name] = '127.0.0.1:%d' % (sock.getsockname()[1])
+
+		sock = _listenSocket()
+		self.mqtt_server = await asyncio.start_server(self.mqttSession, sock=sock)
+		self.hosts['mqtt'] = '127.0.0.1:%d' % (sock.getsockname()[1])
+		self.bms_publisher = asyncio.create_task(self.publishBmsValues())
+
+
+	async def stop(self):
+		if self.bms_publisher is not None:
+			self.bms_publisher.cancel()
+			await asyncio.gather(self.bms_publisher, return_exceptions=True)
+			self.bms_publisher = None
+		if self.mqtt_server is not None:
+			self.mqtt_server.close()
+			self.mqtt_server = None
+		for runner in self.runners:
+			await runner.cleanup()
+		self.runners = []
+
+
+	async def ahoyLive(self, request):
+		self.num_requests += 1
+		return web.json_response({'ch0_fld_names': AHOY_CH0_FIELDS, 'ch0_fld_units': AHOY_CH0_UNITS,
+			'fld_names': AHOY_CH_FIELDS, 'fld_units': AHOY_CH_UNITS})
+
+
+	async def ahoyInverterList(self, request):
+		self.num_requests += 1
+		inverters = [{'enabled': True, 'id': id, 'name': self.plant.inverters[unit].name, 'serial': '11210000000%d' % (unit + 1),
+			'channels': 1, 'version': '10012'} for id, unit in self.units.items()]
+		return web.json_response({'inverter': inverters, 'interval': int(self.plant.dtu_poll_interval_s)})
+
+
+	async def ahoyInverter(self, request):
+		self.num_requests += 1
+		id = int(request.match_info['nr'])
+		if id not in self.units:
+			return web.json_response({})
+		return web.json_response(self.plant.inverterData(self.now(), id, self.units[id]))
+
+
+	async def ahoyCtrl(self, request):
+		self.num_requests += 1
+		try:
+			cmd = await request.json()
+		except ValueError:
+			return web.json_response({'success': False, 'error': 'bad json'}, status=400)
+
+		unit = self.units.get(int(cmd.get('id', -1)))
+		if unit is None:
+			return web.json_response({'success': False, 'error': 'unknown inverter'})
+		if cmd.get('cmd') in ('limit_nonpersistent_absolute', 'limit_persistent_absolute'):
+			self.plant.setPowerLimit(self.now(), float(cmd['val']), unit)
+		elif cmd.get('cmd') == 'power':
+			self.plant.setPowerState(self.now(), int(cmd['val']) != 0, unit)
+		else:
+			return web.json_response({'success': False, 'error': 'unknown command'})
+		return web.json_response({'success': True})
+
+
+	async def bridgeData(self, request):
+		self.num_requests += 1
+		return web.Response(body=self.plant.meterFrame(self.now()), content_type='application/octet-stream')
+
+
+	async def mystromReport(self, request):
+		self.num_requests += 1
+		self.plant.advance(self.now())
+		P = self.plant.steca_charge_W if self.plant.steca_ac_charging else 0.0
+		return web.json_response({'power': P, 'Ws': P, 'relay': self.plant.steca_ac_charging, 'temperature': 25.0})
+
+
+	async def mystromRelay(self, request):
+		self.num_requests += 1
+		self.plant.advance(self.now())
+		self.plant.steca_ac_charging = (request.query.get('state') == '1')
+		return web.Response(text='')
+
+
+	async def influxPing(self, request):
+		return web.Response(status=204, headers={'X-Influxdb-Version': '1.8.10'})
+
+
+	async def influxQuery(self, request):
+		self.num_requests += 1
+		q = request.query.get('q')
+		if q is None:
+			q = (await request.post()).get('q', '')
+
+		values = self.plant.bmsValues(self.now())
+		ts = int(self.plant.wallclock().timestamp() * 1e9)
+		results = []
+		for n, stmt in enumerate(s for s in q.split(';') if s.strip()):
+			result = {'statement_id': n}
+			series = []
+			for topic in _TOPIC_RE.findall(stmt):
+				if topic in values:
+					series.append({'name': 'solar', 'tags': {'topic': topic}, 'columns': ['time', 'last'], 'values': [[ts, values[topic]]]})
+			if len(series) == 1 and 'GROUP BY' not in stmt.upper():
+				del series[0]['tags']
+			if series:
+				result['series'] = series
+			results.append(result)
+		return web.json_response({'results': results})
+
+
+	async def mqttSession(self, reader, writer):
+		"""
+		Minimal MQTT 3.1.1 broker side of one client connection.
+		"""
+		try:
+			while True:
+				hdr = (await reader.readexactly(1))[0]
+				length, shift = 0, 0
+				while True:
+					b = (await reader.readexactly(1))[0]
+					length |= (b & 0x7F) << shift
+					shift += 7
+					if not (b & 0x80):
+						break
+				body = await reader.readexactly(length) if length > 0 else b''
+
+				ptype = hdr & 0xF0
+				if ptype == 0x10:
+					writer.write(bytes([0x20, 2, 0, 0]))
+				elif ptype == 0x30:
+					qos = (hdr >> 1) & 0x03
+					tlen = struct.unpack('>H', body[:2])[0]
+					topic = body[2:2+tlen].decode('utf-8')
+					pos = 2 + tlen
+					if qos > 0:
+						writer.write(bytes([0x40, 2]) + body[pos:pos+2])
+						pos += 2
+					self.onMqttMessage(topic, body[pos:])
+				elif ptype == 0x80:
+					pos, filters = 2, []
+					while pos < len(body):
+						flen = struct.unpack('>H', body[pos:pos+2])[0]
+						filters.append(body[pos+2:pos+2+flen].decode('utf-8'))
+						pos += 2 + flen + 1
+					self.mqtt_subscriptions.setdefault(writer, []).extend(filters)
+					writer.write(bytes([0x90, 2 + len(filters)]) + body[:2] + bytes(len(filters)))
+				elif ptype == 0xC0:
+					writer.write(bytes([0xD0, 0]))
+				elif ptype == 0xE0:
+					break
+				await writer.drain()
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		finally:
+			self.mqtt_subscriptions.pop(writer, None)
+			writer.close()
+
+
+	def onMqttMessage(self, topic, payload):
+		self.mqtt_messages.append((self.now(), topic, payload))
+		self.num_mqtt_messages += 1
+		if topic == 'solar/control/inverter_enable':
+			self.plant.advance(self.now())
+			self.plant.steca_enabled = (payload == b'true')
+		self.forwardMqttMessage(topic, payload)
+
+
+	def forwardMqttMessage(self, topic, payload):
+		"""
+		Send a message with QoS 0 to the clients subscribed to its topic.
+		"""
+		tbytes = topic.encode('utf-8')
+		body = struct.pack('>H', len(tbytes)) + tbytes + payload
+		for writer, filters in list(self.mqtt_subscriptions.items()):
+			if any(topicMatches(f, topic) for f in filters) and not writer.is_closing():
+				writer.write(bytes([0x30]) + _encodeMqttLength(len(body)) + body)
+
+
+	async def publishBmsValues(self):
+		"""
+		Publish the BMS readings to the subscribed clients, like the BMS gateway does.
+		"""
+		while True:
+			await asyncio.sleep(self.bms_publish_interval_s)
+			if not self.mqtt_subscriptions:
+				continue
+			for topic, value in self.plant.bmsValues(self.now()).items():
+				self.forwardMqttMessage(topic, str(value).encode('utf-8'))
+
+
+if __name__ == '__main__':
+
+	from SimulatedPlant import SimulatedPlant
+
+	async def main():
+		devices = SimulatedDevices(SimulatedPlant())
+		await devices.start()
+		for name, host in devices.hosts.items():
+			print('%-8s %s' % (name, host))
+		try:
+			await asyncio.Event().wait()
+		finally:
+			await devices.stop()
+
+	try:
+		asyncio.run(main())
+	except KeyboardInterrupt:
+		pass
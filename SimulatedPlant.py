@@ -0,0 +1,405 @@
+#!/usr/bin/python3
+#
+# Simulated plant for offline tests of the zero export control loop: house load,
+# Hoymiles microinverter, 16S LFP battery with a solar charger, Steca Solarix
+# AC charging, and the grid energy meter.
+#
+# The plant is advanced lazily to the time of each device query, in small
+# fixed steps, so that results do not depend on how often it is queried.
+# All randomness comes from a seeded generator, runs are repeatable.
+#
+# Inverter model: a new power limit takes effect after a dead time
+# (inverter_settling_s, DTU radio round trip and inverter firmware), then the
+# AC output follows it with a first-order lag (inverter_tau_s). Output is
+# limited by the inverter rating and drops to zero when the battery is empty.
+#
+# Optionally (solar_inverter_max_W > 0) a second inverter is fed directly by its
+# own solar panels; its output is further limited by the sun. It is reached as
+# unit 1 of the device methods, the battery inverter is unit 0.
+#
+# The DTU reports inverter values only every dtu_poll_interval_s, and the
+# Tibber Pulse delivers a new meter reading every meter_interval_s. The solar
+# inverter is offline at night: the DTU keeps reporting its last data, with the
+# time of its last successful poll (ts_last_success), 0 if there was none.
+#
+# The house load is synthetic (base load, daily pattern and random appliance
+# use), or a recorded load profile of (T, W) samples relative to the start.
+#
+
+import bisect
+import datetime
+import math
+import random
+
+from SmlParser import SML_ESCAPE, SML_START, crc16x25
+
+# Open circuit voltage of a 16S LFP pack vs state of charge [%]
+LFP_16S_OCV = [(0, 44.0), (5, 48.0), (10, 50.0), (20, 51.2), (40, 52.0), (60, 52.3), (80, 53.1), (95, 53.6), (100, 55.2)]
+
+# Hoymiles field names and units as reported by AhoyDTU /api/live
+AHOY_CH0_FIELDS = ['U_AC', 'I_AC', 'P_AC', 'F_AC', 'PF_AC', 'Temp', 'YieldTotal', 'YieldDay', 'P_DC', 'Efficiency', 'Q_AC', 'MaxPower']
+AHOY_CH0_UNITS = ['V', 'A', 'W', 'Hz', '', '°C', 'kWh', 'Wh', 'W', '%', 'var', 'W']
+AHOY_CH_FIELDS = ['U_DC', 'I_DC', 'P_DC', 'YieldDay', 'YieldTotal', 'Irradiation', 'MaxPower']
+AHOY_CH_UNITS = ['V', 'A', 'W', 'Wh', 'kWh', '%', 'W']
+
+
+def _interpolate(table, x):
+	if x <= table[0][0]:
+		return table[0][1]
+	for (x0, y0), (x1, y1) in zip(table, table[1:]):
+		if x <= x1:
+			return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+	return table[-1][1]
+
+
+def _smlTL(typ, data):
+	n = len(data) + 1
+	if n > 15:
+		n += 1
+		return bytes([0x80 | (typ << 4) | ((n >> 4) & 0x0F), n & 0x0F]) + data
+	return bytes([(typ << 4) | n]) + data
+
+
+def _smlList(*items):
+	return bytes([0x70 | len(items)]) + b''.join(items)
+
+
+def _smlEntry(obis, unit, scaler, value, nbytes):
+	"""
+	One SML_ListEntry with a signed integer value.
+	"""
+	notset = b'\x01'
+	return _smlList(_smlTL(0, bytes(obis)), notset, notset, _smlTL(6, bytes([unit])), _smlTL(5, scaler.to_bytes(1, 'big', signed=True)),
+		_smlTL(5, int(value).to_bytes(nbytes, 'big', signed=True)), notset)
+
+
+def encodeSmlFrame(power_W, import_Wh, export_Wh, phase_W=None, server_id=b'\x0a\x01SIM\x00\x00\x00\x01'):
+	"""
+	Build an SML frame as sent by an electricity meter: an open response and a
+	GetListResponse with energy counters (0.1 Wh resolution) and active power.
+	"""
+	notset = b'\x01'
+	u8 = lambda v: _smlTL(6, bytes([v]))
+	u16 = lambda v: _smlTL(6, v.to_bytes(2, 'big'))
+
+	entries = [_smlEntry([1, 0, 1, 8, 0, 255], 30, -1, round(import_Wh * 10), 8),
+		_smlEntry([1, 0, 2, 8, 0, 255], 30, -1, round(export_Wh * 10), 8),
+		_smlEntry([1, 0, 16, 7, 0, 255], 27, 0, round(power_W), 4)]
+	if phase_W:
+		for obis_c, P in zip((36, 56, 76), phase_W):
+			entries.append(_smlEntry([1, 0, obis_c, 7, 0, 255], 27, 0, round(P), 4))
+
+	open_res = _smlList(_smlTL(0, b'\x00\x01'), u8(0), u8(0),
+		_smlList(u16(0x0101), _smlList(notset, notset, _smlTL(0, b'\x00\x00\x00\x01'), _smlTL(0, server_id), notset, notset)),
+		u16(0), b'\x00')
+	list_res = _smlList(_smlTL(0, b'\x00\x02'), u8(0), u8(0),
+		_smlList(u16(0x0701), _smlList(notset, _smlTL(0, server_id), notset, notset, _smlList(*entries), notset, notset)),
+		u16(0), b'\x00')
+
+	body = (open_res + list_res).replace(SML_ESCAPE, SML_ESCAPE + SML_ESCAPE)
+	pad = (4 - len(body) % 4) % 4
+	frame = SML_START + body + b'\x00' * pad + SML_ESCAPE + b'\x1a' + bytes([pad])
+	crc = crc16x25(frame)
+	return frame + bytes([crc & 0xFF, crc >> 8])
+
+
+class SimulatedInverter:
+	"""
+	Hoymiles microinverter: power limit with dead time, output with first-order lag.
+	"""
+
+	def __init__(self, max_W, settling_s, tau_s, efficiency, name):
+		self.max_W = float(max_W)
+		self.settling_s = float(settling_s)
+		self.tau_s = float(tau_s)
+		self.efficiency = float(efficiency)
+		self.name = name
+		self.on = True
+		self.limit_W = self.max_W
+		self.pending_limits = []      # (time the limit takes effect, limit W)
+		self.P_ac = 0.0
+		self.E_ac_Wh = 0.0
+		self.snapshot = None
+		self.snapshot_T = None
+
+
+	def setPowerLimit(self, T, P_W):
+		self.pending_limits.append((T + self.settling_s, max(0.0, min(float(P_W), self.max_W))))
+
+
+	def step(self, T, dt, P_dc_available):
+		"""
+		Advance the AC output to time T, with at most P_dc_available from the DC source.
+		"""
+		while self.pending_limits and self.pending_limits[0][0] <= T:
+			self.limit_W = self.pending_limits.pop(0)[1]
+
+		target = min(self.limit_W, self.max_W, P_dc_available * self.efficiency) if self.on else 0.0
+		self.P_ac += (target - self.P_ac) * (1.0 - math.exp(-dt / self.tau_s))
+		self.E_ac_Wh += self.P_ac * dt / 3600.0
+
+
+	def data(self, inverter_id, V_dc, ts):
+		"""
+		AhoyDTU /api/inverter/id/<nr> reply for the current state.
+		"""
+		P_dc = self.P_ac / self.efficiency
+		ch0 = [230.0, round(self.P_ac / 230.0, 2), round(self.P_ac, 1), 50.0, 1.0, 35.0,
+			round(self.E_ac_Wh / 1000.0, 3), round(self.E_ac_Wh, 0), round(P_dc, 1),
+			round(100.0 * self.efficiency, 1), 0.0, self.max_W]
+		ch1 = [round(V_dc, 2), round(P_dc / V_dc, 2) if V_dc > 0 else 0.0, round(P_dc, 1), round(self.E_ac_Wh, 0), round(self.E_ac_Wh / 1000.0, 3), 0.0, self.max_W]
+		return {'id': inverter_id, 'enabled': True, 'name': self.name, 'channels': 1,
+			'ts_last_success': ts, 'ch': [ch0, ch1], 'ch_name': ['AC', 'PV1'],
+			'power_limit_read': round(100.0 * self.limit_W / self.max_W, 1)}
+
+
+class SimulatedPlant:
+
+	def __init__(self, seed=1, start=None, step_s=0.25,
+			inverter_max_W=350, inverter_settling_s=5.0, inverter_tau_s=1.5, inverter_efficiency=0.95,
+			dtu_poll_interval_s=5.0, meter_interval_s=1.0,
+			battery_capacity_Wh=5120.0, battery_SOC_percent=60.0, battery_R_ohm=0.03,
+			pv_peak_W=800.0, base_load_W=150.0, steca_charge_W=1500.0, load_profile=None,
+			solar_inverter_max_W=0.0, solar_pv_peak_W=400.0):
+
+		self.rng = random.Random(seed)
+		self.start = start if start is not None else datetime.datetime(2024, 6, 1, 0, 0, 0)
+		self.start_of_day_s = self.start.hour * 3600 + self.start.minute * 60 + self.start.second
+		self.step_s = float(step_s)
+
+		self.inverter_max_W = float(inverter_max_W)
+		self.inverter_settling_s = float(inverter_settling_s)
+		self.inverter_tau_s = float(inverter_tau_s)
+		self.inverter_efficiency = float(inverter_efficiency)
+		self.dtu_poll_interval_s = float(dtu_poll_interval_s)
+		self.meter_interval_s = float(meter_interval_s)
+		self.battery_capacity_Wh = float(battery_capacity_Wh)
+		self.battery_R_ohm = float(battery_R_ohm)
+		self.pv_peak_W = float(pv_peak_W)
+		self.base_load_W = float(base_load_W)
+		self.steca_charge_W = float(steca_charge_W)
+		self.solar_pv_peak_W = float(solar_pv_peak_W)
+
+		# plant state
+		self.T = 0.0
+		self.soc = float(battery_SOC_percent)
+		self.inverters = [SimulatedInverter(inverter_max_W, inverter_settling_s, inverter_tau_s, inverter_efficiency, 'HM-350')]
+		if solar_inverter_max_W > 0:
+			self.inverters.append(SimulatedInverter(solar_inverter_max_W, inverter_settling_s, inverter_tau_s, inverter_efficiency, 'HM-350-PV'))
+		self.P_ac = 0.0               # all inverters
+		self.P_battery = 0.0          # P>0 charging
+		self.V_battery = _interpolate(LFP_16S_OCV, self.soc)
+		self.P_grid = 0.0             # P>0 import
+		self.E_import_Wh = 100000.0
+		self.E_export_Wh = 1000.0
+		self.steca_enabled = True
+		self.steca_ac_charging = False
+
+		# house load events: (start T, end T, W), generated per day
+		self.events = []
+		self.events_until = -self.start_of_day_s   # midnight before the start
+		self.load_W = None
+		self.load_until = None
+		self.profile_T = [T for (T, W) in load_profile] if load_profile else None
+		self.profile_W = [W for (T, W) in load_profile] if load_profile else None
+
+		# snapshots as seen by the meter, the DTU ones are kept per inverter
+		self.meter_frame = None
+		self.meter_frame_T = None
+
+		# statistics for comparing control strategies
+		self.stats = {'export_Wh': 0.0, 'import_Wh': 0.0, 'abs_grid_Wh': 0.0, 'export_s': 0.0,
+			'inverter_Wh': 0.0, 'solar_inverter_Wh': 0.0, 'limit_commands': 0, 'power_commands': 0, 'undersupplied_Wh': 0.0}
+
+
+	def wallclock(self, T=None):
+		return self.start + datetime.timedelta(seconds=self.T if T is None else T)
+
+
+	def hourOfDay(self, T):
+		return ((self.start_of_day_s + T) % 86400.0) / 3600.0
+
+
+	def _generateEvents(self, day_start):
+		"""
+		Random appliance use for one day: kettle, cooking, washing machine, fridge cycles.
+		"""
+		rng = self.rng
+		day = 86400.0
+		for n in range(rng.randint(2, 5)):
+			t0 = day_start + rng.uniform(6*3600, 22*3600)
+			self.events.append((t0, t0 + rng.uniform(120, 240), 2000.0))
+		for t0 in (day_start + rng.gauss(12.5*3600, 1800), day_start + rng.gauss(18.5*3600, 1800)):
+			self.events.append((t0, t0 + rng.uniform(1200, 2700), rng.uniform(800, 1800)))
+		if rng.random() < 0.5:
+			t0 = day_start + rng.uniform(9*3600, 16*3600)
+			self.events.append((t0, t0 + 5400, 450.0))
+		t0 = day_start
+		while t0 < day_start + day:
+			self.events.append((t0, t0 + rng.uniform(600, 1200), 90.0))
+			t0 += rng.uniform(2400, 3600)
+		self.events_until = day_start + day
+
+
+	def houseLoad(self, T):
+		"""
+		House load [W]; piecewise constant, recomputed only after the next change of an event.
+		"""
+		if self.load_until is not None and self.load_until[0] <= T < self.load_until[1]:
+			return self.load_W
+
+		if self.profile_T is not None:
+			k = max(0, bisect.bisect_right(self.profile_T, T) - 1)
+			self.load_W = self.profile_W[k]
+			self.load_until = (T, self.profile_T[k+1] if k + 1 < len(self.profile_T) else math.inf)
+			return self.load_W
+
+		while T >= self.events_until:
+			self.events = [e for e in self.events if e[1] > self.events_until]
+			self._generateEvents(self.events_until)
+
+		midnight = T - self.hourOfDay(T) * 3600.0
+		changes = [self.events_until] + [midnight + h*3600.0 for h in (6.5, 8.5, 17, 23, 24)]
+		hour = self.hourOfDay(T)
+		P = self.base_load_W
+		if 6.5 <= hour < 8.5 or 17 <= hour < 23:
+			P += 120.0
+		for (t0, t1, W) in self.events:
+			if t0 <= T < t1:
+				P += W
+			changes.append(t0)
+			changes.append(t1)
+
+		self.load_W = P
+		self.load_until = (T, min(t for t in changes if t > T))
+		return P
+
+
+	def sunShape(self, T):
+		"""
+		Relative solar power, a sine over the day between 6 and 20 h.
+		"""
+		hour = self.hourOfDay(T)
+		if hour <= 6 or hour >= 20:
+			return 0.0
+		return math.sin(math.pi * (hour - 6) / 14.0)
+
+
+	def pvPower(self, T):
+		"""
+		Solar charger power into the battery.
+		"""
+		return self.pv_peak_W * self.sunShape(T)
+
+
+	def advance(self, T):
+		"""
+		Integrate the plant up to time T.
+		"""
+		while self.T < T:
+			dt = min(self.step_s, T - self.T)
+			self._step(dt)
+		self.T = max(self.T, T)
+
+
+	def _step(self, dt):
+		T = self.T + dt
+
+		# inverter outputs follow their limits with a first-order lag
+		battery_inverter = self.inverters[0]
+		battery_inverter.step(T, dt, math.inf if self.soc > 0 else 0.0)
+		for inverter in self.inverters[1:]:
+			inverter.step(T, dt, self.solar_pv_peak_W * self.sunShape(T))
+		self.P_ac = sum(inverter.P_ac for inverter in self.inverters)
+
+		# battery: solar charger in, inverter DC out, Steca AC charger in
+		P_dc = battery_inverter.P_ac / battery_inverter.efficiency
+		P_charge = self.pvPower(T)
+		P_steca = self.steca_charge_W if self.steca_ac_charging else 0.0
+		self.P_battery = P_charge + P_steca - P_dc
+		ocv = _interpolate(LFP_16S_OCV, self.soc)
+		I = self.P_battery / ocv
+		self.V_battery = ocv + I * self.battery_R_ohm
+		self.soc += 100.0 * self.P_battery * dt / 3600.0 / self.battery_capacity_Wh
+		self.soc = min(100.0, max(0.0, self.soc))
+
+		# grid
+		load = self.houseLoad(T)
+		self.P_grid = load + P_steca - self.P_ac
+		E = self.P_grid * dt / 3600.0
+		if E >= 0:
+			self.E_import_Wh += E
+			self.stats['import_Wh'] += E
+		else:
+			self.E_export_Wh -= E
+			self.stats['export_Wh'] -= E
+			self.stats['export_s'] += dt
+		self.stats['abs_grid_Wh'] += abs(E)
+		self.stats['inverter_Wh'] += self.P_ac * dt / 3600.0
+		for inverter in self.inverters[1:]:
+			self.stats['solar_inverter_Wh'] += inverter.P_ac * dt / 3600.0
+		max_W = sum(inverter.max_W for inverter in self.inverters)
+		self.stats['undersupplied_Wh'] += max(0.0, min(load, max_W) - self.P_ac) * dt / 3600.0
+
+		self.T = T
+
+
+	def setPowerLimit(self, T, P_W, unit=0):
+		self.advance(T)
+		self.inverters[unit].setPowerLimit(T, P_W)
+		self.stats['limit_commands'] += 1
+
+
+	def setPowerState(self, T, enabled, unit=0):
+		self.advance(T)
+		self.inverters[unit].on = bool(enabled)
+		self.stats['power_commands'] += 1
+
+
+	def inverterData(self, T, inverter_id=0, unit=0):
+		"""
+		AhoyDTU /api/inverter/id/<nr> reply as of the last DTU poll of the inverter.
+		"""
+		self.advance(T)
+		inverter = self.inverters[unit]
+		poll_T = math.floor(T / self.dtu_poll_interval_s) * self.dtu_poll_interval_s
+		if inverter.snapshot_T != poll_T:
+			inverter.snapshot_T = poll_T
+			if unit > 0 and self.sunShape(T) <= 0:
+				if inverter.snapshot is None:
+					inverter.snapshot = inverter.data(inverter_id, 0.0, 0)
+				return inverter.snapshot
+			V_dc = self.V_battery if unit == 0 else 30.0 * min(1.0, 5.0 * self.sunShape(T))
+			inverter.snapshot = inverter.data(inverter_id, V_dc, int(self.wallclock(poll_T).timestamp()))
+		return inverter.snapshot
+
+
+	def meterFrame(self, T):
+		"""
+		SML frame of the latest meter reading, as read out by the Tibber Pulse.
+		"""
+		self.advance(T)
+		sample_T = math.floor(T / self.meter_interval_s) * self.meter_interval_s
+		if self.meter_frame_T != sample_T:
+			self.meter_frame_T = sample_T
+			P = self.P_grid
+			self.meter_frame = encodeSmlFrame(P, self.E_import_Wh, self.E_export_Wh, [P / 3.0] * 3)
+		return self.meter_frame
+
+
+	def bmsValues(self, T):
+		"""
+		Latest BMS readings as stored in InfluxDB, by topic.
+		"""
+		self.advance(T)
+		return {'solar/data/Battery_Voltage': round(self.V_battery, 2),
+			'solar/data/Battery_Power': round(self.P_battery, 1),
+			'solar/data/Percent_Remain': round(self.soc, 1),
+			'solar/data/Steca_Load_W': 0.0}
+
+
+	def summary(self):
+		s = dict(self.stats)
+		s['duration_s'] = self.T
+		s['battery_SOC_percent'] = self.soc
+		return s
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+#
+# Deterministic simulation of the zero export control loop, without any real devices.
+#
+# The unmodified controlLoop() of powerControlLoopAsync talks over HTTP and MQTT
+# to local stand-in devices (SimulatedDevices), which are backed by a simulated
+# house, inverter and battery (SimulatedPlant).
+#
+# Everything runs on a virtual clock: VirtualTimeEventLoop is an asyncio event
+# loop whose time() is virtual. Whenever no socket is ready and the loop would
+# otherwise wait for the next timer, virtual time jumps straight to that timer.
+# asyncio.sleep(), aiohttp timeouts and the control loop's DeadlineTickers all
+# follow the virtual time, so a day of operation takes minutes instead of a day,
+# and repeated runs with the same seed give the same result.
+#
+# Work done in threads (run_in_executor) does not hold back virtual time, so
+# the simulation runs without traffic recording.
+#
+# Usage:
+#   ./SimulationHarness.py --hours 24 --seed 1
+#   ./SimulationHarness.py --hours 2 --set settling_time_s=10 --set inverter_power_granularity_W=10 --verbose
+#   ./SimulationHarness.py --plant solar_inverter_max_W=350 --set "inverters=[{'name': 'pv', 'host': None, 'id': 2, 'battery': False}, {'name': 'bat', 'host': None, 'id': 1}]"
+#
+
+import argparse
+import ast
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import selectors
+import sys
+import time
+
+import powerControlLoopAsync
+from ControlScheduler import MonotonicClock
+from SimulatedPlant import SimulatedPlant
+from SimulatedDevices import SimulatedDevices
+
+
+class _VirtualTimeSelector(selectors.BaseSelector):
+	"""
+	Selector that polls the real sockets without blocking, and instead of
+	blocking advances the virtual time of the loop by the requested timeout.
+	"""
+
+	def __init__(self, loop):
+		self.loop = loop
+		self.selector = selectors.DefaultSelector()
+
+	def register(self, fileobj, events, data=None):
+		return self.selector.register(fileobj, events, data)
+
+	def unregister(self, fileobj):
+		return self.selector.unregister(fileobj)
+
+	def modify(self, fileobj, events, data=None):
+		return self.selector.modify(fileobj, events, data)
+
+	def get_map(self):
+		return self.selector.get_map()
+
+	def close(self):
+		self.selector.close()
+
+	def select(self, timeout=None):
+		ready = self.selector.select(0)
+		if ready or timeout == 0:
+			return ready
+		if timeout is None:
+			# no timer pending, only real I/O can wake the loop
+			return self.selector.select(None)
+		self.loop.virtual_time += timeout
+		return []
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+
+	def __init__(self, start_time=0.0):
+		self.virtual_time = float(start_time)
+		super().__init__(_VirtualTimeSelector(self))
+
+	def time(self):
+		return self.virtual_time
+
+
+class VirtualClock(MonotonicClock):
+	"""
+	Control loop clock on the event loop time, with a simulated wall clock.
+	"""
+
+	def __init__(self, start):
+		self.start = start
+		self.t0 = None
+
+	def now(self):
+		return asyncio.get_running_loop().time()
+
+	def wallclock(self):
+		if self.t0 is None:
+			self.t0 = self.now()
+		return self.start + datetime.timedelta(seconds=self.now() - self.t0)
+
+
+def configureControlLoop(hosts, settings=None):
+	"""
+	Point the control loop configuration at the stand-in devices, and apply
+	optional overrides of other configuration variables.
+	"""
+	pcl = powerControlLoopAsync
+	pcl.ahoydtu_host = hosts['dtu']
+	pcl.tibber_bridge_host = hosts['bridge']
+	pcl.steca_ac_host = hosts['mystrom']
+	pcl.bms_db_host, pcl.bms_db_port = hosts['influx'].split(':')
+	pcl.bms_db_port = int(pcl.bms_db_port)
+	pcl.mqtt_host, pcl.mqtt_port = hosts['mqtt'].split(':')
+	pcl.mqtt_port = int(pcl.mqtt_port)
+	pcl.record_traffic_file = None
+
+	for name, value in (settings or {}).items():
+		if not hasattr(pcl, name):
+			raise ValueError('powerControlLoopAsync has no setting %s' % (name))
+		setattr(pcl, name, value)
+
+	# several inverters: those without a host are on the stand-in DTU
+	for inv in (pcl.inverters or []):
+		if inv.get('host') is None:
+			inv['host'] = hosts['dtu']
+
+
+async def simulate(plant, duration_s, settings=None):
+	"""
+	Run the control loop against the plant for duration_s seconds of virtual time.
+	"""
+	devices = SimulatedDevices(plant, inverter_id=powerControlLoopAsync.ahoydtu_inverterId)
+	await devices.start()
+	configureControlLoop(devices.hosts, settings)
+
+	clock = VirtualClock(plant.start)
+	clock.wallclock()
+	task = asyncio.create_task(powerControlLoopAsync.controlLoop(clock))
+	try:
+		await asyncio.sleep(duration_s)
+	finally:
+		task.cancel()
+		[outcome] = await asyncio.gather(task, return_exceptions=True)
+		await devices.stop()
+	if isinstance(outcome, Exception):
+		raise outcome
+
+	plant.advance(devices.now())
+	result = plant.summary()
+	result['requests'] = devices.num_requests
+	result['mqtt_messages'] = devices.num_mqtt_messages
+	return result
+
+
+def runSimulation(duration_s=86400, seed=1, start=None, settings=None, plant_settings=None, verbose=False):
+	"""
+	Simulate duration_s seconds on a fresh virtual time event loop, return the plant summary.
+	Control loop output is discarded unless verbose.
+	"""
+	plant = SimulatedPlant(seed=seed, start=start, **(plant_settings or {}))
+	loop = VirtualTimeEventLoop()
+	try:
+		with open(os.devnull, 'w') as devnull:
+			with contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+				result = loop.run_until_complete(simulate(plant, duration_s, settings))
+		loop.run_until_complete(loop.shutdown_asyncgens())
+	finally:
+		loop.close()
+	return result
+
+
+def _parseSettings(items):
+	settings = {}
+	for item in items or []:
+		name, value = item.split('=', 1)
+		try:
+			settings[name] = ast.literal_eval(value)
+		except (ValueError, SyntaxError):
+			settings[name] = value
+	return settings
+
+
+if __name__ == '__main__':
+
+	ap = argparse.ArgumentParser(description='Run the zero export control loop against a simulated plant on virtual time.')
+	ap.add_argument('--hours', type=float, default=24.0, help='simulated duration (default 24)')
+	ap.add_argument('--seed', type=int, default=1, help='random seed of the house load (default 1)')
+	ap.add_argument('--start', default='2024-06-01T00:00:00', help='simulated local start time, ISO 8601')
+	ap.add_argument('--set', action='append', metavar='NAME=VALUE', help='override a powerControlLoopAsync setting')
+	ap.add_argument('--plant', action='append', metavar='NAME=VALUE', help='override a SimulatedPlant parameter, e.g. inverter_settling_s=10')
+	ap.add_argument('--verbose', action='store_true', help='show the control loop output')
+	args = ap.parse_args()
+
+	t0 = time.monotonic()
+	result = runSimulation(args.hours * 3600.0, args.seed, datetime.datetime.fromisoformat(args.start),
+		_parseSettings(args.set), _parseSettings(args.plant), args.verbose)
+	result['wallclock_s'] = time.monotonic() - t0
+
+	print(json.dumps(result, indent=2, sort_keys=True))
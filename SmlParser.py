@@ -0,0 +1,483 @@
+#!/usr/bin/python3
+#
+# Decoder for SML (Smart Message Language) frames as delivered by electricity
+# meters, e.g. via the Tibber Pulse / Tibber Bridge.
+#
+# A frame is parsed once, in a single pass over the TLV (type-length-value)
+# encoded data without copying it, and all SML_ListEntry elements are indexed
+# by their OBIS code, e.g. '1-0:16.7.0*255' for the net active power.
+# The CRC16 of the transport layer is checked.
+#
+# SmlMeterReadout holds the latest frame of a meter and extracts its readings,
+# None for a frame that fails to decode or the CRC check.
+#
+# SmlLayoutCache is the fast path for a stream of frames from the same meter:
+# once a frame layout has been decoded, the byte offsets of all values are
+# remembered, and later frames of the same layout are read directly with
+# precompiled struct.Struct.unpack_from() calls. A full parse is done only when
+# the layout fingerprint (frame length, OBIS names and value type bytes at the
+# remembered offsets) does not match.
+#
+# Frame layout (SML transport v1):
+#   1b1b1b1b 01010101  <SML messages>  <0..3 padding bytes 00>  1b1b1b1b 1a <#pad> <crc16>
+#
+# SML_ListEntry, a list of 7:
+#   objName (OBIS, 6 bytes), status, valTime, unit, scaler, value, valueSignature
+#
+# For details see https://github.com/volkszaehler/libsml and BSI TR-03109-1.
+#
+
+import struct
+
+SML_ESCAPE = b'\x1b\x1b\x1b\x1b'
+SML_START = SML_ESCAPE + b'\x01\x01\x01\x01'
+SML_END_MARK = SML_ESCAPE + b'\x1a'
+
+TYPE_OCTETS = 0
+TYPE_BOOL = 4
+TYPE_INT = 5
+TYPE_UINT = 6
+TYPE_LIST = 7
+
+# OBIS codes of interest
+OBIS_ENERGY_IMPORT = '1-0:1.8.0*255'     # Wh, total grid import
+OBIS_ENERGY_EXPORT = '1-0:2.8.0*255'     # Wh, total grid export
+OBIS_POWER = '1-0:16.7.0*255'            # W, net active power, P>0 import
+OBIS_POWER_L1 = '1-0:36.7.0*255'         # W, per phase
+OBIS_POWER_L2 = '1-0:56.7.0*255'
+OBIS_POWER_L3 = '1-0:76.7.0*255'
+
+# Fixed byte offsets of values in the frames of known meters, for meters whose frames
+# SmlParser can not decode: meter type -> {OBIS code: (struct, offset, decimal scaler)}
+METER_FIXED_OFFSETS = {
+	'LandisGyrE220': {
+		OBIS_POWER: (struct.Struct('>l'), 12*16 + 4 + 8, 0),
+		OBIS_ENERGY_IMPORT: (struct.Struct('>Q'), 10*16 + 8 + 8, -1),
+	},
+}
+
+# DLMS unit codes
+SML_UNITS = {27: 'W', 28: 'VA', 29: 'var', 30: 'Wh', 33: 'A', 35: 'V', 44: 'Hz'}
+
+
+def _makeCrcTable():
+	table = []
+	for n in range(256):
+		crc = n
+		for k in range(8):
+			crc = (crc >> 1) ^ 0x8408 if (crc & 1) else (crc >> 1)
+		table.append(crc)
+	return table
+
+_CRC_TABLE = _makeCrcTable()
+
+
+def crc16x25(data):
+	"""
+	CRC-16/X-25 as used by SML: reflected polynomial 0x1021, init and final XOR 0xFFFF.
+	"""
+	crc = 0xFFFF
+	table = _CRC_TABLE
+	for b in data:
+		crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+	return crc ^ 0xFFFF
+
+
+def obisName(code):
+	"""
+	Format a 6-byte OBIS code as 'A-B:C.D.E*F'.
+	"""
+	return '%d-%d:%d.%d.%d*%d' % tuple(code[:6])
+
+
+class SmlValue:
+
+	__slots__ = ('obis', 'unit', 'scaler', 'raw', 'offset', 'length', 'signed', 'name_offset')
+
+	def __init__(self, obis, unit, scaler, raw, offset, length, signed, name_offset=None):
+		self.obis = obis
+		self.unit = unit
+		self.scaler = scaler
+		self.raw = raw
+		self.offset = offset    # byte offset of the value payload within the frame
+		self.length = length    # payload length in bytes
+		self.signed = signed
+		self.name_offset = name_offset  # byte offset of the 6-byte OBIS code within the frame
+
+	@property
+	def value(self):
+		"""
+		Value with the scaler applied, i.e. raw * 10^scaler.
+		"""
+		if self.scaler < 0:
+			return self.raw / (10 ** -self.scaler)
+		if self.scaler > 0:
+			return self.raw * (10 ** self.scaler)
+		return self.raw
+
+	@property
+	def unitName(self):
+		return SML_UNITS.get(self.unit, str(self.unit))
+
+	def __repr__(self):
+		return '%s = %s %s' % (self.obis, str(self.value), self.unitName)
+
+
+def findFrame(data, start=0):
+	"""
+	Locate the next complete SML frame in data (bytes or bytearray) at or after 'start'.
+	Returns (begin, end) byte positions with end exclusive, or None.
+	"""
+	begin = data.find(SML_START, start)
+	if begin < 0:
+		return None
+
+	pos = begin + len(SML_START)
+	while True:
+		esc = data.find(SML_ESCAPE, pos)
+		if esc < 0 or esc + 8 > len(data):
+			return None
+		if data[esc+4] == 0x1a:
+			return (begin, esc + 8)
+		# Escaped escape sequence 1b1b1b1b 1b1b1b1b in the payload, skip it
+		pos = esc + 8
+
+
+def unescapeFrame(frame):
+	"""
+	Remove doubled escape sequences 1b1b1b1b 1b1b1b1b from the payload of a complete frame.
+	"""
+	frame = bytes(frame)
+	body = frame[8:-8].replace(SML_ESCAPE + SML_ESCAPE, SML_ESCAPE)
+	return frame[:8] + body + frame[-8:]
+
+
+def checkCrc(frame):
+	"""
+	Verify the CRC16 in the last two bytes of the frame, which cover everything before them.
+	"""
+	if len(frame) < 16:
+		return False
+	crc = crc16x25(memoryview(frame)[:-2])
+	stored = frame[-2] | (frame[-1] << 8)
+	return crc == stored
+
+
+def _readTL(buf, pos):
+	"""
+	Decode a type-length field, return (type, length, number of TL bytes).
+	For lists the length is the number of elements, otherwise the total
+	number of bytes including the TL bytes.
+	"""
+	b = buf[pos]
+	typ = (b >> 4) & 0x07
+	length = b & 0x0F
+	n = 1
+	while b & 0x80:
+		b = buf[pos + n]
+		length = (length << 4) | (b & 0x0F)
+		n += 1
+	return typ, length, n
+
+
+def _decodeInt(buf, off, length, signed):
+	if length <= 0:
+		return None
+	return int.from_bytes(buf[off:off+length], 'big', signed=signed)
+
+
+def _listEntry(buf, children, index):
+	"""
+	Index a finished 7-element list if it looks like an SML_ListEntry.
+	"""
+	name, status, valTime, unit, scaler, value, signature = children
+	if name[0] != TYPE_OCTETS or name[2] != 6:
+		return
+	if value[0] not in (TYPE_INT, TYPE_UINT, TYPE_BOOL):
+		return
+
+	obis = obisName(buf[name[1]:name[1]+6])
+	unit_code = _decodeInt(buf, unit[1], unit[2], False) if unit[0] == TYPE_UINT else None
+	scaler_exp = _decodeInt(buf, scaler[1], scaler[2], True) if scaler[0] == TYPE_INT else 0
+	signed = (value[0] == TYPE_INT)
+	raw = _decodeInt(buf, value[1], value[2], signed)
+	if raw is None:
+		return
+
+	index[obis] = SmlValue(obis, unit_code, scaler_exp or 0, raw, value[1], value[2], signed, name[1])
+
+
+def parseSmlFrame(frame, verify_crc=True):
+	"""
+	Parse one SML frame and return a dict of OBIS code -> SmlValue,
+	or None if the frame is malformed or fails the CRC check.
+	The value offsets in the result are relative to the start escape sequence of the frame.
+	"""
+	if not frame:
+		return None
+
+	if not isinstance(frame, (bytes, bytearray)):
+		frame = bytes(frame)
+
+	loc = findFrame(frame)
+	if loc is None:
+		print('SML frame incomplete, no start or end escape sequence found (%d bytes)' % (len(frame)))
+		return None
+
+	begin, end = loc
+	buf = memoryview(frame)[begin:end]
+	if verify_crc and not checkCrc(buf):
+		print('SML frame CRC error')
+		return None
+
+	if frame.find(SML_ESCAPE, begin + 8, end - 8) >= 0:
+		# rare: payload contains escaped escape sequences, decode a de-escaped copy
+		buf = memoryview(unescapeFrame(buf))
+
+	index = {}
+	stack = []   # open lists: [remaining elements, children]
+	pos = len(SML_START)
+	stop = len(buf) - 8 - buf[len(buf) - 3]   # strip end escape and padding
+
+	try:
+		while pos < stop:
+			if buf[pos] == 0x00:
+				# EndOfSmlMsg, the last element of an SML_Message list
+				node = (TYPE_OCTETS, pos + 1, 0)
+				pos += 1
+				is_list = False
+			else:
+				typ, length, n = _readTL(buf, pos)
+				is_list = (typ == TYPE_LIST)
+				if is_list:
+					node = (TYPE_LIST, pos, length)
+					pos += n
+				else:
+					if length < n:
+						raise ValueError('bad TL field 0x%02x at %d' % (buf[pos], pos))
+					node = (typ, pos + n, length - n)
+					pos += length
+
+			if stack:
+				stack[-1][0] -= 1
+				stack[-1][1].append(node)
+			if is_list:
+				stack.append([length, []])
+
+			# close completed lists, innermost first
+			while stack and stack[-1][0] <= 0:
+				remaining, children = stack.pop()
+				if len(children) == 7:
+					_listEntry(buf, children, index)
+
+		if pos > stop:
+			raise ValueError('last element exceeds frame')
+	except (IndexError, ValueError) as e:
+		print('SML frame decode error: %s' % (str(e)))
+		return None
+
+	return index
+
+
+_INT_STRUCTS = {
+	(1, True): struct.Struct('>b'), (2, True): struct.Struct('>h'), (4, True): struct.Struct('>l'), (8, True): struct.Struct('>q'),
+	(1, False): struct.Struct('>B'), (2, False): struct.Struct('>H'), (4, False): struct.Struct('>L'), (8, False): struct.Struct('>Q'),
+}
+
+
+class SmlLayoutCache:
+
+	def __init__(self, verify_crc=True, max_layouts=8):
+		self.verify_crc = verify_crc
+		self.max_layouts = max_layouts
+		self.layouts = {}   # frame length -> (checks, fields)
+		self.hits = 0
+		self.misses = 0
+
+
+	def _compile(self, frame, index):
+		"""
+		Turn the full parse result of a frame into a layout: fingerprint checks
+		(offset, expected bytes) and value fields (obis, struct, offset, length, signed, scaler).
+		"""
+		checks = []
+		fields = []
+		for obis, v in index.items():
+			checks.append((v.name_offset, bytes(frame[v.name_offset:v.name_offset+6])))
+			checks.append((v.offset - 1, bytes(frame[v.offset-1:v.offset])))  # TL byte of the value
+			fields.append((obis, _INT_STRUCTS.get((v.length, v.signed)), v.offset, v.length, v.signed, v.scaler))
+		return (checks, fields)
+
+
+	def _cacheable(self, frame):
+		"""
+		Offsets are reusable only for a bare frame without escaped escape sequences.
+		"""
+		n = len(frame)
+		return n >= 16 and frame[:8] == SML_START and frame[n-8:n-3] == SML_END_MARK and frame.find(SML_ESCAPE, 8, n - 8) < 0
+
+
+	def decode(self, frame):
+		"""
+		Return a dict of OBIS code -> scaled value for one frame, or None if it is invalid.
+		"""
+		if not frame:
+			return None
+		if not isinstance(frame, (bytes, bytearray)):
+			frame = bytes(frame)
+
+		layout = self.layouts.get(len(frame))
+		if layout is not None:
+			checks, fields = layout
+			for (off, expected) in checks:
+				if frame[off:off+len(expected)] != expected:
+					break
+			else:
+				if self.verify_crc and not checkCrc(frame):
+					print('SML frame CRC error')
+					return None
+				self.hits += 1
+				values = {}
+				for (obis, st, off, length, signed, scaler) in fields:
+					if st is not None:
+						raw = st.unpack_from(frame, off)[0]
+					else:
+						raw = int.from_bytes(frame[off:off+length], 'big', signed=signed)
+					if scaler < 0:
+						values[obis] = raw / (10 ** -scaler)
+					elif scaler > 0:
+						values[obis] = raw * (10 ** scaler)
+					else:
+						values[obis] = raw
+				return values
+
+		# Unknown or changed layout: full parse, then remember the layout
+		self.misses += 1
+		index = parseSmlFrame(frame, self.verify_crc)
+		if index is None:
+			return None
+		if index and self._cacheable(frame):
+			if len(self.layouts) >= self.max_layouts:
+				self.layouts.clear()
+			self.layouts[len(frame)] = self._compile(frame, index)
+
+		return {obis: v.value for obis, v in index.items()}
+
+
+class SmlMeterReadout:
+	"""
+	Readings of the latest SML frame of one meter, shared by LocalTibberQuery and
+	LocalTibberQueryAsync. Readings are None when the frame can not be decoded or
+	fails the CRC check, the frame should then be skipped. Fixed byte offsets are
+	used only when configured for a known meter, see METER_FIXED_OFFSETS.
+	"""
+
+	def __init__(self, meter_type=None):
+		self.smlframe = None
+		self.parsed_frame = None
+		self.readings = None
+		self.layout_cache = SmlLayoutCache()
+		self.decoded_frame = None
+		self.values = None
+		self.fixed_offsets = METER_FIXED_OFFSETS[meter_type] if meter_type else {}
+
+
+	def getReadings(self, smlframe=None):
+		"""
+		Decode the SML frame once and return its OBIS code -> SmlValue index,
+		e.g. getReadings()[OBIS_POWER].value. Returns None if the frame is invalid.
+		Repeated calls for the same frame reuse the index.
+		"""
+		if not smlframe:
+			smlframe = self.smlframe
+
+		if smlframe is not self.parsed_frame:
+			self.parsed_frame = smlframe
+			self.readings = parseSmlFrame(smlframe) if smlframe else None
+
+		return self.readings
+
+
+	def getValues(self, smlframe=None):
+		"""
+		Decode the SML frame via the layout cache and return a dict of OBIS code -> value,
+		or None if the frame is invalid. Once the layout of the meter's frames is known,
+		values are read from cached offsets instead of parsing every frame.
+		"""
+		if not smlframe:
+			smlframe = self.smlframe
+
+		if smlframe is not self.decoded_frame:
+			self.decoded_frame = smlframe
+			self.values = self.layout_cache.decode(smlframe) if smlframe else None
+
+		return self.values
+
+
+	def getValue(self, obis, smlframe=None):
+		"""
+		Return the value of one OBIS code, or None if the frame does not hold it.
+		Falls back to the configured fixed offset of the meter, for a frame with a valid CRC only.
+		"""
+		if not smlframe:
+			smlframe = self.smlframe
+
+		values = self.getValues(smlframe)
+		if values and obis in values:
+			return values[obis]
+
+		if obis not in self.fixed_offsets or not smlframe:
+			return None
+		st, offset, scaler = self.fixed_offsets[obis]
+		if len(smlframe) < offset + st.size or not checkCrc(smlframe):
+			return None
+		raw = st.unpack_from(smlframe, offset)[0]
+		return raw / (10 ** -scaler) if scaler < 0 else raw * (10 ** scaler)
+
+
+	def extractPowerReading(self, smlframe=None):
+		"""
+		Extract net active power reading (OBIS 1-0:16.7.0) from SML frame, in Watt, or None.
+		P>0 is drawn from the grid, P<0 is exported.
+		"""
+		return self.getValue(OBIS_POWER, smlframe)
+
+
+	def extractEnergyReading(self, smlframe=None):
+		"""
+		Extract the grid import energy counter (OBIS 1-0:1.8.0) from SML frame, in Wh, or None.
+		"""
+		E = self.getValue(OBIS_ENERGY_IMPORT, smlframe)
+		return float(E) if E is not None else None
+
+
+	def extractExportEnergyReading(self, smlframe=None):
+		"""
+		Extract the grid export energy counter (OBIS 1-0:2.8.0) from SML frame, in Wh, or None.
+		"""
+		E = self.getValue(OBIS_ENERGY_EXPORT, smlframe)
+		return float(E) if E is not None else None
+
+
+	def extractPhasePowerReadings(self, smlframe=None):
+		"""
+		Extract per-phase active power L1, L2, L3 in Watt; None for phases the meter does not report.
+		"""
+		values = self.getValues(smlframe)
+		if not values:
+			return [None, None, None]
+		return [values.get(obis) for obis in (OBIS_POWER_L1, OBIS_POWER_L2, OBIS_POWER_L3)]
+
+
+if __name__ == '__main__':
+
+	import sys
+
+	with open(sys.argv[1], 'rb') as f:
+		data = f.read()
+
+	readings = parseSmlFrame(data)
+	if readings is None:
+		sys.exit(1)
+	for obis in readings:
+		print(readings[obis])
@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+#
+# Local store of the Tibber energy prices, for the cost reports.
+#
+# Prices are kept per local day in a JSON file (price_cache_file), as a list of
+# [start, EUR/kWh] at the resolution of the Tibber API, hourly or quarter-hourly.
+# Once stored, the prices of a day are served from the file, also without network.
+#
+# Tibber publishes the prices of the next day at about publish_hour local time. The
+# day-ahead prices (today, tomorrow) are fetched at most once per publication window,
+# i.e. once between two publications, and not at all while the requested day cannot
+# be published yet. Missing days in the past are fetched with the price range query;
+# a day that the reply did not have (e.g. before the contract started) is not asked
+# for again within the same window, other days are. The times of the remote calls are
+# kept in the file as well; a call that got no reply (no network) does not count.
+#
+# Usage:
+#   ./TibberPriceCache.py                                    - prefetch today's and tomorrow's prices
+#   ./TibberPriceCache.py --from 2024-01-01 --to 2024-01-31  - fetch historical prices of these days
+#
+
+import asyncio
+import argparse
+import base64
+import datetime
+import json
+import os
+import time
+from zoneinfo import ZoneInfo
+
+from AsyncHttpPool import AsyncHttpPool
+
+tibber_token = "---api token---"
+tibber_api_url = "https://api.tibber.com/v1-beta/gql"
+price_cache_file = os.path.expanduser('~/.tibber_prices.json')
+price_resolution = 'QUARTER_HOURLY'   # or 'HOURLY'
+publish_hour = 13
+timezone = 'Europe/Berlin'
+
+RESOLUTION_S = {'HOURLY': 3600, 'QUARTER_HOURLY': 900}
+
+DAY_AHEAD_QUERY = "{ viewer { homes { currentSubscription { priceInfo(resolution: %s) { today { total startsAt } tomorrow { total startsAt } } } } } }"
+RANGE_QUERY = "{ viewer { homes { currentSubscription { priceInfoRange(resolution: %s, first: %d, after: \"%s\") { nodes { total startsAt } } } } } }"
+
+
+class TibberPriceCache:
+
+	def __init__(self, token=tibber_token, path=price_cache_file, pool=None, resolution=price_resolution, offline=False):
+		self.token = token
+		self.path = path
+		self.pool = pool
+		self.resolution = resolution
+		self.offline = offline
+		self.tz = ZoneInfo(timezone)
+		self.days = {}
+		self.fetched = {'day_ahead': 0, 'range': {}}   # range: time of the last query, by day
+		self.load()
+
+
+	def load(self):
+
+		try:
+			with open(self.path) as f:
+				stored = json.load(f)
+		except FileNotFoundError:
+			return
+		except ValueError as e:
+			print('Tibber price cache %s unreadable, starting empty: %s' % (self.path, str(e)))
+			return
+		self.days = stored.get('days', {})
+		self.fetched.update(stored.get('fetched', {}))
+		if not isinstance(self.fetched['range'], dict):
+			# single time stamp of earlier versions
+			self.fetched['range'] = {}
+
+
+	def save(self):
+
+		tmp = self.path + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump({'days': self.days, 'fetched': self.fetched}, f)
+		os.replace(tmp, self.path)
+
+
+	def _midnight(self, date):
+		return datetime.datetime.combine(date, datetime.time(0), tzinfo=self.tz)
+
+
+	def publicationWindow(self, now=None):
+		"""
+		Unix time of the latest price publication up to now.
+		"""
+		if now is None:
+			now = time.time()
+		local = datetime.datetime.fromtimestamp(now, self.tz)
+		published = datetime.datetime.combine(local.date(), datetime.time(publish_hour), tzinfo=self.tz)
+		if published > local:
+			published -= datetime.timedelta(days=1)
+		return published.timestamp()
+
+
+	def isPublished(self, date, now=None):
+		"""
+		True if the prices of a day are expected to be published by now.
+		"""
+		if now is None:
+			now = time.time()
+		published = datetime.datetime.combine(date - datetime.timedelta(days=1), datetime.time(publish_hour), tzinfo=self.tz)
+		return published.timestamp() <= now
+
+
+	def _store(self, nodes):
+		"""
+		Add API price nodes (startsAt, total) to their days, complete days only. Returns the days added.
+		"""
+		byday = {}
+		for node in nodes:
+			if node is None or node.get('total') is None:
+				continue
+			start = datetime.datetime.fromisoformat(node['startsAt'])
+			byday.setdefault(start.astimezone(self.tz).date(), []).append([start.timestamp(), float(node['total'])])
+
+		added = []
+		for date, prices in byday.items():
+			prices.sort()
+			if self._isComplete(date, prices):
+				self.days[date.isoformat()] = prices
+				added.append(date)
+		return added
+
+
+	def _isComplete(self, date, prices):
+
+		if len(prices) < 2:
+			return False
+		interval_s = prices[1][0] - prices[0][0]
+		day_s = self._midnight(date + datetime.timedelta(days=1)).timestamp() - self._midnight(date).timestamp()
+		return prices[0][0] == self._midnight(date).timestamp() and len(prices) * interval_s == day_s
+
+
+	async def _query(self, query):
+
+		if self.pool is None:
+			self.pool = AsyncHttpPool(timeout_s=30)
+		headers = {'Authorization': 'Bearer %s' % (self.token)}
+		j = await self.pool.postJSON(tibber_api_url, {'query': query}, headers=headers)
+		if j is None:
+			return None
+		if j.get('errors'):
+			print('Tibber API error: %s' % (str(j['errors'])))
+			return None
+		try:
+			return j['data']['viewer']['homes'][0]['currentSubscription']
+		except (KeyError, IndexError, TypeError):
+			print('Unexpected Tibber API reply: %s' % (str(j)))
+			return None
+
+
+	async def fetchDayAhead(self, now=None):
+		"""
+		Fetch today's and tomorrow's prices, unless already done in this publication window.
+		Returns the days added.
+		"""
+		if now is None:
+			now = time.time()
+		if self.offline or self.fetched['day_ahead'] >= self.publicationWindow(now):
+			return []
+
+		previous, self.fetched['day_ahead'] = self.fetched['day_ahead'], now
+		sub = await self._query(DAY_AHEAD_QUERY % (self.resolution))
+		added = []
+		if sub is None:
+			# nothing was fetched, e.g. no network, may retry
+			self.fetched['day_ahead'] = previous
+		else:
+			info = sub['priceInfo']
+			added = self._store((info.get('today') or []) + (info.get('tomorrow') or []))
+		self.save()
+		return added
+
+
+	async def fetchRange(self, first, last, now=None):
+		"""
+		Fetch the prices of those past days first..last that are not stored and were not
+		asked for in this publication window yet. Returns the days added.
+		"""
+		if now is None:
+			now = time.time()
+		window = self.publicationWindow(now)
+		asked = {day: T for day, T in self.fetched['range'].items() if T >= window}
+		days = [first + datetime.timedelta(days=n) for n in range((last - first).days + 1)]
+		days = [date for date in days if date.isoformat() not in self.days and date.isoformat() not in asked]
+		if self.offline or not days:
+			return []
+		first, last = days[0], days[-1]
+
+		interval_s = RESOLUTION_S[self.resolution]
+		start = self._midnight(first)
+		count = int((self._midnight(last + datetime.timedelta(days=1)).timestamp() - start.timestamp()) // interval_s)
+		before = datetime.datetime.fromtimestamp(start.timestamp() - interval_s, self.tz)
+		cursor = base64.b64encode(before.isoformat().encode()).decode()
+
+		sub = await self._query(RANGE_QUERY % (self.resolution, count, cursor))
+		if sub is None:
+			# nothing was fetched, e.g. no network, may retry
+			return []
+		added = self._store(sub['priceInfoRange'].get('nodes') or [])
+		asked.update({date.isoformat(): now for date in days})
+		self.fetched['range'] = asked
+		self.save()
+		return added
+
+
+	async def prefetch(self, first, last, now=None):
+		"""
+		Make sure the published prices of the days first..last are stored, with at most
+		one day-ahead and one range query.
+		"""
+		if now is None:
+			now = time.time()
+		today = datetime.datetime.fromtimestamp(now, self.tz).date()
+		days = [first + datetime.timedelta(days=n) for n in range((last - first).days + 1)]
+		missing = [date for date in days if date.isoformat() not in self.days and self.isPublished(date, now)]
+
+		if any(date >= today for date in missing):
+			await self.fetchDayAhead(now)
+		past = [date for date in missing if date < today and date.isoformat() not in self.days]
+		if past:
+			await self.fetchRange(past[0], past[-1], now)
+
+
+	def prices(self, date):
+		"""
+		Stored prices [EUR/kWh] of a day in time order, None if there are none.
+		"""
+		prices = self.days.get(date.isoformat())
+		if prices is None:
+			return None
+		return [price for start, price in prices]
+
+
+	async def close(self):
+		if self.pool is not None:
+			await self.pool.close()
+
+
+if __name__ == '__main__':
+
+	ap = argparse.ArgumentParser(description='Fetch Tibber prices into the local price cache.')
+	ap.add_argument('--from', dest='first', type=datetime.date.fromisoformat, help='first day, default today')
+	ap.add_argument('--to', dest='last', type=datetime.date.fromisoformat, help='last day, default tomorrow')
+	args = ap.parse_args()
+
+	async def main():
+		cache = TibberPriceCache()
+		today = datetime.date.today()
+		first = args.first if args.first is not None else today
+		last = args.last if args.last is not None else max(first, today + datetime.timedelta(days=1))
+		try:
+			await cache.prefetch(first, last)
+		finally:
+			await cache.close()
+		for n in range((last - first).days + 1):
+			date = first + datetime.timedelta(days=n)
+			prices = cache.prices(date)
+			if prices is None:
+				print('%s  no prices' % (date.isoformat()))
+			else:
+				print('%s  %d prices, %.4f to %.4f EUR/kWh, mean %.4f' % (date.isoformat(), len(prices), min(prices), max(prices), sum(prices) / len(prices)))
+
+	asyncio.run(main())
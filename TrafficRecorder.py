@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+#
+# Recording of the raw device traffic of the control loop (AhoyDTU JSON, Tibber
+# SML frames, MyStrom reports, Influx query results) into an append-only binary
+# log, for later replay.
+#
+# TrafficRecorder.record() only appends the response to an in-memory list and
+# never blocks. A background task hands the pending records every few seconds
+# to a worker thread that packs and writes them, so file I/O is kept out of the
+# control cycle. All file access goes through that one thread, one call at a
+# time. If the disk stalls, at most max_pending_bytes are buffered and newer
+# records are dropped (and counted).
+#
+# Log layout, all little-endian:
+#
+#   file header   b'TAHLOG\x00\x01' <d wall clock time> <d monotonic time>   (both at creation)
+#   record        <B kind> <H source id> <H status> <d monotonic time> <I length> <payload>
+#
+#   kind 1 SOURCE  payload is the name of a new source (e.g. 'GET http://.../api/live'),
+#                  its id is the number of SOURCE records before it
+#   kind 2 DATA    payload is a raw response, status is the HTTP status if any
+#   kind 3 INDEX   payload is <q offset of previous INDEX or -1>
+#                  <I n> n x (<d time> <q offset>) of the DATA records since the previous INDEX
+#                  <H m> m x (<H source id> <H length> <name>) of the sources added since then
+#                  <q own offset>
+#
+# An INDEX record is written after every index_every DATA records and on close.
+# The last 8 bytes of a cleanly closed log thus point to the last INDEX record,
+# from which all index blocks can be found by following the 'previous' offsets.
+# A log that was not closed cleanly (power cut) is read by a linear scan instead.
+#
+
+import asyncio
+import bisect
+import concurrent.futures
+import datetime
+import struct
+import time
+
+from ControlScheduler import MonotonicClock
+
+LOG_MAGIC = b'TAHLOG\x00\x01'
+
+KIND_SOURCE = 1
+KIND_DATA = 2
+KIND_INDEX = 3
+
+_FILE_HEADER = struct.Struct('<8sdd')
+_RECORD_HEADER = struct.Struct('<BHHdI')
+_INDEX_ENTRY = struct.Struct('<dq')
+_INDEX_SOURCE = struct.Struct('<HH')
+_OFFSET = struct.Struct('<q')
+_COUNT32 = struct.Struct('<I')
+_COUNT16 = struct.Struct('<H')
+
+
+class TrafficRecorder:
+
+	def __init__(self, filename, clock=None, flush_interval_s=2.0, index_every=1024, max_pending_bytes=8*1024*1024):
+		self.filename = filename
+		self.clock = clock if clock is not None else MonotonicClock()
+		self.flush_interval_s = float(flush_interval_s)
+		self.index_every = int(index_every)
+		self.max_pending_bytes = int(max_pending_bytes)
+
+		self.pending = []          # (source, status, T, payload)
+		self.pending_bytes = 0
+		self.num_recorded = 0
+		self.num_dropped = 0
+		self.task = None
+		self.executor = None
+		self.writing = None        # future of the write in progress
+
+		# state of the writer thread
+		self.file = None
+		self.sources = {}          # source name -> id
+		self.segment = []          # (T, offset) of DATA records since the last INDEX
+		self.segment_sources = []  # (id, encoded name) of sources added since the last INDEX
+		self.prev_index = -1
+
+
+	def record(self, source, payload, status=0, T=None):
+		"""
+		Queue one raw response for writing. Never blocks.
+		"""
+		if payload is None:
+			return
+		if isinstance(payload, str):
+			payload = payload.encode('utf-8')
+		if self.pending_bytes + len(payload) > self.max_pending_bytes:
+			self.num_dropped += 1
+			return
+		if T is None:
+			T = self.clock.now()
+		self.pending.append((source, status, T, bytes(payload)))
+		self.pending_bytes += len(payload)
+
+
+	async def start(self):
+		if self.task is None:
+			self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='TrafficRecorder')
+			await asyncio.get_running_loop().run_in_executor(self.executor, self._open)
+			self.task = asyncio.create_task(self._flushLoop())
+
+
+	async def stop(self):
+		"""
+		Write out everything still pending, append a final index and close the log.
+		"""
+		if self.task is None:
+			return
+		self.task.cancel()
+		try:
+			await self.task
+		except asyncio.CancelledError:
+			pass
+		self.task = None
+		# a write of the cancelled flush loop may still run in the worker thread
+		if self.writing is not None:
+			try:
+				await self.writing
+			except Exception as e:
+				print('Traffic recorder failed to write %s: %s' % (self.filename, repr(e)))
+		await self.flush()
+		await asyncio.get_running_loop().run_in_executor(self.executor, self._close)
+		self.executor.shutdown()
+		self.executor = None
+
+
+	async def flush(self):
+		"""
+		Hand the pending records to a worker thread for writing.
+		"""
+		if not self.pending:
+			return
+		batch, self.pending, self.pending_bytes = self.pending, [], 0
+		self.writing = asyncio.get_running_loop().run_in_executor(self.executor, self._write, batch)
+		# shielded: cancelling the caller does not abandon the write, stop() waits for it
+		await asyncio.shield(self.writing)
+
+
+	async def _flushLoop(self):
+		while True:
+			await asyncio.sleep(self.flush_interval_s)
+			try:
+				await self.flush()
+			except OSError as e:
+				print('Traffic recorder failed to write %s: %s' % (self.filename, str(e)))
+			except Exception as e:
+				print('Traffic recorder error while writing %s: %s' % (self.filename, repr(e)))
+
+
+	def _open(self):
+		self.file = open(self.filename, 'ab')
+		if self.file.tell() == 0:
+			self.file.write(_FILE_HEADER.pack(LOG_MAGIC, time.time(), self.clock.now()))
+		else:
+			# appending to an existing log: source ids restart, so start a fresh log instead
+			self.file.close()
+			stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+			self.filename = '%s.%s' % (self.filename, stamp)
+			self.file = open(self.filename, 'wb')
+			self.file.write(_FILE_HEADER.pack(LOG_MAGIC, time.time(), self.clock.now()))
+
+
+	def _write(self, batch):
+		"""
+		Pack and append a batch of records, runs in a worker thread.
+		"""
+		out = bytearray()
+		offset = self.file.tell()
+		for (source, status, T, payload) in batch:
+			sid = self.sources.get(source)
+			if sid is None:
+				sid = len(self.sources)
+				self.sources[source] = sid
+				name = source.encode('utf-8')
+				out += _RECORD_HEADER.pack(KIND_SOURCE, sid, 0, T, len(name))
+				out += name
+				self.segment_sources.append((sid, name))
+			self.segment.append((T, offset + len(out)))
+			out += _RECORD_HEADER.pack(KIND_DATA, sid, status, T, len(payload))
+			out += payload
+			if len(self.segment) >= self.index_every:
+				out += self._indexRecord(offset + len(out), T)
+		self.file.write(out)
+		self.file.flush()
+		self.num_recorded += len(batch)
+
+
+	def _indexRecord(self, offset, T):
+		payload = bytearray(_OFFSET.pack(self.prev_index))
+		payload += _COUNT32.pack(len(self.segment))
+		for entry in self.segment:
+			payload += _INDEX_ENTRY.pack(*entry)
+		payload += _COUNT16.pack(len(self.segment_sources))
+		for (sid, name) in self.segment_sources:
+			payload += _INDEX_SOURCE.pack(sid, len(name)) + name
+		payload += _OFFSET.pack(offset)
+		self.segment = []
+		self.segment_sources = []
+		self.prev_index = offset
+		return _RECORD_HEADER.pack(KIND_INDEX, 0, 0, T, len(payload)) + payload
+
+
+	def _close(self):
+		if self.file is None:
+			return
+		self.file.write(self._indexRecord(self.file.tell(), self.clock.now()))
+		self.file.close()
+		self.file = None
+
+
+class TrafficLogReader:
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = open(filename, 'rb')
+		hdr = self.file.read(_FILE_HEADER.size)
+		if len(hdr) < _FILE_HEADER.size or not hdr.startswith(LOG_MAGIC):
+			self.file.close()
+			raise ValueError('%s is not a traffic log' % (filename))
+		magic, self.start_wallclock, self.start_T = _FILE_HEADER.unpack(hdr)
+		self.sources = {}      # id -> name
+		self.index = None      # sorted list of (T, offset) of all DATA records
+		self.index_sources = {}
+
+
+	def close(self):
+		self.file.close()
+
+
+	def toWallclock(self, T):
+		"""
+		Convert a recorded monotonic time stamp to Unix time.
+		"""
+		return self.start_wallclock + (T - self.start_T)
+
+
+	def _readRecord(self, offset):
+		"""
+		Return (kind, source id, status, T, payload, next offset), or None at the end or a truncated record.
+		"""
+		self.file.seek(offset)
+		hdr = self.file.read(_RECORD_HEADER.size)
+		if len(hdr) < _RECORD_HEADER.size:
+			return None
+		kind, sid, status, T, length = _RECORD_HEADER.unpack(hdr)
+		payload = self.file.read(length)
+		if len(payload) < length:
+			return None
+		return (kind, sid, status, T, payload, offset + _RECORD_HEADER.size + length)
+
+
+	def _loadIndex(self):
+		"""
+		Collect the index blocks by following the chain back from the end of the log.
+		Returns False if the log was not closed cleanly.
+		"""
+		self.file.seek(0, 2)
+		size = self.file.tell()
+		if size < _FILE_HEADER.size + _RECORD_HEADER.size + 2*_OFFSET.size:
+			return False
+		self.file.seek(size - _OFFSET.size)
+		offset = _OFFSET.unpack(self.file.read(_OFFSET.size))[0]
+
+		segments = []
+		sources = {}
+		while offset >= 0:
+			if offset < _FILE_HEADER.size or offset >= size:
+				return False
+			r = self._readRecord(offset)
+			if r is None or r[0] != KIND_INDEX or _OFFSET.unpack_from(r[4], len(r[4]) - _OFFSET.size)[0] != offset:
+				return False
+			payload = r[4]
+			pos = _OFFSET.size
+			n = _COUNT32.unpack_from(payload, pos)[0]
+			pos += _COUNT32.size
+			segments.append([_INDEX_ENTRY.unpack_from(payload, pos + k*_INDEX_ENTRY.size) for k in range(n)])
+			pos += n * _INDEX_ENTRY.size
+			m = _COUNT16.unpack_from(payload, pos)[0]
+			pos += _COUNT16.size
+			for k in range(m):
+				sid, length = _INDEX_SOURCE.unpack_from(payload, pos)
+				pos += _INDEX_SOURCE.size
+				sources[sid] = bytes(payload[pos:pos+length]).decode('utf-8')
+				pos += length
+			offset = _OFFSET.unpack_from(payload, 0)[0]
+
+		self.index = [entry for seg in reversed(segments) for entry in seg]
+		self.index_sources = sources
+		return True
+
+
+	def _scan(self, offset=_FILE_HEADER.size):
+		"""
+		Yield (kind, source id, status, T, payload, offset) of all records from the given offset on.
+		"""
+		while True:
+			r = self._readRecord(offset)
+			if r is None:
+				return
+			kind, sid, status, T, payload, nxt = r
+			if kind == KIND_SOURCE:
+				self.sources[sid] = payload.decode('utf-8')
+			yield (kind, sid, status, T, payload, offset)
+			offset = nxt
+
+
+	def records(self, start_T=None, end_T=None, sources=None):
+		"""
+		Yield (T, source name, status, payload) of the recorded responses, in recording order.
+		Optionally only those between start_T and end_T, and whose source name contains
+		one of the strings in 'sources'.
+		"""
+		def wanted(sid):
+			if sources is None:
+				return True
+			name = self.sources.get(sid, '')
+			return any(s in name for s in sources)
+
+		first = _FILE_HEADER.size
+		if start_T is not None and (self.index is not None or self._loadIndex()):
+			# jump to the first response at or after start_T, source names come from the index
+			k = bisect.bisect_left(self.index, (start_T, -1))
+			if k >= len(self.index):
+				return
+			first = self.index[k][1]
+			self.sources.update(self.index_sources)
+
+		for (kind, sid, status, T, payload, offset) in self._scan(first):
+			if kind != KIND_DATA:
+				continue
+			if start_T is not None and T < start_T:
+				continue
+			if end_T is not None and T >= end_T:
+				return
+			if wanted(sid):
+				yield (T, self.sources.get(sid, ''), status, payload)
+
+
+if __name__ == '__main__':
+
+	import sys
+
+	log = TrafficLogReader(sys.argv[1])
+	counts = {}
+	for (T, source, status, payload) in log.records():
+		n, nbytes = counts.get(source, (0, 0))
+		counts[source] = (n + 1, nbytes + len(payload))
+	print('Log started %s' % (str(datetime.datetime.fromtimestamp(log.start_wallclock))))
+	for source in sorted(counts):
+		print('%8d responses %10d bytes  %s' % (counts[source][0], counts[source][1], source))
+	log.close()
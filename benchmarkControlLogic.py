@@ -0,0 +1,383 @@
+#!/usr/bin/python3
+#
+# Benchmark suite for zero export control strategies.
+#
+# Runs the decision logic of the control loop (as built by
+# powerControlLoopAsync.makeControlLogic()) against a SimulatedPlant and reports
+# per scenario and tuning
+#
+#   export_Wh, import_Wh     - energy fed into / drawn from the grid
+#   dtu_commands             - number of power limit and power state commands sent
+#   decision latency         - time spent per meter tick in SML decoding and decide() [us]
+#
+# as JSON, for comparing tunings and implementations, and for catching
+# regressions against an earlier result file (--baseline).
+#
+# Modes:
+#   logic    - fast closed loop on a virtual clock: every meter_interval_s the plant's
+#              SML frame is decoded and judged, DTU/BMS are polled every recheck_interval_s,
+#              and commands go through a DtuCommandQueue (coalescing, rate limit, settling
+#              pause, readback), like in controlLoop()
+#   harness  - the complete controlLoop() with HTTP and MQTT via SimulationHarness (slower)
+#
+# Load profiles are synthetic (seeded), or recorded:
+#   *.csv    - columns 'time' and 'load_W' [W]; a 'power_W' column as written by smlReplay.py
+#              is taken as the house load, i.e. the capture should be without inverter output
+#   traffic log (TrafficRecorder) - house load is the grid meter power plus the inverter AC power
+#
+# Usage:
+#   ./benchmarkControlLogic.py --hours 24 --seeds 1 2 3 > results.json
+#   ./benchmarkControlLogic.py --grid inverter_power_granularity_W=5,10 --grid settling_time_s=3,5,10
+#   ./benchmarkControlLogic.py --grid control_engine=proportional,pi,predictive --seeds 1 2 3
+#   ./benchmarkControlLogic.py --profile traffic-20240601.log --baseline results.json
+#
+
+import argparse
+import ast
+import asyncio
+import collections
+import contextlib
+import csv
+import datetime
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import powerControlLoopAsync
+from DtuCommandQueue import DtuCommandQueue
+from SimulationHarness import VirtualTimeEventLoop, VirtualClock, runSimulation
+from SmlParser import SmlLayoutCache, OBIS_POWER, OBIS_ENERGY_IMPORT
+from LocalTibberQueryAsync import powerWindowStats
+from SimulatedPlant import SimulatedPlant, AHOY_CH0_FIELDS, AHOY_CH_FIELDS
+from TrafficRecorder import TrafficLogReader, LOG_MAGIC
+
+# Result keys that are compared against a baseline, and whether smaller is better
+REGRESSION_KEYS = {'export_Wh': True, 'import_Wh': True, 'dtu_commands': True, 'latency_p99_us': True}
+
+
+def loadProfileCsv(filename):
+	"""
+	Read (T, load W) samples from a CSV file, T relative to the first sample.
+	"""
+	profile = []
+	with open(filename) as f:
+		for row in csv.DictReader(f):
+			W = row.get('load_W') or row.get('power_W')
+			if not W:
+				continue
+			profile.append((float(row['time']), float(W)))
+	if not profile:
+		return profile
+	T0 = profile[0][0]
+	return [(T - T0, W) for (T, W) in profile]
+
+
+def loadProfileTrafficLog(filename):
+	"""
+	Derive (T, load W) samples from a recorded traffic log: grid power of each
+	meter frame plus the AC power of the latest DTU reading.
+	"""
+	cache = SmlLayoutCache()
+	log = TrafficLogReader(filename)
+	fields = AHOY_CH0_FIELDS
+	P_ac = 0.0
+	profile = []
+	try:
+		for (T, source, status, payload) in log.records(sources=['data.json', '/api/live', '/api/inverter/id/']):
+			if status != 200:
+				continue
+			if '/api/live' in source:
+				fields = json.loads(payload)['ch0_fld_names']
+			elif '/api/inverter/id/' in source:
+				inv = json.loads(payload)
+				if inv.get('ch') and 'P_AC' in fields:
+					P_ac = float(inv['ch'][0][fields.index('P_AC')])
+			else:
+				values = cache.decode(payload)
+				if values and OBIS_POWER in values:
+					profile.append((T, values[OBIS_POWER] + P_ac))
+	finally:
+		log.close()
+	if not profile:
+		return profile
+	T0 = profile[0][0]
+	return [(T - T0, W) for (T, W) in profile]
+
+
+def loadProfile(filename):
+	with open(filename, 'rb') as f:
+		is_log = (f.read(len(LOG_MAGIC)) == LOG_MAGIC)
+	return loadProfileTrafficLog(filename) if is_log else loadProfileCsv(filename)
+
+
+@contextlib.contextmanager
+def controlSettings(settings):
+	"""
+	Temporarily override powerControlLoopAsync configuration variables.
+	"""
+	pcl = powerControlLoopAsync
+	saved = {}
+	for name, value in settings.items():
+		if not hasattr(pcl, name):
+			raise ValueError('powerControlLoopAsync has no setting %s' % (name))
+		saved[name] = getattr(pcl, name)
+		setattr(pcl, name, value)
+	try:
+		yield
+	finally:
+		for name, value in saved.items():
+			setattr(pcl, name, value)
+
+
+class PlantDtu:
+	"""
+	DTU stand-in for a DtuCommandQueue, applies the commands to the plant at the virtual time.
+	"""
+
+	def __init__(self, plant, clock):
+		self.plant = plant
+		self.clock = clock
+
+	async def setPowerLimit(self, P_W):
+		self.plant.setPowerLimit(self.clock.now(), P_W)
+		return {'success': True}
+
+	async def setPowerState(self, powerEnabled=True):
+		self.plant.setPowerState(self.clock.now(), powerEnabled)
+		return {'success': True}
+
+
+async def _logicLoop(plant, duration_s, clock, latencies):
+	"""
+	Closed loop of decision logic and plant, one meter tick per meter_interval_s of virtual
+	time. DTU commands go through a DtuCommandQueue like in controlLoop(). Returns the number of ticks.
+	"""
+	pcl = powerControlLoopAsync
+	logic = pcl.makeControlLogic()
+	cache = SmlLayoutCache()
+	fields = AHOY_CH0_FIELDS
+	i_Pac, i_Vdc = fields.index('P_AC'), AHOY_CH_FIELDS.index('U_DC')
+	max_W = plant.inverters[0].max_W
+
+	def on_sent(kind, value):
+		if kind == 'power_limit':
+			logic.noteCommandSent(clock.now(), value)
+
+	queue = DtuCommandQueue(PlantDtu(plant, clock), clock, commands_per_min=pcl.dtu_commands_per_min,
+		burst=pcl.dtu_command_burst, settling_time_s=pcl.settling_time_s, tolerance_W=pcl.inverter_power_granularity_W,
+		confirm_timeout_s=pcl.dtu_confirm_timeout_s, on_sent=on_sent)
+	sender = asyncio.create_task(queue.run())
+
+	history = collections.deque(maxlen=120)
+	last = {'dtu_T': 0.0, 'dtu_Vdc': 0.0, 'dtu_Pac': 0.0}
+	next_poll_T = 0.0
+
+	plant.setPowerState(0.0, True)
+	T0 = clock.now()
+	n = 0
+	try:
+		while True:
+			T = n * pcl.meter_interval_s
+			if T >= duration_s:
+				break
+			n += 1
+			await clock.sleep_until(T0 + T)
+
+			if T >= next_poll_T:
+				inv = plant.inverterData(T)
+				bms = plant.bmsValues(T)
+				last.update({'dtu_T': T, 'dtu_Vdc': float(inv['ch'][1][i_Vdc]), 'dtu_Pac': float(inv['ch'][0][i_Pac]),
+					'bmsVolt': bms['solar/data/Battery_Voltage'], 'bmsPower': bms['solar/data/Battery_Power'],
+					'bmsSOC': bms['solar/data/Percent_Remain'], 'stecaCharge': plant.steca_ac_charging})
+				queue.noteReadback(float(inv['power_limit_read']) * max_W / 100.0, T0 + T)
+				next_poll_T += pcl.recheck_interval_s
+
+			frame = plant.meterFrame(T)
+
+			t0 = time.perf_counter()
+			values = cache.decode(frame)
+			history.append((T, values[OBIS_POWER], values[OBIS_ENERGY_IMPORT]))
+			stats = powerWindowStats(history, pcl.meter_window_s, T)
+			sample = dict(last)
+			sample.update({'T': T, 'hour': int(plant.hourOfDay(T)), 'meter_T': T,
+				'meter_P': values[OBIS_POWER], 'meter_E': values[OBIS_ENERGY_IMPORT], 'meter_slope': stats['slope'],
+				'dtu_busy': queue.isBusy()})
+			cmds = logic.decide(sample)
+			latencies.append(time.perf_counter() - t0)
+
+			for (kind, value) in cmds:
+				if kind == 'power_limit':
+					queue.setPowerLimit(value)
+				elif kind == 'power_state':
+					queue.setPowerState(value)
+				elif kind == 'steca_enable':
+					plant.steca_enabled = bool(value)
+	finally:
+		sender.cancel()
+		await asyncio.gather(sender, return_exceptions=True)
+	return n
+
+
+def runLogicBenchmark(plant, duration_s):
+	"""
+	Closed loop of decision logic and plant, on a virtual time event loop.
+	Returns (per-tick latencies in seconds, number of ticks).
+	"""
+	latencies = []
+	loop = VirtualTimeEventLoop()
+	try:
+		n = loop.run_until_complete(_logicLoop(plant, duration_s, VirtualClock(plant.start), latencies))
+	finally:
+		loop.close()
+	plant.advance(duration_s)
+	return latencies, n
+
+
+def runScenario(mode, duration_s, seed, profile, settings, plant_settings):
+
+	plant_kwargs = dict(plant_settings)
+	if profile is not None:
+		plant_kwargs['load_profile'] = profile
+
+	t0 = time.perf_counter()
+	latencies = []
+	with controlSettings(settings):
+		if mode == 'logic':
+			plant = SimulatedPlant(seed=seed, **plant_kwargs)
+			with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+				latencies, ticks = runLogicBenchmark(plant, duration_s)
+			summary = plant.summary()
+		else:
+			summary = runSimulation(duration_s, seed, settings=settings, plant_settings=plant_kwargs)
+			ticks = int(duration_s / powerControlLoopAsync.meter_interval_s)
+	wall_s = time.perf_counter() - t0
+
+	result = {
+		'export_Wh': round(summary['export_Wh'], 3),
+		'import_Wh': round(summary['import_Wh'], 3),
+		'abs_grid_Wh': round(summary['abs_grid_Wh'], 3),
+		'export_s': round(summary['export_s'], 1),
+		'inverter_Wh': round(summary['inverter_Wh'], 3),
+		'dtu_commands': summary['limit_commands'] + summary['power_commands'],
+		'limit_commands': summary['limit_commands'],
+		'power_commands': summary['power_commands'],
+		'ticks': ticks,
+		'wall_s': round(wall_s, 3),
+	}
+	if latencies:
+		lat_us = sorted(1e6 * x for x in latencies)
+		result.update({
+			'latency_mean_us': round(statistics.fmean(lat_us), 2),
+			'latency_p50_us': round(lat_us[len(lat_us) // 2], 2),
+			'latency_p99_us': round(lat_us[min(len(lat_us) - 1, int(0.99 * len(lat_us)))], 2),
+			'latency_max_us': round(lat_us[-1], 2),
+		})
+	return result
+
+
+def compareBaseline(results, baseline, tolerance):
+	"""
+	Return descriptions of results that are worse than the matching baseline result by more than tolerance.
+	"""
+	def key(r):
+		return (r['scenario'], json.dumps(r['settings'], sort_keys=True))
+
+	base = {key(r): r for r in baseline.get('results', [])}
+	regressions = []
+	for r in results:
+		b = base.get(key(r))
+		if b is None:
+			continue
+		for name, smaller_is_better in REGRESSION_KEYS.items():
+			if name not in r or name not in b:
+				continue
+			old, new = b[name], r[name]
+			limit = old * (1 + tolerance) + (1e-9 if old == 0 else 0)
+			if smaller_is_better and new > limit:
+				regressions.append('%s %s: %s %s -> %s' % (r['scenario'], json.dumps(r['settings'], sort_keys=True), name, old, new))
+	return regressions
+
+
+def _parseValue(text):
+	try:
+		return ast.literal_eval(text)
+	except (ValueError, SyntaxError):
+		return text
+
+
+def _parseGrid(items):
+	"""
+	['name=v1,v2', ...] -> list of settings dicts, the cartesian product of all values.
+	"""
+	names, choices = [], []
+	for item in items or []:
+		name, values = item.split('=', 1)
+		names.append(name)
+		choices.append([_parseValue(v) for v in values.split(',')])
+	return [dict(zip(names, combo)) for combo in itertools.product(*choices)]
+
+
+if __name__ == '__main__':
+
+	ap = argparse.ArgumentParser(description='Benchmark zero export control strategies on a simulated plant, results as JSON.')
+	ap.add_argument('--mode', choices=['logic', 'harness'], default='logic')
+	ap.add_argument('--hours', type=float, default=24.0, help='simulated duration per scenario (default 24, or the length of a recorded profile)')
+	ap.add_argument('--seeds', type=int, nargs='+', default=[1], help='seeds of the synthetic load scenarios')
+	ap.add_argument('--profile', action='append', help='recorded load profile, CSV or traffic log (instead of synthetic load)')
+	ap.add_argument('--grid', action='append', metavar='NAME=V1,V2,..', help='powerControlLoopAsync setting values to benchmark, all combinations are run')
+	ap.add_argument('--plant', action='append', metavar='NAME=VALUE', help='SimulatedPlant parameter, e.g. inverter_settling_s=10')
+	ap.add_argument('--output', help='write the JSON results to this file instead of stdout')
+	ap.add_argument('--baseline', help='earlier JSON results to compare against, exit code 1 on regressions')
+	ap.add_argument('--tolerance', type=float, default=0.05, help='relative tolerance for --baseline (default 0.05)')
+	args = ap.parse_args()
+
+	plant_settings = {}
+	for item in args.plant or []:
+		name, value = item.split('=', 1)
+		plant_settings[name] = _parseValue(value)
+
+	scenarios = []
+	if args.profile:
+		for filename in args.profile:
+			profile = loadProfile(filename)
+			if not profile:
+				print('No load samples in %s' % (filename), file=sys.stderr)
+				sys.exit(1)
+			duration_s = min(args.hours * 3600.0, profile[-1][0]) if args.hours else profile[-1][0]
+			scenarios.append((os.path.basename(filename), 1, profile, duration_s))
+	else:
+		for seed in args.seeds:
+			scenarios.append(('synthetic-seed%d' % (seed), seed, None, args.hours * 3600.0))
+
+	results = []
+	for (name, seed, profile, duration_s) in scenarios:
+		for settings in _parseGrid(args.grid):
+			r = runScenario(args.mode, duration_s, seed, profile, settings, plant_settings)
+			r.update({'scenario': name, 'mode': args.mode, 'duration_s': duration_s, 'settings': settings})
+			results.append(r)
+			print('%-24s %-50s export %8.1f Wh  import %8.1f Wh  %5d commands  %.1f s' % (name, json.dumps(settings, sort_keys=True),
+				r['export_Wh'], r['import_Wh'], r['dtu_commands'], r['wall_s']), file=sys.stderr)
+
+	output = {
+		'meta': {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+			'machine': platform.machine(), 'plant': plant_settings},
+		'results': results,
+	}
+	text = json.dumps(output, indent=2, sort_keys=True)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(text + '\n')
+	else:
+		print(text)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			regressions = compareBaseline(results, json.load(f), args.tolerance)
+		for line in regressions:
+			print('Regression: %s' % (line), file=sys.stderr)
+		if regressions:
+			sys.exit(1)
@@ -1,142 +1,173 @@
 #!/usr/bin/python3
+#
+# Daily energy and cost report: solar output consumed in the house (off-grid Steca,
+# on-grid and grid-support HM-350), grid import and export, valued at the Tibber
+# hourly prices.
+#
+# The series of the three databases ('controllers', 'hoymiles350', 'sensors') and
+# the Tibber prices are fetched concurrently, with the async InfluxDB client that
+# LocalInfluxdbQueryAsync uses, each query with a timeout of query_timeout_s. Series
+# come from the influxdbRollups.py rollups where present, else from the raw data.
+# Prices come from the local TibberPriceCache, which fetches missing published days.
+# Date ranges are reported day by day, max_concurrent_days at a time.
+#
+# Usage:
+#   ./influxdbCalcCosts.py                                   - report of today
+#   ./influxdbCalcCosts.py --from 2024-01-01 --to 2024-01-31 - report of each day and the totals
+#   ./influxdbCalcCosts.py --offline                         - use stored prices only
+#
+
+import asyncio
+import argparse
+import datetime
+from aioinflux import InfluxDBClient, InfluxDBError
 
-import influxdb
-from influxdb import InfluxDBClient
+import numpy as np
 
-import tibber
+import EnergyMath
+from TibberPriceCache import TibberPriceCache
 
-import time
-import datetime
-import calendar
+from influxdbRollups import ROLLUP_SERIES, localDayRange, rollupStartStatement, parseRollupStart, rollupCovers, coverageStatements, rollupHasGaps, hourlyEnergyStatements, parseHourlyEnergy
 
-tibber_token = "---api token---"
 ql_timezone = "tz('Europe/Berlin')"
 influxdb1host = "localhost"
 influxdb1port = 8086
 
+query_timeout_s = 30
+max_concurrent_days = 4
 
-def getTibberHourlyPriceToday():
+# raw data fallback: power is averaged over this interval [s] before it is summed up
+# per hour, and split into import and export
+raw_grouping_s = {'offgrid': 3600, 'gridsupport': 3600, 'balkonsolar': 3600, 'house': 60}
 
-	tibber_account = tibber.Account(tibber_token)
-	tibber_home = tibber_account.homes[0]
-	tibber_sub = tibber_home.current_subscription
-	price_data = tibber_sub.price_info
-	#for prices in price_data.today:
-	#	print(prices.starts_at, prices.total)
-	cost_eur_kWh = [priceinfo.total for priceinfo in price_data.today]
-	if len(cost_eur_kWh) != 24:
-		print("Tibber API: unexpected non-24 length of Account::homes[0]::current_subscription::price_info::today->[%d items] = %s" % (len(cost_eur_kWh), str(cost_eur_kWh)))
+# start of the hourly rollup of each series, one query per run
+_rollup_starts = {}
 
-	return cost_eur_kWh
 
+async def queryPoints(db, q, epoch='s'):
+	"""
+	Points of each statement of q as lists of dicts, times as Unix time in units of 'epoch'.
+	"""
+	result = await asyncio.wait_for(db.query(q, epoch=epoch), query_timeout_s)
+	points = []
+	for res in result['results']:
+		pts = []
+		for series in res.get('series', []):
+			pts += [dict(zip(series['columns'], row)) for row in series['values']]
+		points.append(pts)
+	return points
 
-def getOffgridHourlyOutput(db, year=2023, month=1, day=1):
 
-	template_AC_W = "SELECT mean(value) FROM autogen.solar WHERE (topic::tag = 'solar/data/Steca_Load_W') "
-	template_AC_W += "AND time >= '%s' and time < '%s' + 1d "
-	template_AC_W += "GROUP BY time(1h) fill(0) " + ql_timezone
+async def getRollupStart(db, name):
 
-	datestr = '%d-%02d-%02d' % (year, month, day)
-	q_AC_W = template_AC_W % (datestr, datestr)
+	if name not in _rollup_starts:
+		_rollup_starts[name] = asyncio.ensure_future(queryPoints(db, rollupStartStatement(name), epoch='s'))
+	future = _rollup_starts[name]
 	try:
-		ac_load = db.query(q_AC_W)
-		pts = list(ac_load.get_points())
-	except influxdb1.exceptions.Influxdb1ClientError as cli_err:
-		pts = [{'mean':0}]
-		print(cli_err)
-		return 0.0
-
-	E_kWh = [1e-3*float(pt['mean']) if pt['mean'] is not None else 0 for pt in pts]
-
-	return E_kWh
-
-
-def getGridsupportHourlyOutput(db, year=2023, month=1, day=1):
-
-	template_AC_W = "SELECT mean(value) FROM autogen.mqtt_consumer WHERE (topic::tag = 'ahoy/hm350night/ch0/P_AC') "
-	template_AC_W += "AND time >= '%s' and time < '%s' + 1d "
-	template_AC_W += "GROUP BY time(1h) fill(0) " + ql_timezone
-
-	datestr = '%d-%02d-%02d' % (year, month, day)
-	q_AC_W = template_AC_W % (datestr, datestr)
-	try:
-		ac_load = db.query(q_AC_W)
-		pts = list(ac_load.get_points())
-	except influxdb1.exceptions.Influxdb1ClientError as cli_err:
-		pts = [{'mean':0}]
-		print(cli_err)
-		return 0.0
-
-	E_kWh = [1e-3*float(pt['mean']) if pt['mean'] is not None else 0 for pt in pts]
-
-	return E_kWh
-
-
-def getBalkonsolarHourlyOutput(db, year=2023, month=1, day=1):
-
-	template_AC_W = "SELECT mean(value) FROM autogen.mqtt_consumer WHERE (topic::tag = 'ahoy/hm350/ch0/P_AC') "
-	template_AC_W += "AND time >= '%s' and time < '%s' + 1d "
-	template_AC_W += "GROUP BY time(1h) fill(0) " + ql_timezone
-
-	datestr = '%d-%02d-%02d' % (year, month, day)
-	q_AC_W = template_AC_W % (datestr, datestr)
-	try:
-		ac_load = db.query(q_AC_W)
-		pts = list(ac_load.get_points())
-	except influxdb1.exceptions.Influxdb1ClientError as cli_err:
-		pts = [{'mean':0}]
-		print(cli_err)
-		return 0.0
-
-	E_kWh = [1e-3*float(pt['mean']) if pt['mean'] is not None else 0 for pt in pts]
-
-	return E_kWh
-
-
-def getHouseHourlyDraw(db, year=2023, month=1, day=1):
-
-	template_AC_W = "SELECT mean(value) FROM autogen.local_tibber WHERE (topic::tag = 'local_tibber/power') "
-	template_AC_W += "AND time >= '%s' and time < '%s' + 1d "
-	template_AC_W += "GROUP BY time(1m) fill(0) " + ql_timezone
-
-	datestr = '%d-%02d-%02d' % (year, month, day)
-	q_AC_W = template_AC_W % (datestr, datestr)
-	try:
-		ac_load = db.query(q_AC_W)
-		pts = list(ac_load.get_points())
-	except influxdb1.exceptions.Influxdb1ClientError as cli_err:
-		pts = [{'mean':0}]
-		print(cli_err)
-		return 0.0
-
-	E_Wmin = [float(pt['mean']) if pt['mean'] is not None else 0 for pt in pts]
-	E_Wmin_import = [E if E>0 else 0 for E in E_Wmin]
-	E_Wmin_export = [-E if E<0 else 0 for E in E_Wmin]
-
-	E_kWh_import = [0] * 24
-	E_kWh_export = [0] * 24
-	h = 0
-	while h < 24:
-		istart = h*60
-		istop = min(istart + 60, len(E_Wmin_import))
-		if istart >= len(E_Wmin_import):
-			break
-		E_kWh_import[h] = sum(E_Wmin_import[istart:istop]) / 60.0e3
-		E_kWh_export[h] = sum(E_Wmin_export[istart:istop]) / 60.0e3
-		h += 1
-
-	return (E_kWh_import, E_kWh_export)
+		points = await asyncio.shield(future)
+	except Exception as e:
+		# a failed query is not kept, the next day asks again
+		if _rollup_starts.get(name) is future:
+			del _rollup_starts[name]
+		if isinstance(e, (InfluxDBError, asyncio.TimeoutError)):
+			# no rollup retention policy in this database, or no answer in time: use the raw data
+			return None
+		raise
+	return parseRollupStart(points[0])
+
+
+async def getRawHourlyEnergy(db, name, date):
+	"""
+	Energy per local hour of a day from the raw power readings, like influxdbRollups.parseHourlyEnergy().
+	"""
+	series = ROLLUP_SERIES[name]
+	grouping_s = raw_grouping_s[name]
+
+	q = "SELECT mean(value) FROM %s WHERE (topic::tag = '%s') AND %s GROUP BY time(%ds) fill(none) %s"
+	points = (await queryPoints(db, q % (series['measurement'], series['topic'], localDayRange(date, date), grouping_s, ql_timezone), epoch='s'))[0]
+	t = np.array([pt['time'] for pt in points], dtype=float)
+	P_W = np.array([pt['mean'] for pt in points], dtype=float)
+
+	edges = EnergyMath.localBinEdges(date, date)[0]
+	total, imported, exported = EnergyMath.binEnergy(t, P_W, edges, grouping_s)
+	return {'Wh': total, 'import_Wh': imported, 'export_Wh': exported}
+
+
+async def getHourlyEnergy(db, name, date):
+	"""
+	Energy [kWh] per local hour of a day: dict of arrays 'kWh', 'import_kWh' and 'export_kWh'.
+	"""
+	energy = None
+	if rollupCovers(await getRollupStart(db, name), date):
+		statements = hourlyEnergyStatements(name, date, date)
+		points = await queryPoints(db, ';'.join(coverageStatements(name, date, date) + [q for q, columns in statements]))
+		if not rollupHasGaps(points[0], points[1]):
+			energy = parseHourlyEnergy(statements, points[2:])
+	if energy is None:
+		energy = await getRawHourlyEnergy(db, name, date)
+
+	return {field.replace('Wh', 'kWh'): 1e-3 * np.asarray(values, dtype=float) for field, values in energy.items()}
 
 
 def floatlistStr(floats):
 	return ' '.join(['%.2f' % f for f in floats])
 
 
-def dotProduct(a, b):
-	if len(a) != len(b):
-		print("Error: non-identical vector lenghts, a=%s b=%s" % (str(a),str(b)))
-		return 0
-	return sum(ab[0] * ab[1] for ab in zip(a, b))
+async def getDayReport(dbs, date, prices=None):
+	"""
+	Energies [kWh] and costs [EUR] of a day as a dict, None if a query failed.
+	Costs are left out without the prices of the day.
+	"""
+	names = ('offgrid', 'balkonsolar', 'gridsupport', 'house')
+	queries = [getHourlyEnergy(dbs[ROLLUP_SERIES[name]['database']], name, date) for name in names]
+	if prices is not None:
+		queries.append(prices)
+
+	results = await asyncio.gather(*queries, return_exceptions=True)
+	for name, result in zip(names + ('prices',), results):
+		if isinstance(result, asyncio.TimeoutError):
+			print('%s: %s query timed out after %d s' % (date.isoformat(), name, query_timeout_s))
+		elif isinstance(result, Exception):
+			print('%s: %s query failed: %s' % (date.isoformat(), name, str(result)))
+	if any(isinstance(result, Exception) for result in results[:len(names)]):
+		return None
+	energy = dict(zip(names, results))
+	price_hourly = results[-1] if prices is not None and not isinstance(results[-1], Exception) else None
+
+	series_kWh = {'offgrid': energy['offgrid']['kWh'], 'ongrid': energy['balkonsolar']['kWh'], 'gridsupport': energy['gridsupport']['kWh'],
+		'export': energy['house']['export_kWh'], 'import': energy['house']['import_kWh']}
+	report = {key + '_kWh': float(E_kWh.sum()) for key, E_kWh in series_kWh.items()}
+	report['selfconsumed_kWh'] = report['offgrid_kWh'] + report['ongrid_kWh'] + report['gridsupport_kWh']
+
+	if price_hourly is not None:
+		costs = {key: EnergyMath.priceWeighted(E_kWh, price_hourly) for key, E_kWh in series_kWh.items()}
+		if all(cost is not None for cost in costs.values()):
+			report.update({key + '_cost': float(cost.sum()) for key, cost in costs.items()})
+			report['selfconsumed_cost'] = report['offgrid_cost'] + report['ongrid_cost'] + report['gridsupport_cost']
+
+	return report
+
+
+def printReport(report):
+
+	def line(label, key):
+		if key.replace('kWh', 'cost') in report:
+			print("%-20s: %.2f kWh, %.2f €" % (label, report[key], report[key.replace('kWh', 'cost')]))
+		else:
+			print("%-20s: %.2f kWh" % (label, report[key]))
+
+	line("Off-grid Output", 'offgrid_kWh')
+	line("On-grid Output", 'ongrid_kWh')
+	line("Grid Support Output", 'gridsupport_kWh')
+	line("Generated Consumed", 'selfconsumed_kWh')
+	line("Grid Export (lost)", 'export_kWh')
+	line("Grid Import (paid)", 'import_kWh')
+	print("------------------------------------------")
+	if 'import_cost' in report:
+		print("Cost %.2f €  Saved %.2f €  Missed %.2f €" % (report['import_cost'], report['selfconsumed_cost'], report['export_cost']))
+	autarcy = EnergyMath.autarky(report['selfconsumed_kWh'], report['import_kWh'])
+	if not np.isnan(autarcy):
+		print("Autarcy %.0f %%" % (autarcy))
 
 
 def writeEndOfDayData(db, imported_kWh, imported_cost, selfconsumed_kWh, selfconsumed_costsaved):
@@ -157,41 +188,65 @@ def writeEndOfDayData(db, imported_kWh, imported_cost, selfconsumed_kWh, selfcon
 		#db.write_points(datapoints)
 
 
+async def main(first, last, offline=False):
 
-db_steca = InfluxDBClient(influxdb1host, influxdb1port, '', '', 'controllers')
-db_hoymiles = InfluxDBClient(influxdb1host, influxdb1port, '', '', 'hoymiles350')
-db_tibber = InfluxDBClient(influxdb1host, influxdb1port, '', '', 'sensors')
-
-now = datetime.datetime.now()
-
-offgrid_hourlyE = getOffgridHourlyOutput(db_steca, now.year, now.month, now.day)
-ongrid_hourlyE = getBalkonsolarHourlyOutput(db_hoymiles, now.year, now.month, now.day)
-gridsupport_hourlyE = getGridsupportHourlyOutput(db_hoymiles, now.year, now.month, now.day)
-(house_hourlyE_import, house_hourlyE_export) = getHouseHourlyDraw(db_tibber, now.year, now.month, now.day)
-
-tibber_price_hourly = getTibberHourlyPriceToday()
+	dbs = {name: InfluxDBClient(host=influxdb1host, port=influxdb1port, username='', password='', db=name, mode='async')
+		for name in ('controllers', 'hoymiles350', 'sensors')}
 
-saved_offgrid = dotProduct(tibber_price_hourly, offgrid_hourlyE)
-saved_ongrid = dotProduct(tibber_price_hourly, ongrid_hourlyE)
-saved_gridsupport = dotProduct(tibber_price_hourly, gridsupport_hourlyE)
-saved_total = saved_offgrid + saved_ongrid + saved_gridsupport
-lost_export = dotProduct(tibber_price_hourly, house_hourlyE_export)
-cost_import = dotProduct(tibber_price_hourly, house_hourlyE_import)
+	cache = TibberPriceCache(offline=offline)
+	prefetch = asyncio.ensure_future(asyncio.wait_for(cache.prefetch(first, last), query_timeout_s))
+	limit = asyncio.Semaphore(max_concurrent_days)
 
-total_self_consumption = sum(offgrid_hourlyE) + sum(ongrid_hourlyE) + sum(gridsupport_hourlyE)
-total_imported = sum(house_hourlyE_import)
+	async def getPrices(date):
+		try:
+			await asyncio.shield(prefetch)
+		except asyncio.TimeoutError:
+			pass
+		return cache.prices(date)
 
-autarcy = 100.0 * total_self_consumption / (total_self_consumption + total_imported)
-
-print("Off-grid Output     : %.2f kWh, %.2f €" % (sum(offgrid_hourlyE), saved_offgrid))
-print("On-grid Output      : %.2f kWh, %.2f €" % (sum(ongrid_hourlyE), saved_ongrid))
-print("Grid Support Output : %.2f kWh, %.2f €" % (sum(gridsupport_hourlyE), saved_gridsupport))
-print("Generated Consumed  : %.2f kWh, %.2f €" % (total_self_consumption, saved_total))
-print("Grid Export (lost)  : %.2f kWh, %.2f €" % (sum(house_hourlyE_export), lost_export))
-print("Grid Import (paid)  : %.2f kWh, %.2f €" % (sum(house_hourlyE_import), cost_import))
-print("------------------------------------------")
-print("Cost %.2f €  Saved %.2f €  Missed %.2f €" % (cost_import, saved_total, lost_export))
-print("Autarcy %.0f %%" % (autarcy))
-
-writeEndOfDayData(db_steca, total_imported, cost_import, total_self_consumption, saved_total)
+	async def reportDay(date):
+		async with limit:
+			return await getDayReport(dbs, date, getPrices(date))
 
+	days = [first + datetime.timedelta(days=n) for n in range((last - first).days + 1)]
+	try:
+		reports = await asyncio.gather(*[reportDay(date) for date in days])
+	finally:
+		for db in dbs.values():
+			await db.close()
+		if prefetch.done() and not prefetch.cancelled() and isinstance(prefetch.exception(), asyncio.TimeoutError):
+			print('Tibber prices: no reply within %d s, using stored prices' % (query_timeout_s))
+		await cache.close()
+
+	for date, report in zip(days, reports):
+		if report is None:
+			continue
+		if len(days) > 1:
+			print("\n%s" % (date.isoformat()))
+		printReport(report)
+
+	if len(days) > 1:
+		valid = [report for report in reports if report is not None]
+		totals = {key: sum(report[key] for report in valid) for key in valid[0] if all(key in report for report in valid)} if valid else {}
+		if totals:
+			print("\nTotal of %d days, %d failed" % (len(valid), len(days) - len(valid)))
+			printReport(totals)
+
+	today = datetime.date.today()
+	if today in days and reports[days.index(today)] is not None and 'import_cost' in reports[days.index(today)]:
+		report = reports[days.index(today)]
+		writeEndOfDayData(dbs['controllers'], report['import_kWh'], report['import_cost'], report['selfconsumed_kWh'], report['selfconsumed_cost'])
+
+
+if __name__ == '__main__':
+
+	ap = argparse.ArgumentParser(description='Report of the daily energy flows and their costs.')
+	ap.add_argument('--from', dest='first', type=datetime.date.fromisoformat, help='first day, default today')
+	ap.add_argument('--to', dest='last', type=datetime.date.fromisoformat, help='last day, default the first day')
+	ap.add_argument('--offline', action='store_true', help='do not fetch prices, use the stored ones')
+	args = ap.parse_args()
+
+	first = args.first if args.first is not None else datetime.date.today()
+	last = args.last if args.last is not None else first
+
+	asyncio.run(main(first, last, args.offline))
@@ -1,124 +1,258 @@
 #!/usr/bin/python3
+#
+# Daily energy yields of the Steca AC output, from the 'solar/data/Steca_Load_W'
+# power readings in InfluxDB, and their running total 'Steca_YieldTotal'.
+#
+# The yield of a day is the sum of 20-second mean power values over the local day.
+# Yields are computed server-side for a whole date range at once: the 20 s means
+# of a subquery are summed per day with GROUP BY time(1d) tz(...), so that days
+# with a DST change have their 23 or 25 hours.
+#
+# Each day's yield is kept as a checkpoint in 'derived' (tag checkpoint=yield_day)
+# together with the number of raw readings of that day, for the complete days only
+# (up to yesterday, or today after 20:00 UT), which are added to the total. Only
+# days whose raw reading count differs from their checkpoint (new days, late
+# arriving data) are recomputed. Backfilling a year takes a few queries.
+#
+# The total is stored with the last day it includes ('last_day'); the next run adds
+# the days after it. For totals stored without it, that day is derived from the time
+# of storing, like the last complete day of a run at that time. Days up to the last
+# included day that were never checkpointed are not recomputed, their share of the
+# total can not be told apart.
+#
+# Where the hourly rollup of influxdbRollups.py covers the days, the yields are
+# summed up from it instead of the raw readings (1 min instead of 20 s means).
+#
+# Usage:
+#   ./influxdbCalcYields.py                                  - add the days since the stored total
+#   ./influxdbCalcYields.py --from 2023-01-01 --to 2023-12-31  - backfill/check day checkpoints
+#
 
 from influxdb import InfluxDBClient
-import time
+from influxdb.exceptions import InfluxDBClientError
+import argparse
 import datetime
 import calendar
+from zoneinfo import ZoneInfo
 
-ql_timezone = "tz('Europe/Berlin')"
+from influxdbRollups import localDayRange, queryDailyEnergy
+
+timezone = 'Europe/Berlin'
+ql_timezone = "tz('%s')" % (timezone)
 dbhost = "localhost"
 dbport = 8086
 
+yield_topic = 'solar/data/Steca_Load_W'
+t_grouping_sec = 20          # power readings are averaged over this interval before summing up
+max_days_per_query = 184     # longer date ranges are split into several queries
+recheck_days = 7             # days before the stored total to check for late arriving data
 
-def getYieldOfDay(db, year=2023, month=1, day=1):
 
-	t_grouping_sec = 20
+def _days(first, last):
+	return [first + datetime.timedelta(days=n) for n in range((last - first).days + 1)]
+
+
+def _pointsByDay(resultset, column):
+
+	daily = {}
+	for pt in resultset.get_points():
+		if pt.get(column) is not None:
+			daily[datetime.date.fromisoformat(pt['time'][:10])] = pt[column]
+	return daily
+
+
+def queryDailyCounts(db, first, last):
+	"""
+	Number of raw power readings per local day, {date: count}.
+	"""
+	q = "SELECT count(value) FROM autogen.solar WHERE (topic::tag = '%s') AND %s GROUP BY time(1d) %s"
+	return _pointsByDay(db.query(q % (yield_topic, localDayRange(first, last), ql_timezone)), 'count')
+
+
+def queryDailyYields(db, first, last):
+	"""
+	Energy yield [kWh] per local day of first..last in one query, {date: kWh}.
+	Taken from the hourly rollup if there is one for these days.
+	"""
+	rollup = queryDailyEnergy(db, 'offgrid', first, last)
+	if rollup is not None:
+		return {day: 1e-3 * Wh for day, Wh in rollup.items()}
+
+	trange = localDayRange(first, last)
+	q = "SELECT sum(mean_W) FROM (SELECT mean(value) AS mean_W FROM autogen.solar WHERE (topic::tag = '%s') AND %s GROUP BY time(%ds)) "
+	q += "WHERE %s GROUP BY time(1d) %s"
+	sums = _pointsByDay(db.query(q % (yield_topic, trange, t_grouping_sec, trange, ql_timezone)), 'sum')
+	return {day: 1e-3 * W * t_grouping_sec / 3600.0 for day, W in sums.items()}
+
+
+def queryCheckpoints(db, first, last):
+	"""
+	Stored day checkpoints, {date: (kWh, raw reading count)}.
+	"""
+	q = "SELECT value, raw_count FROM derived WHERE checkpoint = 'yield_day' AND %s %s"
+	checkpoints = {}
+	for pt in db.query(q % (localDayRange(first, last), ql_timezone)).get_points():
+		checkpoints[datetime.date.fromisoformat(pt['time'][:10])] = (pt['value'], pt['raw_count'])
+	return checkpoints
+
+
+def writeCheckpoints(db, yields, counts):
+
+	tz = ZoneInfo(timezone)
+	points = []
+	for day, E_kWh in yields.items():
+		tstamp = datetime.datetime.combine(day, datetime.time(0), tzinfo=tz).astimezone(datetime.timezone.utc)
+		points.append({"measurement": "derived", "tags": {"checkpoint": "yield_day"}, "time": tstamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+			"fields": {'value': float(E_kWh), 'raw_count': int(counts.get(day, 0))}})
+	if points:
+		db.write_points(points)
+
+
+def updateDailyYields(db, first, last):
+	"""
+	Yields of the local days first..last, {date: (kWh, previous checkpoint kWh or None)}.
+	Only days whose raw data changed since their checkpoint are recomputed and checkpointed.
+	"""
+	result = {}
+	chunk_first = first
+	while chunk_first <= last:
+		chunk_last = min(last, chunk_first + datetime.timedelta(days=max_days_per_query - 1))
+
+		counts = queryDailyCounts(db, chunk_first, chunk_last)
+		stored = queryCheckpoints(db, chunk_first, chunk_last)
+		changed = [day for day in _days(chunk_first, chunk_last) if day not in stored or stored[day][1] != counts.get(day, 0)]
+
+		yields = {}
+		if changed:
+			computed = queryDailyYields(db, changed[0], changed[-1])
+			yields = {day: computed.get(day, 0.0) for day in changed}
+			writeCheckpoints(db, yields, counts)
 
-	template_AC_W = "SELECT mean(value) FROM autogen.solar WHERE (topic::tag = 'solar/data/Steca_Load_W') "
-	template_AC_W += "AND time >= '%s' and time < '%s' + 1d "
-	template_AC_W += "GROUP BY time(%ds) fill(null) " + ql_timezone
+		for day in _days(chunk_first, chunk_last):
+			previous = stored[day][0] if day in stored else None
+			result[day] = (yields[day], previous) if day in yields else (previous, previous)
 
-	datestr = '%d-%02d-%02d' % (year, month, day)
-	q_AC_W = template_AC_W % (datestr, datestr, t_grouping_sec)
-	# print(q_AC_W)
+		chunk_first = chunk_last + datetime.timedelta(days=1)
 
+	return result
+
+
+def getYieldOfDay(db, year=2023, month=1, day=1):
+
+	date = datetime.date(year, month, day)
 	try:
-		ac_load = db.query(q_AC_W)
-		pts = list(ac_load.get_points())
-	except influxdb.exceptions.InfluxDBClientError as cli_err:
-		pts = [{'mean':None}]
+		E_kWh = queryDailyYields(db, date, date).get(date, 0.0)
+	except InfluxDBClientError as cli_err:
 		print(cli_err)
 		return 0.0
 
-	vals = [pt['mean'] if  pt['mean'] is not None else 0 for pt in pts]
-
-	E_Ws = sum(vals) * t_grouping_sec
-	E_kWh = 1e-3 * E_Ws * (1 / 3600.0)
-
 	if E_kWh > 0:
-		print('%s  %.2f kWh' % (datestr, E_kWh))
+		print('%s  %.2f kWh' % (date.isoformat(), E_kWh))
 
 	return E_kWh
 
 
 def getYieldOfMonth(db, year=2023, month=1, start_day=1):
 
-	E_kWh_sum = 0
-	metered_days = 0
-	unmetered_days = 0
-
 	daysInMonth = calendar.monthrange(year,month)[1]
+	yields = queryDailyYields(db, datetime.date(year, month, start_day), datetime.date(year, month, daysInMonth))
 
-	for daynr in range(start_day, daysInMonth):
-		# NB: loop ends at daynr = end_day|daysInMonth - 1, since Influx query covers daynr to daynr+1d
-
-		E_kWh = getYieldOfDay(db, year, month, daynr)
-		if E_kWh > 0:
-			E_kWh_sum += E_kWh
-			metered_days += 1
-		else:
-			unmetered_days += 1
+	E_kWh_sum = sum(E_kWh for E_kWh in yields.values() if E_kWh > 0)
+	metered_days = len([E_kWh for E_kWh in yields.values() if E_kWh > 0])
+	unmetered_days = daysInMonth - start_day + 1 - metered_days
 
 	print('During %d-%02d the inverter was active on %d days, idle on %d days, total yield %.2f kWh' % (year, month, metered_days, unmetered_days, E_kWh_sum))
 
 	return E_kWh_sum
 
 
-def queryLatestTotal(db):
+def lastCompleteDay(Tutc):
+	"""
+	Last day whose yield is complete at UT time Tutc: today after 20:00 UT, else yesterday.
+	"""
+	if Tutc.hour >= 20:
+		return Tutc.date()
+	return Tutc.date() + datetime.timedelta(days=-1)
 
-	query = "SELECT last(value) from derived where (topic = 'Steca_YieldTotal')"
+
+def queryLatestTotal(db):
+	"""
+	Latest stored total: (UT time of storing, kWh, last day included), or (None, 0.0, None).
+	"""
+	query = "SELECT value, last_day from derived where (topic = 'Steca_YieldTotal') ORDER BY time DESC LIMIT 1"
 	latest = db.query(query)
 
 	pts = list(latest.get_points())
 	if len(pts) <= 0:
-		return {'last':0.0, 'time':'0'}
+		return None, 0.0, None
 
 	vals = pts[-1]
-	dtime = datetime.datetime.strptime(vals['time'], '%Y-%m-%dT%H:%M:%SZ')
-	data = vals['last']
+	dtime = datetime.datetime.strptime(vals['time'][:19], '%Y-%m-%dT%H:%M:%S')
+	data = vals['value']
+	if vals.get('last_day'):
+		last_day = datetime.date.fromisoformat(vals['last_day'])
+	else:
+		last_day = lastCompleteDay(dtime)
 
-	return dtime, data
+	return dtime, data, last_day
 
 
-def writeLatestTotal(db, total_kWh):
+def writeLatestTotal(db, total_kWh, last_day):
 
 	Tnow = datetime.datetime.utcnow()
 	tstamp = Tnow.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-	datapoint = [{"measurement":"derived", "time":tstamp, "fields":{'topic':'Steca_YieldTotal', 'value':total_kWh}}]
+	datapoint = [{"measurement":"derived", "time":tstamp, "fields":{'topic':'Steca_YieldTotal', 'value':total_kWh, 'last_day':last_day.isoformat()}}]
 
 	db.write_points(datapoint)
 
 
+if __name__ == '__main__':
 
-db = InfluxDBClient(dbhost, dbport, '', '', 'controllers')
-
+	ap = argparse.ArgumentParser(description='Update the daily and total Steca AC yields in InfluxDB.')
+	ap.add_argument('--from', dest='first', type=datetime.date.fromisoformat, help='first day to check, default: %d days before the stored total' % (recheck_days))
+	ap.add_argument('--to', dest='last', type=datetime.date.fromisoformat, help='last day to check, default: yesterday, or today after 20:00 UT')
+	args = ap.parse_args()
 
-E_timestamp, E_kWh = queryLatestTotal(db)
-print('Latest reading  %.2f kWh  stored on UT %s' % (E_kWh, E_timestamp))
+	db = InfluxDBClient(dbhost, dbport, '', '', 'controllers')
 
-new_days = 0
-next_timestamp = E_timestamp.date() + datetime.timedelta(days=1)
+	E_timestamp, E_kWh, total_date = queryLatestTotal(db)
+	if E_timestamp is not None:
+		print('Latest reading  %.2f kWh  stored on UT %s, up to %s' % (E_kWh, E_timestamp, total_date.isoformat()))
 
-now = datetime.datetime.utcnow()
-if now.hour >= 20:
 	# Include data of "today" only if already close to midnight,
 	# else postpone adding "todays" data until a later time
-	ending_date = now.date()
-else:
-	ending_date = now.date() + datetime.timedelta(days=-1)
-
-while next_timestamp <= ending_date:
-
-	E_day_kWh = getYieldOfDay(db, next_timestamp.year, next_timestamp.month, next_timestamp.day)
-	if E_day_kWh > 0:
-		new_days += 1
-		E_kWh += E_day_kWh
-
-	next_timestamp = next_timestamp + datetime.timedelta(days=1)
-
-if new_days > 0:
-
-	print("Updated energy reading by %d new days for a total of %.2f kWh" % (new_days, E_kWh))
-
-	writeLatestTotal(db, E_kWh)
+	ending_date = lastCompleteDay(datetime.datetime.utcnow())
+
+	first = args.first
+	if first is None:
+		first = total_date - datetime.timedelta(days=recheck_days) if total_date is not None else ending_date
+	if total_date is not None and first > total_date + datetime.timedelta(days=1):
+		# days after the stored total can not be skipped, they would never be added
+		first = total_date + datetime.timedelta(days=1)
+	last = args.last if args.last is not None else ending_date
+	if last > ending_date:
+		# an incomplete day would be checkpointed without being added to the total,
+		# and its data so far would be missing from the total later on
+		print('Days after %s are not complete yet, checking up to %s only' % (ending_date.isoformat(), ending_date.isoformat()))
+		last = ending_date
+
+	# Days up to the last day of the stored total are in it already, only their changes count.
+	# Days without an earlier checkpoint were counted by the stored total as they were.
+	new_days, changed_days = 0, 0
+	for day, (E_day_kWh, previous_kWh) in sorted(updateDailyYields(db, first, last).items()):
+		if total_date is not None and day <= total_date:
+			if previous_kWh is not None and E_day_kWh != previous_kWh:
+				print('%s  %.2f kWh, was %.2f kWh' % (day.isoformat(), E_day_kWh, previous_kWh))
+				E_kWh += E_day_kWh - previous_kWh
+				changed_days += 1
+		elif E_day_kWh > 0:
+			print('%s  %.2f kWh' % (day.isoformat(), E_day_kWh))
+			E_kWh += E_day_kWh
+			new_days += 1
+
+	if new_days > 0 or changed_days > 0:
+
+		print("Updated energy reading by %d new days and %d changed days for a total of %.2f kWh" % (new_days, changed_days, E_kWh))
+
+		writeLatestTotal(db, E_kWh, max(last, total_date) if total_date is not None else last)
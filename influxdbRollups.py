@@ -0,0 +1,351 @@
+#!/usr/bin/python3
+#
+# Downsampled energy series (rollups) in InfluxDB, maintained by continuous queries.
+#
+# The report scripts (influxdbCalcCosts.py, influxdbCalcYields.py) need energy per hour
+# or per day. Aggregating the raw power readings for that scans every point; the rollups
+# instead keep, per ROLLUP_SERIES entry and in the database of its raw data,
+#
+#   rollup_1m.energy  - 'Wh' per minute: mean power of the minute / 60
+#                       (retention policy of rollup_1m_days days)
+#   rollup_1h.energy  - 'Wh' per hour: sum of the minute values, also split into
+#                       'import_Wh' (minutes of P>0) and 'export_Wh' (minutes of P<0, positive)
+#                       (kept forever)
+#
+# tagged with the 'topic' of the raw series. Continuous queries fill them as data comes
+# in, with RESAMPLE FOR to pick up late points; backfillRollups() fills them for older
+# data, the hourly rollup directly from the raw data since the minute rollup expires.
+# Backfills start at the first whole day still within the retention of the raw data,
+# and the minute rollup is backfilled only for days within its own retention.
+# Minutes without any reading count as 0 Wh.
+#
+# queryHourlyEnergy() and queryDailyEnergy() read from the rollups when they cover the
+# requested days and return None otherwise, the report scripts then fall back to raw data.
+# Hours the hourly continuous queries have not rolled up yet, e.g. the current one, are
+# summed up from the minute rollup.
+# The rollups cover days from their start on, unless an hour with raw data is missing in
+# the hourly rollup (rollupHasGaps()), e.g. because the continuous queries did not run.
+#
+# Usage:
+#   ./influxdbRollups.py --provision                           - create/update retention policies and continuous queries
+#   ./influxdbRollups.py --backfill 2023-01-01 2024-06-30      - compute the rollups of these days from raw data
+#
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+import argparse
+import datetime
+import re
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from EnergyMath import localBinEdges, binValues
+
+timezone = 'Europe/Berlin'
+ql_timezone = "tz('%s')" % (timezone)
+dbhost = "localhost"
+dbport = 8086
+
+rollup_1m_days = 400
+
+# Raw power [W] series to roll up, by name
+ROLLUP_SERIES = {
+	'offgrid':     {'database': 'controllers', 'measurement': 'autogen.solar', 'topic': 'solar/data/Steca_Load_W'},
+	'gridsupport': {'database': 'hoymiles350', 'measurement': 'autogen.mqtt_consumer', 'topic': 'ahoy/hm350night/ch0/P_AC'},
+	'balkonsolar': {'database': 'hoymiles350', 'measurement': 'autogen.mqtt_consumer', 'topic': 'ahoy/hm350/ch0/P_AC'},
+	'house':       {'database': 'sensors', 'measurement': 'autogen.local_tibber', 'topic': 'local_tibber/power'},
+}
+
+# first rollup hour of a series and database, looked up once per run
+_coverage = {}
+
+
+def _localDayBounds(first, last):
+
+	tz = ZoneInfo(timezone)
+	start = datetime.datetime.combine(first, datetime.time(0), tzinfo=tz)
+	end = datetime.datetime.combine(last + datetime.timedelta(days=1), datetime.time(0), tzinfo=tz)
+	return start, end
+
+
+def _timeCondition(start, end):
+	return "time >= '%s' AND time < '%s'" % (start.isoformat(), end.isoformat())
+
+
+def localDayRange(first, last):
+	"""
+	InfluxQL time condition covering the local days first..last.
+	"""
+	return _timeCondition(*_localDayBounds(first, last))
+
+
+def _minuteSelect(name, into='', cond=''):
+
+	series = ROLLUP_SERIES[name]
+	return "SELECT mean(value) / 60 AS Wh %sFROM %s WHERE topic::tag = '%s'%s GROUP BY time(1m), topic" % (into, series['measurement'], series['topic'], cond)
+
+
+def rollupStatements(name):
+	"""
+	SELECT ... INTO statements of a series, {name: (statement, RESAMPLE clause)}, minute rollup first.
+	"""
+	where = "topic::tag = '%s'" % (ROLLUP_SERIES[name]['topic'])
+	return {
+		'cq_%s_1m' % (name): (_minuteSelect(name, into='INTO rollup_1m.energy '), "RESAMPLE FOR 5m"),
+		'cq_%s_1h' % (name): ("SELECT sum(Wh) AS Wh INTO rollup_1h.energy FROM rollup_1m.energy WHERE %s GROUP BY time(1h), topic" % (where),
+			"RESAMPLE EVERY 1h FOR 2h"),
+		'cq_%s_1h_import' % (name): ("SELECT sum(Wh) AS import_Wh INTO rollup_1h.energy FROM rollup_1m.energy WHERE %s AND Wh > 0 GROUP BY time(1h), topic" % (where),
+			"RESAMPLE EVERY 1h FOR 2h"),
+		'cq_%s_1h_export' % (name): ("SELECT sum(Wh) * -1 AS export_Wh INTO rollup_1h.energy FROM rollup_1m.energy WHERE %s AND Wh < 0 GROUP BY time(1h), topic" % (where),
+			"RESAMPLE EVERY 1h FOR 2h"),
+	}
+
+
+def provisionRollups(db, database):
+	"""
+	Create the retention policies and (re)create continuous queries whose definition changed.
+	"""
+	db.query('CREATE RETENTION POLICY rollup_1m ON "%s" DURATION %dd REPLICATION 1' % (database, rollup_1m_days))
+	db.query('CREATE RETENTION POLICY rollup_1h ON "%s" DURATION INF REPLICATION 1' % (database))
+
+	# the server keeps the statements with quoted, fully qualified names
+	existing = {}
+	for pt in db.query('SHOW CONTINUOUS QUERIES').get_points(measurement=database):
+		existing[pt['name']] = pt['query'].replace('"', '').replace('%s.' % (database), '').replace(' ', '')
+
+	for name, series in ROLLUP_SERIES.items():
+		if series['database'] != database:
+			continue
+		for cq, (select, resample) in rollupStatements(name).items():
+			if cq in existing and ('%sBEGIN%sEND' % (resample, select)).replace(' ', '') in existing[cq]:
+				continue
+			if cq in existing:
+				print('Updating continuous query %s' % (cq))
+				db.query('DROP CONTINUOUS QUERY %s ON "%s"' % (cq, database))
+			else:
+				print('Creating continuous query %s' % (cq))
+			db.query('CREATE CONTINUOUS QUERY %s ON "%s" %s BEGIN %s END' % (cq, database, resample, select))
+
+
+def backfillStatements(name, first, last, minutes_too=True):
+	"""
+	SELECT ... INTO statements that compute the rollups of the local days first..last from the
+	raw data, the minute rollup only if minutes_too. The hourly rollup is summed up from minute
+	means of a subquery, not from the minute rollup, which holds only the last rollup_1m_days days.
+	"""
+	trange = " AND %s" % (localDayRange(first, last))
+	minutes = _minuteSelect(name, cond=trange)
+	statements = []
+	if minutes_too:
+		statements.append(_minuteSelect(name, into='INTO rollup_1m.energy ', cond=trange))
+	q = "SELECT %s INTO rollup_1h.energy FROM (%s) WHERE %s%s GROUP BY time(1h), topic"
+	statements.append(q % ('sum(Wh) AS Wh', minutes, localDayRange(first, last), ''))
+	statements.append(q % ('sum(Wh) AS import_Wh', minutes, localDayRange(first, last), ' AND Wh > 0'))
+	statements.append(q % ('sum(Wh) * -1 AS export_Wh', minutes, localDayRange(first, last), ' AND Wh < 0'))
+	return statements
+
+
+def retentionDays(db, policy):
+	"""
+	Duration [days] of a retention policy of the database of db, None if infinite or unknown.
+	"""
+	for rp in db.get_list_retention_policies():
+		if rp['name'] == policy:
+			hours = re.match(r'(\d+)h', rp['duration'])
+			if hours and int(hours.group(1)) > 0:
+				return int(hours.group(1)) // 24
+	return None
+
+
+def backfillRollups(db, name, first, last, days_per_query=7):
+	"""
+	Compute the rollups of a series for the local days first..last from its raw data.
+	Days no longer completely within the retention of the raw data are skipped, their
+	rollups would be partial. The minute rollup is written only for days within its retention.
+	"""
+	today = datetime.date.today()
+	raw_days = retentionDays(db, ROLLUP_SERIES[name]['measurement'].split('.')[0])
+	if raw_days is not None and first <= today - datetime.timedelta(days=raw_days):
+		first = today - datetime.timedelta(days=raw_days - 1)
+		print('%s: raw data is kept for %d days, rolling up from %s on' % (name, raw_days, first.isoformat()))
+	minutes_first = today - datetime.timedelta(days=rollup_1m_days - 1)
+
+	day = first
+	while day <= last:
+		chunk_last = min(last, day + datetime.timedelta(days=days_per_query - 1))
+		if day < minutes_first <= chunk_last:
+			# a chunk is either completely within the minute rollup retention or not at all
+			chunk_last = minutes_first - datetime.timedelta(days=1)
+		for select in backfillStatements(name, day, chunk_last, minutes_too=day >= minutes_first):
+			db.query(select)
+		print('%s: rolled up %s to %s' % (name, day.isoformat(), chunk_last.isoformat()))
+		day = chunk_last + datetime.timedelta(days=1)
+
+
+def rollupStartStatement(name):
+	return "SELECT first(Wh) FROM rollup_1h.energy WHERE topic::tag = '%s'" % (ROLLUP_SERIES[name]['topic'])
+
+
+def parseRollupStart(points):
+	"""
+	Start of the hourly rollup from the points of rollupStartStatement(), queried with epoch='s',
+	None if there is none.
+	"""
+	if not points:
+		return None
+	return datetime.datetime.fromtimestamp(points[0]['time'], datetime.timezone.utc)
+
+
+def rollupCovers(start, first):
+	"""
+	True if a rollup that starts at 'start' can cover the local day 'first' and later,
+	see rollupHasGaps() for whether it does.
+	"""
+	return start is not None and start <= _localDayBounds(first, first)[0]
+
+
+def rollupStart(db, name):
+	"""
+	Start of the hourly rollup of a series, None if there is none.
+	"""
+	if name not in _coverage:
+		try:
+			pts = list(db.query(rollupStartStatement(name), epoch='s').get_points())
+		except InfluxDBClientError:
+			pts = []
+		_coverage[name] = parseRollupStart(pts)
+	return _coverage[name]
+
+
+def _completeUntil(start, end, now=None):
+	"""
+	End of the hours of start..end that the hourly continuous queries have rolled up by now,
+	they run at the end of each hour.
+	"""
+	if now is None:
+		now = datetime.datetime.now(datetime.timezone.utc)
+	return max(start, min(end, now.replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=1)))
+
+
+def coverageStatements(name, first, last, now=None):
+	"""
+	Statements counting per local day of first..last the hours with raw data and the hours in the
+	hourly rollup, up to the last rolled up hour; see rollupHasGaps().
+	"""
+	series = ROLLUP_SERIES[name]
+	start, end = _localDayBounds(first, last)
+	trange = _timeCondition(start, _completeUntil(start, end, now))
+	q = "SELECT count(n) FROM (SELECT count(value) AS n FROM %s WHERE topic::tag = '%s' AND %s GROUP BY time(1h) fill(none)) "
+	q += "WHERE %s GROUP BY time(1d) fill(0) %s"
+	raw = q % (series['measurement'], series['topic'], trange, trange, ql_timezone)
+	q = "SELECT count(Wh) FROM rollup_1h.energy WHERE topic::tag = '%s' AND %s GROUP BY time(1d) fill(0) %s"
+	rolled = q % (series['topic'], trange, ql_timezone)
+	return [raw, rolled]
+
+
+def rollupHasGaps(raw_points, rollup_points):
+	"""
+	True if on some day the hourly rollup has fewer hours than there are hours with raw data,
+	from the points of the two coverageStatements().
+	"""
+	rolled = {pt['time']: pt['count'] or 0 for pt in rollup_points}
+	return any((pt['count'] or 0) > rolled.get(pt['time'], 0) for pt in raw_points)
+
+
+def hourlyEnergyStatements(name, first, last, now=None):
+	"""
+	Statements for the energy per local hour of the days first..last, as a list of
+	(statement, [(energy field, result column, sign), ...]). Hours not yet in the hourly
+	rollup are summed up from the minute rollup.
+	"""
+	topic = ROLLUP_SERIES[name]['topic']
+	start, end = _localDayBounds(first, last)
+	complete = _completeUntil(start, end, now)
+
+	statements = []
+	if complete > start:
+		q = "SELECT sum(Wh) AS Wh, sum(import_Wh) AS import_Wh, sum(export_Wh) AS export_Wh FROM rollup_1h.energy "
+		q += "WHERE topic::tag = '%s' AND %s GROUP BY time(1h) fill(0) %s" % (topic, _timeCondition(start, complete), ql_timezone)
+		statements.append((q, [('Wh', 'Wh', 1), ('import_Wh', 'import_Wh', 1), ('export_Wh', 'export_Wh', 1)]))
+
+	if end > complete:
+		q = "SELECT sum(Wh) FROM rollup_1m.energy WHERE topic::tag = '%s'%s AND %s GROUP BY time(1h) fill(0) %s"
+		for field, cond, sign in (('Wh', '', 1), ('import_Wh', ' AND Wh > 0', 1), ('export_Wh', ' AND Wh < 0', -1)):
+			statements.append((q % (topic, cond, _timeCondition(complete, end), ql_timezone), [(field, 'sum', sign)]))
+
+	return statements
+
+
+def parseHourlyEnergy(statements, results):
+	"""
+	Energy per hour from the statements of hourlyEnergyStatements() and a list of the points
+	of each: dict of lists 'Wh', 'import_Wh', 'export_Wh' [Wh], export positive.
+	"""
+	energy = {'Wh': [], 'import_Wh': [], 'export_Wh': []}
+	for (q, columns), points in zip(statements, results):
+		for field, column, sign in columns:
+			energy[field] += [sign * (pt[column] or 0.0) for pt in points]
+	return energy
+
+
+def queryHourlyEnergy(db, name, first, last):
+	"""
+	Energy per local hour of the days first..last from the rollups, see parseHourlyEnergy(),
+	in one request together with the check for gaps. Returns None if the rollups do not cover the days.
+	"""
+	if not rollupCovers(rollupStart(db, name), first):
+		return None
+
+	statements = hourlyEnergyStatements(name, first, last)
+	results = db.query(';'.join(coverageStatements(name, first, last) + [q for q, columns in statements]))
+	points = [list(rs.get_points()) for rs in results]
+	if rollupHasGaps(points[0], points[1]):
+		return None
+	return parseHourlyEnergy(statements, points[2:])
+
+
+def queryDailyEnergy(db, name, first, last):
+	"""
+	Energy per local day of first..last from the hourly rollup, {date: Wh}, or None if not covered.
+	Hours not yet in the hourly rollup are summed up from the minute rollup.
+	"""
+	if not rollupCovers(rollupStart(db, name), first):
+		return None
+
+	# one pass over the hourly and the latest minute points, also for a range of years
+	topic = ROLLUP_SERIES[name]['topic']
+	start, end = _localDayBounds(first, last)
+	complete = _completeUntil(start, end)
+	statements = coverageStatements(name, first, last)
+	statements.append("SELECT Wh FROM rollup_1h.energy WHERE topic::tag = '%s' AND %s" % (topic, _timeCondition(start, complete)))
+	statements.append("SELECT Wh FROM rollup_1m.energy WHERE topic::tag = '%s' AND %s" % (topic, _timeCondition(complete, end)))
+	results = db.query(';'.join(statements), epoch='s')
+	if rollupHasGaps(list(results[0].get_points()), list(results[1].get_points())):
+		return None
+	points = list(results[2].get_points()) + list(results[3].get_points())
+	t = np.array([pt['time'] for pt in points], dtype=float)
+	Wh = np.array([pt['Wh'] if pt['Wh'] is not None else np.nan for pt in points], dtype=float)
+
+	edges = localBinEdges(first, last, bin_s=86400, tz=timezone)[0]
+	daily_Wh = binValues(t, Wh, edges)
+	hours = binValues(t, ~np.isnan(Wh), edges)
+	return {first + datetime.timedelta(days=int(n)): float(daily_Wh[n]) for n in np.flatnonzero(hours)}
+
+
+if __name__ == '__main__':
+
+	ap = argparse.ArgumentParser(description='Maintain the downsampled energy series in InfluxDB.')
+	ap.add_argument('--provision', action='store_true', help='create retention policies and continuous queries')
+	ap.add_argument('--backfill', nargs=2, metavar=('FROM', 'TO'), type=datetime.date.fromisoformat, help='roll up raw data of these days')
+	ap.add_argument('--series', nargs='*', default=list(ROLLUP_SERIES), help='series to backfill, default all')
+	args = ap.parse_args()
+
+	for database in sorted(set(series['database'] for series in ROLLUP_SERIES.values())):
+		db = InfluxDBClient(dbhost, dbport, '', '', database)
+		if args.provision:
+			provisionRollups(db, database)
+		if args.backfill:
+			for name in args.series:
+				if ROLLUP_SERIES[name]['database'] == database:
+					backfillRollups(db, name, args.backfill[0], args.backfill[1])
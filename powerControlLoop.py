@@ -38,6 +38,7 @@ ahoydtu_inverterId = 1            # cf. http://<ahoydtu_host>/api/inverter/list/
 ## Tibber Pulse/Bridge device
 tibber_bridge_host = "192.168.0.14"
 tibber_bridge_password = "XXXX-XXXX"  # code found printed on Tibber Bridge device, below QR tag
+tibber_meter_type = None  # or e.g. 'LandisGyrE220' to read frames SmlParser can not decode at fixed offsets, see SmlParser.METER_FIXED_OFFSETS
 
 ## Local Influxdb server that stores JK-BMS measurements incl. State-Of-Charge(%)
 bms_db_host = "localhost"
@@ -162,7 +163,7 @@ def isBatteryLow(SoC_pct, voltage_V, battery_W):
 if __name__ == '__main__':
 
 	dtu = AhoyDtuREST(ahoydtu_host, inverter=ahoydtu_inverterId)
-	meter = LocalTibberQuery(tibber_bridge_host, tibber_bridge_password)
+	meter = LocalTibberQuery(tibber_bridge_host, tibber_bridge_password, meter_type=tibber_meter_type)
 	bms = LocalInfluxdbQuery(bms_db_host, bms_db_port, bms_db_database)
 
 	T = datetime.datetime.utcnow()
@@ -223,10 +224,11 @@ if __name__ == '__main__':
 			print('Battery remain   : %3.0f %%' % (bmsSOC))
 
 
-		if gridsml and len(gridsml) > 0:
+		gridP = meter.extractPowerReading(gridsml) if gridsml else None
+		gridE = meter.extractEnergyReading(gridsml) if gridsml else None
+		if gridP is not None and gridE is not None:
 			meter_T = T
-			meter_P = meter.extractPowerReading(gridsml)
-			meter_E = meter.extractEnergyReading(gridsml)
+			meter_P, meter_E = gridP, gridE
 			print("Grid power       : %+d Watt" % (meter_P))
 			print("Grid energy      : %.2f kWh" % (meter_E/1000))
 
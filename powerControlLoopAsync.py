@@ -2,8 +2,8 @@
 #
 # Simple polling loop that
 #  1) queries energy meter net power reading via local page of the Tibber Bridge,
-#  2) queries the active power output of for now one single Hoymiles microinverter,
-#  3) adjusts the non-persistent power limit of the Hoymiles microinverter by
+#  2) queries the active power output of one or several Hoymiles microinverters,
+#  3) adjusts the non-persistent power limit of the Hoymiles microinverter(s) by
 #     3.1   reducing inverter output power if too much flows into the grid
 #     3.2   increasing inverter output power to reduce draw from grid
 #     3.3   keeping a minimum export flow into grid of 10 W (default)
@@ -20,317 +20,447 @@
 #     they tend to keep track of battery SOC% based on energy (dis-)charge
 #     over time - perhaps more accurate.
 #
+# The loop runs as asyncio tasks: a grid meter stream (a new SML frame about every
+# second), polling of DTU, BMS and MyStrom on drift-free deadlines every recheck_interval_s,
+# sensing (combines each new meter frame with the latest device readings), deciding
+# (PowerControlLogic) and actuating. Load steps are thus acted on within 1-2 seconds.
+#
+# DTU commands go through a DtuCommandQueue, which coalesces them to the latest
+# value, rate limits them, skips limits the inverter already has according to the
+# DTU readback, and waits settling_time_s after each command.
+#
+# With several inverters (see 'inverters' below) the control logic decides their
+# total power limit. The InverterGroup splits it up, solar powered inverters first,
+# then battery powered ones; each inverter has its own DtuCommandQueue.
+#
+# Each snapshot a decision was based on (ControlSnapshot) is kept in an in-memory
+# history of the last history_s seconds, for windowed statistics and telemetry.
+#
+# With record_traffic_file set, all raw device responses are recorded into an
+# append-only log (see TrafficRecorder.py) from which the day can be replayed.
+#
 
 import asyncio
-import aiohttp
-import time, datetime
-import requests
-import subprocess
-import sys
+import datetime
+import signal
 
+from AsyncHttpPool import AsyncHttpPool
 from AhoyDtuRESTAsync import AhoyDtuRESTAsync
 from LocalTibberQueryAsync import LocalTibberQueryAsync
 from LocalInfluxdbQueryAsync import LocalInfluxdbQueryAsync
+from MqttClientAsync import MqttClientAsync
+from ControlScheduler import MonotonicClock, DeadlineTicker, Mailbox, runTasks
+from PowerControlLogic import PowerControlLogic, makeControlEngine
+from TrafficRecorder import TrafficRecorder
+from DtuCommandQueue import DtuCommandQueue
+from InverterGroup import InverterGroup, InverterUnit
+from ControlSnapshot import ControlSnapshot, SnapshotHistory
+from BmsDataSource import BmsDataSource
+from BatteryEstimator import BatteryStateEstimator
 
 ## AhoyDTU device that is connected to the Hoymiles u-inverter
 ahoydtu_host = "192.168.0.52"
 ahoydtu_inverterId = 1            # cf. http://<ahoydtu_host>/api/inverter/list/ for list of connected inverters and their IDs
 
+## Several Hoymiles u-inverters, on one or more AhoyDTUs, to control together. None: only the
+## battery powered inverter ahoydtu_inverterId of ahoydtu_host above. Optional keys per inverter:
+## 'max_power_W' (default no limit besides the day/night max power), 'battery' (default True),
+## 'priority' (default 0 for solar powered, 1 for battery powered; lower values are loaded first)
+inverters = None
+#inverters = [
+#	{'name': 'hm350', 'host': '192.168.0.52', 'id': 0, 'max_power_W': 350, 'battery': False},
+#	{'name': 'hm350night', 'host': '192.168.0.52', 'id': 1, 'max_power_W': 310, 'battery': True},
+#]
+
 ## Tibber Pulse/Bridge device
 tibber_bridge_host = "192.168.0.14"
 tibber_bridge_password = "XXXX-XXXX"  # code found printed on Tibber Bridge device, below QR tag
+tibber_meter_type = None  # or e.g. 'LandisGyrE220' to read frames SmlParser can not decode at fixed offsets, see SmlParser.METER_FIXED_OFFSETS
 
 ## Local Influxdb server that stores JK-BMS measurements incl. State-Of-Charge(%)
 bms_db_host = "localhost"
 bms_db_port = 8086
 bms_db_database = "controllers"
+bms_mqtt_enabled = True            # Take the BMS measurements straight from their MQTT topics (on mqtt_host), Influxdb as fallback
+bms_max_age_s = 60                 # Query Influxdb when the latest MQTT values are older than this
 
 ## Remote MQTT over which to auto-off the 5000VA Steca AC inverter
 mqtt_host = "192.168.0.74"
+mqtt_port = 1883
+mqtt_telemetry_enabled = True      # Also publish grid power, commanded limit, battery verdicts
+mqtt_telemetry_prefix = "solar/zeroexport"
+mqtt_telemetry_interval_s = 10     # Per-decision values are published when changed, numbers at most this often
 
 ## Steca Solarix PLI-4800 AC input, controlled by a MyStrom wifi switch with a REST API
 ## with simple http get "http://[switch_ip]/relay?state=1" for AC ON, or state=0 for AC OFF
 steca_ac_host = "192.168.0.44"
 
 ## Power control settings
-# Power limits
+# Power limits, of all inverters together
 inverter_day_max_power_W = 310    # Day time max power assist; Hoymiles HM-350, tested 350W, but inverter gets quite warm (>40C)
 inverter_night_max_power_W = 310  # Night time max power assist
 inverter_min_power_W = 5          # Minimum inverter output power
 inverter_power_granularity_W = 5  # Minimum change of +- x Watt to apply, smaller changes are ignored and not sent to the inverter
 settling_time_s = 5               # Approx. delay till DTU & Hoymiles have applied a requested power level change; esp8226 ~20sec, esp32 ~10sec
-recheck_interval_s = 10           # Interval at which to query for new values
+recheck_interval_s = 10           # Interval at which to query DTU, BMS and MyStrom for new values
+meter_interval_s = 1              # Interval at which to fetch grid meter frames; Tibber Pulse updates about every 1 sec
+meter_window_s = 10               # Time window for grid power statistics (mean, min, max, slope)
+meter_stale_s = 3                 # Grid meter readings older than this are not used for adjustments
+dtu_stale_s = 60                  # DTU readings older than this (by their DTU timestamp) are not used
+bms_stale_s = 120                 # BMS readings older than this are not used, the battery state estimate bridges gaps
+dtu_commands_per_min = 6          # Sustained rate of DTU commands (limit or power), excess requests are coalesced to the latest
+dtu_command_burst = 4             # Number of DTU commands that may be sent back-to-back after a quiet period
+dtu_confirm_timeout_s = 30        # Re-send a power limit once if the DTU readback has not confirmed it by then
+history_s = 6*3600                # Length of the in-memory history of control snapshots
+history_stats_window_s = 3600     # Time window of the grid and inverter power averages reported per poll
+
+# Control law, see PowerControlLogic.CONTROL_ENGINES
+control_engine = 'proportional'   # 'proportional': inverter + grid power; 'pi': PI with anti-windup (experimental); 'predictive': dead time model with meter trend
+control_engine_params = {}        # e.g. {'Kp': 0.1, 'Ki': 0.5} for 'pi', {'dead_time_s': 8} for 'predictive'
+
+# Local device HTTP connections
+http_max_conn_per_host = 2        # ESP8266/ESP32 web servers handle only a few parallel sockets
+http_keepalive_s = 30             # Keep idle device connections open this long between polls
+
+# Recording of raw device responses for replay, None to disable
+record_traffic_file = None        # e.g. '/var/log/zeroexport/traffic-%Y%m%d.log', strftime() placeholders are expanded
 
 # Undervoltage shutdown/recovery
 lfp_undervoltage = 51.2           # DC safety limit, turn off the inverter altogether then the input voltage drops to this level
 lfp_recovery_voltage = 51.5       # DC recovery limit, restart inverter once undervoltage has cleared e.g. battery charged sufficiently
 				  # Note, 16S LFP voltages approx.: 51.2V = 20%, 52.0 = 40%, 52.3 = 60%, 53.1 = 80% charged
 lfp_min_SOC_percent = 20.0        # SOC safety limit, turn off inverter when remaining charge of battery drops to this level
+battery_capacity_Wh = 5120.0      # Battery state estimate: capacity, for coulomb counting between BMS readings
+battery_R_ohm = 0.03              # Battery state estimate: initial internal resistance, refined from BMS readings
+battery_max_coast_s = 900         # Battery state estimate: valid this long after the last BMS reading
 #lfp_recovery_SOC_percent = 30.0   # SOC recovery limit, restart after charged sufficiently _and_ lfp_recovery_voltage is met
 
 
-def mqtt_submit(host, topic, value):
+async def command_power_state(dtu, powerEnabled=True):
+	'''Turn the inverter power production on or off'''
 
-	cmd = ["/usr/bin/mosquitto_pub", "-h", host, "-t", topic, "-m", str(value)]
+	reply = await dtu.setPowerState(powerEnabled)
+	print("  DTU reply ", str(reply))
 
-	if True:
-		result = subprocess.run(cmd, shell=False, capture_output=True, text=True)
-		if len(result.stdout) > 1:
-			print("  EXEC   ", " ".join(cmd))
-			print("  STDOUT ", result.stdout)
-	else:
-		print("TODO ", " ".join(cmd))
 
+def publish_unit_telemetry(mqtt, unit):
+	'''Publish readings of one of several inverters, e.g. <prefix>/<inverter name>/Pac_W'''
 
+	publish_telemetry(mqtt, {'%s/Pac_W' % (unit.name): unit.Pac, '%s/Vdc_V' % (unit.name): unit.Vdc,
+		'%s/limit_W' % (unit.name): unit.limit_W})
 
-def send_JSON(host, json):
 
-	cmd = ["/usr/bin/curl", "-i", "-v", "-H", "Accept:application/json", "-H", "Content-Type:application/json", "-X", "POST"]
-	cmd += ["--data", json, "http://%s/api/ctrl" % (host)]
+def command_steca_inverter_state(mqtt, enable=False):
 
-	if True:
-		result = subprocess.run(cmd, shell=False, capture_output=True, text=True)
-		print("  EXEC   ", " ".join(cmd))
-		print("  STDOUT ", result.stdout)
+	if not enable:
+		mqtt.publish("solar/control/inverter_enable", "false", qos=1)
 	else:
-		print("TODO ", " ".join(cmd))
-
+		mqtt.publish("solar/control/inverter_enable", "true", qos=1)
 
-def command_new_power(host, invId, P_Watt):
 
-	json = '{"id":%u,"cmd":"limit_nonpersistent_absolute","val":%u}' % (int(invId), int(P_Watt))
+def publish_telemetry(mqtt, values):
+	'''Publish loop-internal values under mqtt_telemetry_prefix, e.g. <prefix>/grid_power_W'''
 
-	send_JSON(host, json)
+	if not mqtt_telemetry_enabled:
+		return
 
+	for name, value in values.items():
+		if value is None:
+			continue
+		if isinstance(value, bool):
+			value = 'true' if value else 'false'
+		mqtt.publish('%s/%s' % (mqtt_telemetry_prefix, name), value, qos=0)
 
-def command_power_state(host, invId, powerEnabled=True):
-	'''Turn the inverter power production on or off'''
 
-	if powerEnabled:
-		json = '{"id":%u,"cmd":"power","val":%u}' % (int(invId), 1)
-	else:
-		json = '{"id":%u,"cmd":"power","val":%u}' % (int(invId), 0)
+class TelemetryThrottle:
+	'''Publish values only when they changed; numeric values at most every interval_s'''
 
-	send_JSON(host, json)
+	def __init__(self, clock, interval_s=mqtt_telemetry_interval_s):
+		self.clock = clock
+		self.interval_s = interval_s
+		self.published = {}
 
+	def publish(self, mqtt, values):
+		T = self.clock.now()
+		changed = {}
+		for name, value in values.items():
+			if name in self.published:
+				last_value, last_T = self.published[name]
+				if value == last_value:
+					continue
+				if not isinstance(value, bool) and T - last_T < self.interval_s:
+					continue
+			changed[name] = value
+			self.published[name] = (value, T)
+		publish_telemetry(mqtt, changed)
 
-def command_steca_inverter_state(host, enable=False):
 
-	if not enable:
-		mqtt_submit(host, "solar/control/inverter_enable", "false")
-	else:
-		mqtt_submit(host, "solar/control/inverter_enable", "true")
+async def query_steca_mystrom_on(pool, host):
 
-
-async def query_steca_mystrom_on(host):
-
-	ac_input_on = False
 	url = 'http://%s/report' % (host)
 
-	try:
-		async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as client:
-			async with client.get(url) as resp:
-				if resp.status != 200:
-					print ('Failed to query %s' % (url))
-					return ac_input_on
-				j = await resp.json()
-				ac_input_on = (j['relay'] == True)
-				return ac_input_on
-
-	except Exception as e:
-		print('Unexpected result of querying %s - exception: %s' % (url, str(e)))
+	j = await pool.getJSON(url, timeout_s=5)
+	if not j or 'relay' not in j:
+		print ('Failed to query %s' % (url))
+		return False
 
-	return ac_input_on
+	return (j['relay'] == True)
 
 
 
-def isBatteryLow(SoC_pct, voltage_V, battery_W):
+def execute_command(group, mqtt, cmd):
 	"""
-	Check combination of battery voltage, BMS-reported SoC%, and power draw,
-	to return a best guess whether the 16S LFP battery is close to empty (80% DoD).
-	The SoC chaged% reading is not always reliable.
+	Carry out one command of PowerControlLogic.decide(). DTU commands are split across the inverters and queued.
 	"""
-	drained = False
+	kind, value = cmd
+
+	if kind == 'power_state':
+		group.setPowerState(value)
+	elif kind == 'power_limit':
+		group.setPowerLimit(value)
+	elif kind == 'steca_enable':
+		command_steca_inverter_state(mqtt, enable=value)
+	else:
+		print('Unknown command %s' % (str(cmd)))
+
 
-	# BMS-reported load: P<0 means discharging, P>0 means charging.
-	# Flip the sign
-	if battery_W >= 0:
-		load_W = 0
+async def pollDevices(clock, pool, group, bms, mqtt, history, last):
+	"""
+	Query the slowly changing devices (DTU, BMS, MyStrom) concurrently.
+	Results go into the dict 'last', which sensingTask() combines with the grid meter stream.
+	"""
+	T = clock.now()
+	Tloc = clock.wallclock()
+
+	#timing0 = time.perf_counter()
+	[nreplies,bmsReadings,stecaCharge] = await asyncio.gather(*[group.readInverterData(T, Tloc.timestamp()),
+		bms.getBatteryReadings(), query_steca_mystrom_on(pool, steca_ac_host)
+	])
+	bmsVolt, bmsPower, bmsSOC = bmsReadings.voltage, bmsReadings.power, bmsReadings.soc
+	#dtiming = time.perf_counter() - timing0
+	#print('Network wait time (ms):', 1e3*dtiming) # approx 150ms..250ms, vs non-async ~600ms
+
+	print()
+	print('Local time       : %s' % (str(Tloc)))
+
+	print('Steca AC In      : %s' % ('ON' if stecaCharge else 'off'))
+
+	dtu_T = group.acquisitionTime()
+	last['dtu_ok'] = dtu_T is not None
+	if nreplies > 0:
+		last['dtu_T'] = dtu_T if dtu_T is not None else T
+		last['dtu_Pac'], last['dtu_battery_Pac'], last['dtu_Vdc'] = group.totals()
+		print('DTU report time  : %s' % (str(max(u.dtu.last_update for u in group.units))))
+		print('Hoymiles DC in   : %.2f V_dc' % (last['dtu_Vdc']))
+		print('Hoymiles AC pwr  : %.2f W_rms' % (last['dtu_Pac']))
+		if len(group.units) > 1:
+			for u in group.units:
+				if u.offline:
+					print('  %-14s : offline' % (u.name))
+				elif u.Pac is not None:
+					print('  %-14s : %.2f V_dc, %.2f W_rms, limit %s W' % (u.name, u.Vdc, u.Pac,
+						'%.0f' % (u.limit_W) if u.limit_W is not None else '?'))
+				publish_unit_telemetry(mqtt, u)
+		print('DTU commands     : %(sent)d sent, %(coalesced)d coalesced, %(skipped)d skipped, %(confirmed)d confirmed' % group.stats())
 	else:
-		load_W = -battery_W
+		last['dtu_Vdc'], last['dtu_Pac'], last['dtu_battery_Pac'] = 0.0, 0.0, 0.0
 
-	# Medium to no load, and voltage indicates below 20% SoC
-	if voltage_V <= 51.2 and load_W <= 400.0:
-		drained = True
+	if bmsVolt > 0:
+		print('Battery voltage  : %.2f V per BMS' % (bmsVolt))
+	if bmsSOC > 0 or True:
+		print('Battery remain   : %.0f %%' % (bmsSOC))
 
-	# Voltage looks critical regardless of load
-	if voltage_V <= 49.5:
-		drained = True
+	ages = [bmsReadings.age(name, Tloc.timestamp()) for name in ('voltage', 'power', 'soc')]
+	bms_age_s = max(ages) if None not in ages else None
+	if bms_age_s is None:
+		print('BMS readings     : missing')
+	elif bms_age_s > recheck_interval_s:
+		print('BMS readings     : %.0f s old' % (bms_age_s))
 
-	# Load is high and hence internal voltage drop is high,
-	# fall back to trusting SoC% rather than voltage?
-	if (load_W > 400.0 and SoC_pct < 20.0) and voltage_V <= 50.0:
-		drained = True
+	last['bmsVolt'], last['bmsPower'], last['bmsSOC'] = bmsVolt, bmsPower, bmsSOC
+	last['bms_ok'] = bms_age_s is not None and bmsVolt > 0
+	last['bms_T'] = T - max(0.0, bms_age_s) if bms_age_s is not None else None
+	last['stecaCharge'] = stecaCharge
 
-	print ("DBG: isBatteryLow(%.2f%%, %.2fV, load=%.2fW) verdict: %s" % (SoC_pct, voltage_V, load_W, drained))
+	grid = history.windowStats('meter_P', history_stats_window_s)
+	inverter = history.windowStats('dtu_Pac', history_stats_window_s)
+	if grid and inverter:
+		print('Power averages   : grid %+.0f W, inverter %.0f W over %d min' % (grid['mean'], inverter['mean'], history_stats_window_s/60))
+		publish_telemetry(mqtt, {'grid_power_mean_W': round(grid['mean'], 1), 'inverter_power_mean_W': round(inverter['mean'], 1)})
 
-	return drained
 
+async def pollingTask(clock, pool, group, bms, mqtt, history, last, polled):
+	"""
+	Poll DTU, BMS and MyStrom once per recheck_interval_s, on drift-free deadlines.
+	The event 'polled' is set once the first round of readings is available.
+	"""
+	ticker = DeadlineTicker(recheck_interval_s, clock)
+	while True:
+		await ticker.wait()
+		await pollDevices(clock, pool, group, bms, mqtt, history, last)
+		polled.set()
 
-async def controlLoop():
 
-	dtu = AhoyDtuRESTAsync(ahoydtu_host, inverter=ahoydtu_inverterId)
-	meter = LocalTibberQueryAsync(tibber_bridge_host, tibber_bridge_password)
-	bms = LocalInfluxdbQueryAsync(bms_db_host, bms_db_port, bms_db_database)
+async def sensingTask(clock, meter, last, polled, samples, battery):
+	"""
+	Sense: on each new grid meter frame, combine it with the latest device readings into a sample,
+	and update the battery state estimate with it.
+	"""
+	await polled.wait()
 
-	T = datetime.datetime.utcnow()
-	dtu_T, meter_T, prev_adjust_T = T, T, T
-	dtu_Pac, meter_P, meter_E = 0, 0, 0
+	while True:
+		reading = await meter.waitForFrame(timeout_s=meter_stale_s)
+		if reading is None:
+			print('No grid meter frame for %d sec' % (meter_stale_s))
+			reading = meter.getLatest()
+			if reading is None:
+				continue
+
+		meter_T, meter_P, meter_E = reading
+		stats = meter.getWindowStats(meter_window_s)
+		if stats:
+			print("Grid power       : %+d Watt, last %ds mean %+.0f, min %+d, max %+d, slope %+.1f W/s" % (meter_P,
+				meter_window_s, stats['mean'], stats['min'], stats['max'], stats['slope']))
+
+		sample = ControlSnapshot(T=clock.now(), hour=clock.wallclock().hour,
+			meter_T=meter_T, meter_P=meter_P, meter_E=meter_E,
+			meter_slope=stats['slope'] if stats else 0.0, **last)
+		battery.update(sample['T'], sample)
+		for name, value in battery.values().items():
+			sample[name] = value
+		samples.put(sample)
+
+
+async def decidingTask(clock, logic, samples, group, mqtt, history):
+	"""
+	Decide: judge each new sample, hand resulting commands to the actuators.
+	DTU commands not yet sent by the DTU command queues are replaced by newer ones.
+	"""
+	telemetry = TelemetryThrottle(clock)
+	while True:
+		sample = await samples.get()
+		sample['dtu_busy'] = group.isBusy()
+		history.append(sample)
+		cmds = logic.decide(sample)
+		telemetry.publish(mqtt, logic.verdict)
+		for cmd in cmds:
+			execute_command(group, mqtt, cmd)
+
+
+async def makeInverterGroup(pool, clock, mqtt, logic):
+	'''Inverters and their DTU command queues configured from the settings above, reporting sent limits to the logic and as telemetry'''
+
+	group = InverterGroup(granularity_W=inverter_power_granularity_W, max_age_s=dtu_stale_s)
+
+	def sentBy(name):
+		def on_sent(kind, value):
+			if kind == 'power_limit':
+				logic.noteCommandSent(clock.now(), group.total_W)
+				publish_telemetry(mqtt, {'commanded_limit_W': group.total_W})
+				if len(group.units) > 1:
+					publish_telemetry(mqtt, {'%s/commanded_limit_W' % (name): value})
+		return on_sent
+
+	default_max_W = max(inverter_day_max_power_W, inverter_night_max_power_W)
+	configured = inverters
+	if not configured:
+		configured = [{'name': 'inverter', 'host': ahoydtu_host, 'id': ahoydtu_inverterId, 'battery': True}]
+
+	# inverters as listed by their DTUs, measurement names are loaded once per DTU
+	hosts = sorted(set(str(inv['host']) for inv in configured))
+	discovered = await asyncio.gather(*[AhoyDtuRESTAsync.discover(host, pool) for host in hosts])
+	listed = {(dtu.hostname, dtu.inverter): dtu for dtus in discovered for dtu in dtus}
+
+	for inv in configured:
+		dtu = listed.get((str(inv['host']), int(inv['id'])))
+		if dtu is None:
+			print('Inverter %s is not listed by the DTU at %s' % (inv['name'], inv['host']))
+			dtu = AhoyDtuRESTAsync(inv['host'], pool, inverter=inv['id'])
+		queue = DtuCommandQueue(dtu, clock, commands_per_min=dtu_commands_per_min, burst=dtu_command_burst,
+			settling_time_s=settling_time_s, tolerance_W=inverter_power_granularity_W,
+			confirm_timeout_s=dtu_confirm_timeout_s, on_sent=sentBy(inv['name']))
+		group.add(InverterUnit(inv['name'], dtu, queue, inv.get('max_power_W', default_max_W),
+			min_power_W=inverter_min_power_W, battery=inv.get('battery', True), priority=inv.get('priority')))
+
+	return group
+
+
+def makeControlLogic():
+	'''Decision logic configured from the settings above'''
+
+	return PowerControlLogic(day_max_power_W=inverter_day_max_power_W, night_max_power_W=inverter_night_max_power_W,
+		min_power_W=inverter_min_power_W, power_granularity_W=inverter_power_granularity_W,
+		settling_time_s=settling_time_s, max_meter_age_s=meter_stale_s,
+		lfp_recovery_voltage=lfp_recovery_voltage, lfp_min_SOC_percent=lfp_min_SOC_percent,
+		max_dtu_age_s=dtu_stale_s, max_bms_age_s=bms_stale_s,
+		engine=makeControlEngine(control_engine, **control_engine_params))
+
+
+async def controlLoop(clock=None):
+
+	if clock is None:
+		clock = MonotonicClock()
+
+	# One HTTP session with kept-alive connections, shared by all local devices
+	# and one persistent MQTT broker connection
+	mqtt = MqttClientAsync(mqtt_host, mqtt_port)
+	await mqtt.start()
+
+	recorder = None
+	if record_traffic_file:
+		recorder = TrafficRecorder(datetime.datetime.now().strftime(record_traffic_file), clock=clock)
+		await recorder.start()
+		print('Recording device traffic to %s' % (recorder.filename))
+
+	bms = LocalInfluxdbQueryAsync(bms_db_host, bms_db_port, bms_db_database, recorder=recorder)
+	if bms_mqtt_enabled:
+		bms = BmsDataSource(mqtt, bms, max_age_s=bms_max_age_s, clock=clock)
 
-	hitUndervoltage = False
-	dynamic_max_power_W = inverter_day_max_power_W
+	try:
+		async with AsyncHttpPool(limit_per_host=http_max_conn_per_host, keepalive_timeout_s=http_keepalive_s, recorder=recorder) as pool:
 
-	# Make sure the inverter is on
-	command_power_state(ahoydtu_host, ahoydtu_inverterId, powerEnabled=True)
-	#sys.exit(0)
+			meter = LocalTibberQueryAsync(tibber_bridge_host, tibber_bridge_password, pool=pool, clock=clock, meter_type=tibber_meter_type)
 
-	# Power control loop
-	while True:
+			logic = makeControlLogic()
+			group = await makeInverterGroup(pool, clock, mqtt, logic)
 
-		# Grab new data
-		T = datetime.datetime.utcnow()
-		Tloc = datetime.datetime.now()
-
-		if Tloc.hour >= 8 and Tloc.hour <= 18:
-			dynamic_max_power_W = inverter_day_max_power_W
-		else:
-			dynamic_max_power_W = inverter_night_max_power_W
-
-		#timing0 = time.perf_counter()
-		[invdata,gridsml,bmsVolt,bmsPower,bmsSOC,stecaCharge] = await asyncio.gather(*[dtu.readInverterData(),
-			meter.getMeterSMLFrame(),
-			bms.getBatteryVoltage(), bms.getBatteryPower(), bms.getBatteryPercentage(),
-			query_steca_mystrom_on(steca_ac_host)
-		])
-		#dtiming = time.perf_counter() - timing0
-		#print('Network wait time (ms):', 1e3*dtiming) # approx 150ms..250ms, vs non-async ~600ms
-
-		print()
-		print('Local time       : %s' % (str(Tloc)))
-
-		print('Steca AC In      : %s' % ('ON' if stecaCharge else 'off'))
-
-		tmp1 = dtu.getChannelMeasurement(invdata, 'U_DC', dtu.DC_INPUT_1)
-		tmp2 = dtu.getChannelMeasurement(invdata, 'P_AC', dtu.AC_CHAN)
-		if tmp1 != None and tmp2 != None:
-			dtu_T = T # dtu.last_update
-			dtu_Vdc = float(tmp1)
-			dtu_Pac = float(tmp2)
-			print('DTU report time  : %s' % (str(dtu.last_update)))
-			print('Hoymiles DC in   : %.2f V_dc' % (dtu_Vdc))
-			print('Hoymiles AC pwr  : %.2f W_rms of max %d W' % (dtu_Pac, dynamic_max_power_W))
-		else:
-			dtu_Vdc, dtu_Pac = 0.0, 0.0
-
-		if bmsVolt > 0:
-			print('Battery voltage  : %.2f V per BMS' % (bmsVolt))
-		if bmsSOC > 0 or True:
-			print('Battery remain   : %.0f %%' % (bmsSOC))
-
-
-		if gridsml and len(gridsml) > 0:
-			meter_T = T
-			meter_P = meter.extractPowerReading(gridsml)
-			meter_E = meter.extractEnergyReading(gridsml)
-			print("Grid power       : %+d Watt" % (meter_P))
-			print("Grid energy      : %.2f kWh" % (meter_E/1000))
-
-
-		# Stop microinverter if Steca Solarix hybrid inverter AC-IN was
-		# switched on (outside of this script) to charge battery esp.
-		# at night during a minimal electricity cost hour (Tibber); no point
-		# in microinverter feeding house via Solarix-internal battery charger...
-		if stecaCharge:  # and ('P_AC' in invdata and float(invdata['P_AC']) > 0):
-			print("Command power    : OFF due to Steca Solarix hybrid inverter charging battery from AC In")
-			command_power_state(ahoydtu_host, ahoydtu_inverterId, powerEnabled=False)
-			time.sleep(settling_time_s)
-			continue
+			# Make sure the inverters are on
+			await asyncio.gather(*[command_power_state(u.dtu, powerEnabled=True) for u in group.units])
+
+			# Power control loop
+			T = clock.now()
+			last = {'dtu_T': T, 'dtu_Vdc': 0.0, 'dtu_Pac': 0.0, 'dtu_battery_Pac': 0.0}
+			polled = asyncio.Event()
+			samples = Mailbox()
+			history = SnapshotHistory(history_s, meter_interval_s)
+			battery = BatteryStateEstimator(battery_capacity_Wh, battery_R_ohm, max_coast_s=battery_max_coast_s)
+			await runTasks(meter.streamFrames(meter_interval_s),
+				pollingTask(clock, pool, group, bms, mqtt, history, last, polled),
+				sensingTask(clock, meter, last, polled, samples, battery),
+				decidingTask(clock, logic, samples, group, mqtt, history),
+				group.run())
+	finally:
+		await bms.close()
+		await mqtt.stop()
+		if recorder is not None:
+			await recorder.stop()
 
-		# Check battery undervoltage & low charge remaining, and recovery from it
-		# First judge based on Hoymiles -reported DC input voltage
-		if dtu_Vdc > 0:
-			drained = isBatteryLow(bmsSOC, dtu_Vdc, bmsPower)
-			if hitUndervoltage and not drained and dtu_Vdc >= lfp_recovery_voltage:
-				hitUndervoltage = False
-			elif drained:
-				hitUndervoltage = True
-
-		# Secondly judge from BMS -reported battery voltage
-		drained = isBatteryLow(bmsSOC, bmsVolt, bmsPower)
-		if hitUndervoltage and not drained and bmsVolt >= lfp_recovery_voltage:
-			hitUndervoltage = False
-		elif drained:
-			hitUndervoltage = True
-
-		# Aux: safe-off a separate Steca Solarix PLI hybrid inverter
-		if drained:
-			print("Command Steca AC : safety OFF due low battery SOC %%")
-			command_steca_inverter_state(mqtt_host, enable=False)
-
-		# During undervoltage, shut down the u-inverter power production,
-		# turn back on only after undervoltage condition has cleared
-		if hitUndervoltage and dtu_Pac > 0:
-			print("Command power    : OFF due low battery, wait till %.2f V and %.0f %% charge" % (lfp_recovery_voltage,lfp_min_SOC_percent))
-			command_power_state(ahoydtu_host, ahoydtu_inverterId, powerEnabled=False)
-			time.sleep(settling_time_s)
-			continue
-		elif (not hitUndervoltage) and dtu_Pac <= 0 and not stecaCharge:
-			print("Command power    : ON due to recovery from earlier DC undervoltage or AC-Charge Priority")
-			command_power_state(ahoydtu_host, ahoydtu_inverterId, powerEnabled=True)
-			time.sleep(settling_time_s)
-			continue
 
+async def main():
 
-		# When DTU and Grid values are "fresh enough", inspect them,
-		# and adjust inverter output power to get near zero energy export
-		if abs((dtu_T - meter_T).total_seconds()) < recheck_interval_s/2:
-			new_P = dtu_Pac + meter_P
-			new_P = (new_P // inverter_power_granularity_W) * inverter_power_granularity_W
-			new_P = new_P + inverter_power_granularity_W  # always feed some extra
-			new_P = min(new_P, dynamic_max_power_W)
-			new_P = max(new_P, inverter_min_power_W)
-
-			#if hitUndervoltage:
-			#	new_P = inverter_power_granularity_W
-			#	print("DC Undervoltage  : fixing output to %d Watt until recovery" % (new_P))
-
-			pdiff = new_P - dtu_Pac
-
-			if abs(pdiff) > 2*inverter_power_granularity_W:
-				# Large load change: slowly assist, or quickly back off
-				if hitUndervoltage:
-					print("Command power    : stay OFF due to DC undervoltage")
-				elif (T - prev_adjust_T).total_seconds() > settling_time_s or pdiff < 0:
-					print("Command power    : %d Watt" % (new_P))
-					command_new_power(ahoydtu_host, ahoydtu_inverterId, new_P)
-					prev_adjust_T = T
-				else:
-					print("Future cmd power : %d Watt" % (new_P))
-		else:
-			print('Not enough recent data in this interval, skipping adjustments')
-
-		# Pause until the next iteration
-		tsleep = recheck_interval_s - (datetime.datetime.utcnow() - T).seconds
-		if tsleep > 0:
-			print("Re-checking after: %d sec" % (tsleep))
-			time.sleep(tsleep)
+	# Stop cleanly on 'kill' as well as on Ctrl-C
+	asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+	await controlLoop()
 
 
 if __name__ == '__main__':
 
 	while True:
 		try:
-			asyncio.run(controlLoop())
+			asyncio.run(main())
+		except (KeyboardInterrupt, asyncio.CancelledError):
+			print('Main program stopped')
+			break
 		except Exception as e:
 			print('Main program ran into an exception: %s' % (str(e)))
 			print('Plowing on, anyway...')
@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+#
+# Offline replay of captured SML frames, e.g. raw downloads of the Tibber Bridge
+# http://<bridge>/data.json?node_id=1 that were appended to a capture file.
+#
+# Every frame found in the capture file(s) is decoded with the same code as used
+# by LocalTibberQuery (SmlParser, with the frame layout cache), and the readings
+# are written out as
+#
+#   csv     - one line per frame
+#   npy     - one NumPy .npy array per column in an output directory
+#   influx  - InfluxDB line protocol, one point per frame
+#
+# Captures are read in chunks and results are written out as they are decoded,
+# so memory use stays constant regardless of the number of frames.
+#
+# Capture files are either raw frames back to back, or traffic logs written by
+# the control loop (TrafficRecorder), from which the Tibber Bridge responses are
+# taken. Raw frames carry no time stamps, their time stamps are derived from a
+# start time and the sampling interval of the capture (--start, --interval).
+# Traffic logs provide the recorded time stamps.
+#
+# Usage:
+#   ./smlReplay.py capture.bin > readings.csv
+#   ./smlReplay.py --format npy --output readings/ captures/
+#   ./smlReplay.py --format influx --start 2024-03-01T00:00:00 --interval 1 capture.bin > readings.lp
+#   ./smlReplay.py --check capture.bin > /dev/null
+#
+
+import argparse
+import datetime
+import math
+import os
+import sys
+import time
+
+from TrafficRecorder import TrafficLogReader, LOG_MAGIC
+from SmlParser import findFrame, parseSmlFrame, SmlLayoutCache, OBIS_POWER, OBIS_ENERGY_IMPORT, OBIS_ENERGY_EXPORT, OBIS_POWER_L1, OBIS_POWER_L2, OBIS_POWER_L3
+
+# Output columns: (name, OBIS code)
+COLUMNS = [
+	('power_W', OBIS_POWER),
+	('import_Wh', OBIS_ENERGY_IMPORT),
+	('export_Wh', OBIS_ENERGY_EXPORT),
+	('power_L1_W', OBIS_POWER_L1),
+	('power_L2_W', OBIS_POWER_L2),
+	('power_L3_W', OBIS_POWER_L3),
+]
+
+READ_CHUNK_BYTES = 1 << 20
+MAX_FRAME_BYTES = 1 << 16   # longer stretches without a complete frame are discarded
+
+
+def captureFiles(paths):
+	"""
+	Expand the given files and directories into a sorted list of capture files.
+	"""
+	for path in paths:
+		if os.path.isdir(path):
+			for root, dirs, files in os.walk(path):
+				dirs.sort()
+				for name in sorted(files):
+					yield os.path.join(root, name)
+		else:
+			yield path
+
+
+def iterFrames(filename, chunk_bytes=READ_CHUNK_BYTES):
+	"""
+	Yield (Unix time or None, frame) for the complete SML frames found in a capture file.
+	"""
+	with open(filename, 'rb') as f:
+		is_log = (f.read(len(LOG_MAGIC)) == LOG_MAGIC)
+
+	if is_log:
+		log = TrafficLogReader(filename)
+		try:
+			for (T, source, status, payload) in log.records(sources=['data.json']):
+				if status == 200:
+					yield (log.toWallclock(T), payload)
+		finally:
+			log.close()
+		return
+
+	buf = bytearray()
+	with open(filename, 'rb') as f:
+		while True:
+			chunk = f.read(chunk_bytes)
+			if not chunk:
+				break
+			buf += chunk
+			pos = 0
+			while True:
+				loc = findFrame(buf, pos)
+				if loc is None:
+					break
+				begin, end = loc
+				yield (None, bytes(buf[begin:end]))
+				pos = end
+			del buf[:pos]
+			if len(buf) > MAX_FRAME_BYTES:
+				# no frame end in sight; keep only what could be the start of the next frame
+				del buf[:len(buf) - 8]
+
+
+class CsvWriter:
+
+	def __init__(self, out):
+		self.out = out
+		self.out.write('time,' + ','.join(name for name, obis in COLUMNS) + '\n')
+
+	def write(self, T, row):
+		self.out.write('%.3f,' % (T) + ','.join('' if v is None else repr(v) for v in row) + '\n')
+
+	def close(self):
+		self.out.flush()
+
+
+class InfluxLineWriter:
+
+	def __init__(self, out, measurement='meter'):
+		self.out = out
+		self.measurement = measurement
+
+	def write(self, T, row):
+		fields = ['%s=%r' % (name, float(v)) for (name, obis), v in zip(COLUMNS, row) if v is not None]
+		if fields:
+			self.out.write('%s %s %d\n' % (self.measurement, ','.join(fields), int(round(T * 1e9))))
+
+	def close(self):
+		self.out.flush()
+
+
+class NpyWriter:
+	"""
+	Column-wise float64 output. Values are appended to raw files while decoding,
+	and converted to <column>.npy files once the number of rows is known.
+	"""
+
+	def __init__(self, outdir, flush_rows=65536):
+		import numpy
+		self.np = numpy
+		os.makedirs(outdir, exist_ok=True)
+		self.outdir = outdir
+		self.names = ['time'] + [name for name, obis in COLUMNS]
+		self.rawfiles = [open(os.path.join(outdir, name + '.raw'), 'wb') for name in self.names]
+		self.block = numpy.empty((flush_rows, len(self.names)), dtype=numpy.float64)
+		self.fill = 0
+		self.rows = 0
+
+	def write(self, T, row):
+		b = self.block[self.fill]
+		b[0] = T
+		b[1:] = [math.nan if v is None else v for v in row]
+		self.fill += 1
+		if self.fill >= len(self.block):
+			self._flush()
+
+	def _flush(self):
+		for n, f in enumerate(self.rawfiles):
+			f.write(self.block[:self.fill, n].tobytes())
+		self.rows += self.fill
+		self.fill = 0
+
+	def close(self):
+		from numpy.lib.format import open_memmap
+		self._flush()
+		for name, f in zip(self.names, self.rawfiles):
+			f.close()
+			rawname = os.path.join(self.outdir, name + '.raw')
+			out = open_memmap(os.path.join(self.outdir, name + '.npy'), mode='w+', dtype=self.np.float64, shape=(self.rows,))
+			if self.rows > 0:
+				raw = self.np.memmap(rawname, dtype=self.np.float64, mode='r', shape=(self.rows,))
+				step = len(self.block)
+				for k in range(0, self.rows, step):
+					out[k:k+step] = raw[k:k+step]
+				del raw
+			out.flush()
+			del out
+			os.remove(rawname)
+
+
+def parseStartTime(s):
+	"""
+	Accept a Unix time stamp or an ISO 8601 date/time (local time unless a UTC offset is given).
+	"""
+	try:
+		return float(s)
+	except ValueError:
+		return datetime.datetime.fromisoformat(s).timestamp()
+
+
+def replay(paths, writer, start_T=0.0, interval_s=1.0, verify_crc=True, check=False):
+	"""
+	Decode all frames of the captures and pass the readings to the writer.
+	Returns a dict of statistics.
+	"""
+	cache = SmlLayoutCache(verify_crc=verify_crc)
+	stats = {'files': 0, 'frames': 0, 'bad': 0, 'mismatch': 0}
+	T = start_T
+
+	for filename in captureFiles(paths):
+		stats['files'] += 1
+		for (frame_T, frame) in iterFrames(filename):
+			if frame_T is not None:
+				T = frame_T
+			stats['frames'] += 1
+			values = cache.decode(frame)
+			if values is None:
+				stats['bad'] += 1
+			else:
+				if check:
+					# compare against a full parse, to validate the fast path
+					readings = parseSmlFrame(frame, verify_crc)
+					if readings is None or {obis: v.value for obis, v in readings.items()} != values:
+						stats['mismatch'] += 1
+						print('Frame %d of %s: layout cache and full parse disagree' % (stats['frames'], filename), file=sys.stderr)
+				writer.write(T, [values.get(obis) for name, obis in COLUMNS])
+			T += interval_s
+
+	stats['cache_hits'] = cache.hits
+	stats['cache_misses'] = cache.misses
+	return stats
+
+
+if __name__ == "__main__":
+
+	ap = argparse.ArgumentParser(description='Decode captured SML frames into CSV, NumPy arrays or InfluxDB line protocol.')
+	ap.add_argument('captures', nargs='+', help='capture files or directories of capture files')
+	ap.add_argument('--format', choices=['csv', 'npy', 'influx'], default='csv')
+	ap.add_argument('--output', help='output file (csv, influx; default stdout) or directory (npy)')
+	ap.add_argument('--start', default=None, help='time of the first raw frame, Unix time or ISO 8601 (default 0, influx requires it; traffic logs have their own time stamps)')
+	ap.add_argument('--interval', type=float, default=1.0, help='time between frames in seconds (default 1.0)')
+	ap.add_argument('--measurement', default='meter', help='InfluxDB measurement name (default meter)')
+	ap.add_argument('--no-crc', action='store_true', help='do not verify frame CRCs')
+	ap.add_argument('--check', action='store_true', help='also fully parse every frame and report disagreements with the cached layout')
+	args = ap.parse_args()
+
+	if args.format == 'influx' and args.start is None:
+		ap.error('--format influx needs --start')
+	if args.format == 'npy' and not args.output:
+		ap.error('--format npy needs --output <directory>')
+	start_T = parseStartTime(args.start) if args.start is not None else 0.0
+
+	out = sys.stdout
+	if args.format != 'npy' and args.output:
+		out = open(args.output, 'w')
+
+	if args.format == 'csv':
+		writer = CsvWriter(out)
+	elif args.format == 'influx':
+		writer = InfluxLineWriter(out, args.measurement)
+	else:
+		writer = NpyWriter(args.output)
+
+	t0 = time.monotonic()
+	try:
+		stats = replay(args.captures, writer, start_T, args.interval, not args.no_crc, args.check)
+	finally:
+		writer.close()
+		if out is not sys.stdout:
+			out.close()
+	dt = time.monotonic() - t0
+
+	print('%d frames from %d files in %.1f s (%.0f frames/s), %d invalid, layout cache %d hits %d misses' % (
+		stats['frames'], stats['files'], dt, stats['frames'] / max(dt, 1e-9), stats['bad'], stats['cache_hits'], stats['cache_misses']),
+		file=sys.stderr)
+	if args.check:
+		print('%d frames disagree with the full parse' % (stats['mismatch']), file=sys.stderr)
+		if stats['mismatch'] > 0:
+			sys.exit(1)
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+#
+# DtuCommandQueue coalescing, redundant-write skipping and readback confirmation,
+# run on the virtual time event loop of SimulationHarness.py.
+#
+# Usage:
+#   python -m pytest -q test_DtuCommandQueue.py
+#
+
+import asyncio
+import unittest
+
+from DtuCommandQueue import DtuCommandQueue
+from SimulationHarness import VirtualTimeEventLoop, VirtualClock
+
+
+class FakeDtu:
+	"""
+	Stands in for AhoyDtuRESTAsync: records the commands and accepts them all.
+	"""
+
+	def __init__(self):
+		self.commands = []
+
+	async def setPowerLimit(self, P_W):
+		self.commands.append(('power_limit', P_W))
+		return {'success': True}
+
+	async def setPowerState(self, powerEnabled):
+		self.commands.append(('power_state', powerEnabled))
+		return {'success': True}
+
+
+def runVirtual(coro):
+	loop = VirtualTimeEventLoop()
+	try:
+		return loop.run_until_complete(coro)
+	finally:
+		loop.close()
+
+
+class TestDtuCommandQueue(unittest.TestCase):
+
+	def test_coalesce(self):
+		dtu = FakeDtu()
+		async def scenario():
+			queue = DtuCommandQueue(dtu, VirtualClock(None))
+			queue.setPowerLimit(100)
+			queue.setPowerLimit(200)
+			queue.setPowerLimit(300)
+			task = asyncio.create_task(queue.run())
+			await asyncio.sleep(1)
+			task.cancel()
+			return queue.stats
+		stats = runVirtual(scenario())
+		self.assertEqual(dtu.commands, [('power_limit', 300)])
+		self.assertEqual(stats['coalesced'], 2)
+		self.assertEqual(stats['sent'], 1)
+
+	def test_power_state_first(self):
+		dtu = FakeDtu()
+		async def scenario():
+			queue = DtuCommandQueue(dtu, VirtualClock(None))
+			queue.setPowerLimit(300)
+			queue.setPowerState(False)
+			task = asyncio.create_task(queue.run())
+			await asyncio.sleep(10)
+			task.cancel()
+		runVirtual(scenario())
+		self.assertEqual(dtu.commands, [('power_state', False), ('power_limit', 300)])
+
+	def test_skip_redundant_limit(self):
+		dtu = FakeDtu()
+		async def scenario():
+			queue = DtuCommandQueue(dtu, VirtualClock(None), tolerance_W=5)
+			queue.noteReadback(300)
+			queue.setPowerLimit(302)
+			task = asyncio.create_task(queue.run())
+			await asyncio.sleep(1)
+			self.assertFalse(queue.isBusy())
+			task.cancel()
+			return queue
+		queue = runVirtual(scenario())
+		self.assertEqual(dtu.commands, [])
+		self.assertEqual(queue.stats['skipped'], 1)
+
+	def test_readback_confirms(self):
+		dtu = FakeDtu()
+		async def scenario():
+			queue = DtuCommandQueue(dtu, VirtualClock(None), settling_time_s=5)
+			queue.noteReadback(100)
+			queue.setPowerLimit(300)
+			task = asyncio.create_task(queue.run())
+			await asyncio.sleep(1)
+			# DTU reading from before the command has settled confirms nothing
+			queue.noteReadback(100)
+			self.assertEqual(queue.expectedLimit(), 300)
+			await asyncio.sleep(5)
+			queue.noteReadback(300)
+			task.cancel()
+			return queue
+		queue = runVirtual(scenario())
+		self.assertEqual(queue.stats['confirmed'], 1)
+		self.assertEqual(queue.stats['unconfirmed'], 0)
+		self.assertIsNone(queue.sent_limit_W)
+		self.assertEqual(queue.expectedLimit(), 300)
+
+	def test_unconfirmed_resend_once(self):
+		dtu = FakeDtu()
+		async def scenario():
+			queue = DtuCommandQueue(dtu, VirtualClock(None), settling_time_s=5, confirm_timeout_s=30)
+			queue.setPowerLimit(300)
+			task = asyncio.create_task(queue.run())
+			await asyncio.sleep(31)
+			queue.noteReadback(100)
+			await asyncio.sleep(31)
+			queue.noteReadback(100)
+			await asyncio.sleep(31)
+			task.cancel()
+			return queue
+		queue = runVirtual(scenario())
+		self.assertEqual(dtu.commands, [('power_limit', 300), ('power_limit', 300)])
+		self.assertEqual(queue.stats['unconfirmed'], 2)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+#
+# Local hour bins of EnergyMath.py on the days of a DST change, and prices per bin.
+#
+# Usage:
+#   python -m pytest -q test_EnergyMath.py
+#
+
+import datetime
+import unittest
+
+import numpy as np
+
+from EnergyMath import localBinEdges, localMidnight, binValues, binEnergy, perDay, priceWeighted
+
+
+class TestLocalBinEdges(unittest.TestCase):
+
+	def test_spring_forward(self):
+		day = datetime.date(2024, 3, 31)
+		edges, day_index = localBinEdges(day, day)
+		self.assertEqual(len(edges) - 1, 23)
+		self.assertEqual(edges[0], localMidnight(day))
+		self.assertEqual(edges[-1], localMidnight(datetime.date(2024, 4, 1)))
+		self.assertTrue(np.all(np.diff(edges) == 3600))
+
+	def test_fall_back(self):
+		day = datetime.date(2024, 10, 27)
+		edges, day_index = localBinEdges(day, day)
+		self.assertEqual(len(edges) - 1, 25)
+		self.assertTrue(np.all(np.diff(edges) == 3600))
+
+	def test_quarter_hours(self):
+		edges, day_index = localBinEdges(datetime.date(2024, 10, 27), datetime.date(2024, 10, 27), bin_s=900)
+		self.assertEqual(len(edges) - 1, 100)
+
+	def test_day_index(self):
+		edges, day_index = localBinEdges(datetime.date(2024, 3, 30), datetime.date(2024, 4, 1))
+		self.assertEqual(list(np.bincount(day_index)), [24, 23, 24])
+		self.assertEqual(edges[24], localMidnight(datetime.date(2024, 3, 31)))
+		self.assertEqual(edges[47], localMidnight(datetime.date(2024, 4, 1)))
+
+	def test_per_day(self):
+		edges, day_index = localBinEdges(datetime.date(2024, 10, 26), datetime.date(2024, 10, 27))
+		self.assertEqual(list(perDay(np.ones(len(day_index)), day_index)), [24.0, 25.0])
+
+
+class TestBinValues(unittest.TestCase):
+
+	def test_outside_and_nan(self):
+		edges = np.array([0.0, 10.0, 20.0])
+		sums = binValues([-1, 0, 5, 10, 15, 20], [100, 1, 2, 3, np.nan, 100], edges)
+		self.assertEqual(list(sums), [3.0, 3.0])
+
+	def test_import_export(self):
+		edges = np.array([0.0, 3600.0])
+		total, imported, exported = binEnergy([0, 1800], [200, -100], edges, 1800)
+		self.assertEqual((total[0], imported[0], exported[0]), (50.0, 100.0, 50.0))
+
+
+class TestPriceWeighted(unittest.TestCase):
+
+	def test_quarter_hour_prices(self):
+		# 25 h day: hourly energy at 100 quarter-hourly prices
+		E_kWh = np.ones(25)
+		prices = np.repeat(np.arange(25) * 0.01, 4) + np.tile([0.0, 0.01, 0.02, 0.03], 25)
+		cost = priceWeighted(E_kWh, prices)
+		self.assertEqual(len(cost), 25)
+		self.assertAlmostEqual(cost[0], 0.015)
+		self.assertAlmostEqual(cost[24], 0.255)
+
+	def test_hourly_prices(self):
+		cost = priceWeighted(np.full(92, 0.25), np.arange(23) * 0.1)
+		self.assertEqual(len(cost), 92)
+		self.assertAlmostEqual(cost[4], 0.025)
+		self.assertAlmostEqual(cost[91], 0.55)
+
+	def test_mismatch(self):
+		# prices of a 24 h day for the 23 h of the spring forward day
+		self.assertIsNone(priceWeighted(np.ones(23), np.ones(24)))
+		self.assertIsNone(priceWeighted(np.ones(23), np.ones(96)))
+		self.assertIsNone(priceWeighted(np.ones(23), []))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+#
+# Split of the total power limit across inverters by PowerControlLogic.allocatePower().
+#
+# Usage:
+#   python -m pytest -q test_PowerControlLogic.py
+#
+
+import unittest
+
+from PowerControlLogic import allocatePower
+
+
+class TestAllocatePower(unittest.TestCase):
+
+	def test_priority_fill(self):
+		units = [{'max_W': 600}, {'max_W': 400}]
+		self.assertEqual(allocatePower(800, units), [600, 200])
+		self.assertEqual(allocatePower(300, units), [300, 0])
+
+	def test_remainder_capped(self):
+		units = [{'max_W': 600}, {'max_W': 400}]
+		self.assertEqual(allocatePower(1500, units), [600, 400])
+
+	def test_negative_total(self):
+		units = [{'max_W': 600}, {'max_W': 400}]
+		self.assertEqual(allocatePower(-50, units), [0, 0])
+
+	def test_min_limit(self):
+		units = [{'max_W': 600}, {'max_W': 400, 'min_W': 20}]
+		self.assertEqual(allocatePower(600, units), [600, 20])
+
+	def test_disabled(self):
+		units = [{'max_W': 600, 'enabled': False}, {'max_W': 400}]
+		self.assertEqual(allocatePower(300, units), [None, 300])
+
+	def test_solar_short_of_sun(self):
+		units = [{'max_W': 600, 'solar': True, 'Pac': 150, 'limit_W': 400}, {'max_W': 400}]
+		self.assertEqual(allocatePower(500, units), [600, 350])
+
+	def test_solar_at_limit(self):
+		units = [{'max_W': 600, 'solar': True, 'Pac': 398, 'limit_W': 400}, {'max_W': 400}]
+		self.assertEqual(allocatePower(500, units), [500, 0])
+
+	def test_solar_last_takes_remainder(self):
+		units = [{'max_W': 400}, {'max_W': 600, 'solar': True, 'Pac': 150, 'limit_W': 400}]
+		self.assertEqual(allocatePower(700, units), [400, 300])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+#
+# SmlParser.parseSmlFrame() and SmlLayoutCache on frames built by SimulatedPlant.encodeSmlFrame().
+#
+# Usage:
+#   python -m pytest -q test_SmlParser.py
+#
+
+import unittest
+
+from SimulatedPlant import encodeSmlFrame
+from SmlParser import parseSmlFrame, SmlLayoutCache, OBIS_POWER, OBIS_ENERGY_IMPORT, OBIS_ENERGY_EXPORT, OBIS_POWER_L1, OBIS_POWER_L3
+
+
+class TestParseSmlFrame(unittest.TestCase):
+
+	def test_roundtrip(self):
+		index = parseSmlFrame(encodeSmlFrame(-123, 4567.8, 901.2))
+		self.assertEqual(index[OBIS_POWER].value, -123)
+		self.assertAlmostEqual(index[OBIS_ENERGY_IMPORT].value, 4567.8)
+		self.assertAlmostEqual(index[OBIS_ENERGY_EXPORT].value, 901.2)
+		self.assertEqual(index[OBIS_POWER].unitName, 'W')
+		self.assertEqual(index[OBIS_ENERGY_IMPORT].unitName, 'Wh')
+
+	def test_phases(self):
+		index = parseSmlFrame(encodeSmlFrame(300, 1.0, 0.0, phase_W=(100, 150, 50)))
+		self.assertEqual(index[OBIS_POWER_L1].value, 100)
+		self.assertEqual(index[OBIS_POWER_L3].value, 50)
+
+	def test_crc_error(self):
+		frame = bytearray(encodeSmlFrame(100, 1.0, 0.0))
+		frame[-1] ^= 0xFF
+		self.assertIsNone(parseSmlFrame(bytes(frame)))
+		self.assertIsNotNone(parseSmlFrame(bytes(frame), verify_crc=False))
+
+	def test_truncated(self):
+		self.assertIsNone(parseSmlFrame(encodeSmlFrame(100, 1.0, 0.0)[:-20]))
+		self.assertIsNone(parseSmlFrame(b''))
+
+	def test_leading_garbage(self):
+		index = parseSmlFrame(b'\x00\x42' + encodeSmlFrame(77, 2.0, 0.0))
+		self.assertEqual(index[OBIS_POWER].value, 77)
+
+
+class TestSmlLayoutCache(unittest.TestCase):
+
+	def test_same_as_full_parse(self):
+		cache = SmlLayoutCache()
+		for (P, E_in, E_out) in ((250, 1000.0, 10.0), (-40, 1000.5, 10.1), (1999, 1234.5, 11.0)):
+			frame = encodeSmlFrame(P, E_in, E_out)
+			expected = {obis: v.value for obis, v in parseSmlFrame(frame).items()}
+			self.assertEqual(cache.decode(frame), expected)
+		self.assertEqual(cache.misses, 1)
+		self.assertEqual(cache.hits, 2)
+
+	def test_layout_change(self):
+		cache = SmlLayoutCache()
+		cache.decode(encodeSmlFrame(250, 1000.0, 10.0))
+		values = cache.decode(encodeSmlFrame(300, 1000.0, 10.0, phase_W=(100, 100, 100)))
+		self.assertEqual(values[OBIS_POWER_L1], 100)
+		self.assertEqual(cache.misses, 2)
+
+	def test_crc_error_on_cached_layout(self):
+		cache = SmlLayoutCache()
+		cache.decode(encodeSmlFrame(250, 1000.0, 10.0))
+		frame = bytearray(encodeSmlFrame(260, 1000.0, 10.0))
+		frame[-2] ^= 0xFF
+		self.assertIsNone(cache.decode(bytes(frame)))
+
+
+if __name__ == '__main__':
+	unittest.main()
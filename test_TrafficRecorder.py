@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+#
+# Logs written by TrafficRecorder, read back by TrafficLogReader through the index of a
+# cleanly closed log and by the linear scan of a log that was cut short.
+#
+# Usage:
+#   python -m pytest -q test_TrafficRecorder.py
+#
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from TrafficRecorder import TrafficRecorder, TrafficLogReader
+
+
+SOURCES = ['GET http://dtu/api/live', 'GET http://tibber/data.json', 'GET http://mystrom/report']
+
+
+async def writeLog(filename, n, index_every):
+	recorder = TrafficRecorder(filename, index_every=index_every)
+	await recorder.start()
+	for k in range(n):
+		recorder.record(SOURCES[k % 3], 'response %d' % (k), status=200, T=1000.0 + k)
+		if k % 7 == 6:
+			await recorder.flush()
+	await recorder.stop()
+	return recorder
+
+
+class TestTrafficLog(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.filename = os.path.join(self.dir, 'traffic.log')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_roundtrip(self):
+		recorder = asyncio.run(writeLog(self.filename, 35, 10))
+		self.assertEqual(recorder.num_recorded, 35)
+		log = TrafficLogReader(self.filename)
+		records = list(log.records())
+		log.close()
+		self.assertEqual(len(records), 35)
+		self.assertEqual(records[4], (1004.0, SOURCES[1], 200, b'response 4'))
+
+	def test_index(self):
+		asyncio.run(writeLog(self.filename, 35, 10))
+		log = TrafficLogReader(self.filename)
+		records = list(log.records(start_T=1012.0, end_T=1030.0))
+		self.assertIsNotNone(log.index)
+		self.assertEqual(len(log.index), 35)
+		log.close()
+		self.assertEqual([r[0] for r in records], [1000.0 + k for k in range(12, 30)])
+		self.assertEqual(records[0][1], SOURCES[0])
+
+	def test_index_same_as_scan(self):
+		asyncio.run(writeLog(self.filename, 35, 10))
+		truncated = self.filename + '.cut'
+		with open(self.filename, 'rb') as f:
+			data = f.read()
+		with open(truncated, 'wb') as f:
+			f.write(data[:-1])
+
+		indexed = TrafficLogReader(self.filename)
+		scanned = TrafficLogReader(truncated)
+		for start_T in (999.0, 1000.0, 1009.5, 1010.0, 1034.0):
+			self.assertEqual(list(indexed.records(start_T=start_T, sources=['tibber'])), list(scanned.records(start_T=start_T, sources=['tibber'])))
+			self.assertEqual(list(indexed.records(start_T=start_T)), list(scanned.records(start_T=start_T)))
+		self.assertIsNotNone(indexed.index)
+		self.assertIsNone(scanned.index)
+		indexed.close()
+		scanned.close()
+
+	def test_after_end(self):
+		asyncio.run(writeLog(self.filename, 35, 10))
+		log = TrafficLogReader(self.filename)
+		self.assertEqual(list(log.records(start_T=2000.0)), [])
+		log.close()
+
+	def test_not_a_log(self):
+		with open(self.filename, 'wb') as f:
+			f.write(b'{"power": 0}')
+		with self.assertRaises(ValueError):
+			TrafficLogReader(self.filename)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+#
+# Rollup start of influxdbCalcCosts.py from replies shaped like those of aioinflux,
+# which returns epoch timestamps rather than RFC3339 strings, and after failed queries.
+#
+# Usage:
+#   python -m pytest -q test_influxdbCalcCosts.py
+#
+
+import asyncio
+import datetime
+import unittest
+
+from aioinflux import InfluxDBError
+
+import influxdbCalcCosts
+from influxdbRollups import parseRollupStart, rollupCovers
+
+
+class FakeAioInflux:
+	"""
+	Stands in for aioinflux.InfluxDBClient: query() returns the parsed JSON reply as is.
+	"""
+
+	def __init__(self, reply):
+		self.reply = reply
+		self.epochs = []
+
+	async def query(self, q, epoch='ns'):
+		self.epochs.append(epoch)
+		return self.reply
+
+
+class FailingAioInflux:
+	"""
+	aioinflux.InfluxDBClient whose first queries fail with the given exceptions.
+	"""
+
+	def __init__(self, errors, reply):
+		self.errors = list(errors)
+		self.reply = reply
+		self.calls = 0
+
+	async def query(self, q, epoch='ns'):
+		self.calls += 1
+		if self.errors:
+			raise self.errors.pop(0)
+		return self.reply
+
+
+def rollupStartReply(t):
+	return {'results': [{'statement_id': 0, 'series': [{'name': 'energy', 'columns': ['time', 'first'], 'values': [[t, 1.0]]}]}]}
+
+
+class TestRollupStart(unittest.TestCase):
+
+	def setUp(self):
+		influxdbCalcCosts._rollup_starts.clear()
+
+	def test_queryPoints_epoch(self):
+		db = FakeAioInflux(rollupStartReply(1700000000))
+		points = asyncio.run(influxdbCalcCosts.queryPoints(db, 'SELECT 1'))
+		self.assertEqual(points, [[{'time': 1700000000, 'first': 1.0}]])
+		self.assertEqual(db.epochs, ['s'])
+
+	def test_getRollupStart(self):
+		db = FakeAioInflux(rollupStartReply(1700000000))
+		start = asyncio.run(influxdbCalcCosts.getRollupStart(db, 'house'))
+		self.assertEqual(start, datetime.datetime(2023, 11, 14, 22, 13, 20, tzinfo=datetime.timezone.utc))
+		self.assertEqual(db.epochs, ['s'])
+		self.assertTrue(rollupCovers(start, datetime.date(2023, 11, 16)))
+		self.assertFalse(rollupCovers(start, datetime.date(2023, 11, 14)))
+
+	def test_getRollupStart_empty(self):
+		db = FakeAioInflux({'results': [{'statement_id': 0}]})
+		self.assertIsNone(asyncio.run(influxdbCalcCosts.getRollupStart(db, 'house')))
+
+	def test_getRollupStart_timeout(self):
+		db = FailingAioInflux([asyncio.TimeoutError()], rollupStartReply(1700000000))
+		self.assertIsNone(asyncio.run(influxdbCalcCosts.getRollupStart(db, 'house')))
+		self.assertNotIn('house', influxdbCalcCosts._rollup_starts)
+		start = asyncio.run(influxdbCalcCosts.getRollupStart(db, 'house'))
+		self.assertEqual(start, datetime.datetime(2023, 11, 14, 22, 13, 20, tzinfo=datetime.timezone.utc))
+		self.assertEqual(db.calls, 2)
+
+	def test_getRollupStart_influx_error(self):
+		db = FailingAioInflux([InfluxDBError('retention policy not found: rollup_1h')], rollupStartReply(1700000000))
+		self.assertIsNone(asyncio.run(influxdbCalcCosts.getRollupStart(db, 'house')))
+		self.assertNotIn('house', influxdbCalcCosts._rollup_starts)
+
+	def test_getRollupStart_other_error(self):
+		db = FailingAioInflux([ValueError('bad reply')], rollupStartReply(1700000000))
+		with self.assertRaises(ValueError):
+			asyncio.run(influxdbCalcCosts.getRollupStart(db, 'house'))
+		self.assertNotIn('house', influxdbCalcCosts._rollup_starts)
+
+	def test_parseRollupStart(self):
+		self.assertIsNone(parseRollupStart([]))
+		self.assertEqual(parseRollupStart([{'time': 0, 'first': 1.0}]), datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc))
+
+
+if __name__ == '__main__':
+	unittest.main()